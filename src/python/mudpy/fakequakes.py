@@ -6,6 +6,9 @@ This grew (a lot) from RJ Leveque's KL2d_vonKarman notebook. I modified
 it to work in a similar way to the MudPy ivnersions
 '''
 
+from dataclasses import dataclass
+from typing import Optional,Union,Any
+
 
 #Initalize project folders
 def init(home,project_name):
@@ -93,13 +96,20 @@ def llz2utm(lon,lat,projection_zone='None'):
 
 
 
-def subfault_distances_3D(home,project_name,fault_name,slab_name,projection_zone):
+def subfault_distances_3D(home,project_name,fault_name,slab_name,projection_zone,
+        chunk_size=256,precision='float64',out_prefix=None):
     """
     Estimate the distance between subfaults i and j for every pair in the list
     fault.subfaults. For a 3D fault geometry
 
     :Inputs:
       -  *fault* of MudPy .fault class
+      -  *chunk_size* number of rows of the distance matrices computed per
+         vectorized batch, lower it if memory is tight
+      -  *precision* 'float64' (default) or 'float32' for the output arrays
+      -  *out_prefix* if not None the matrices are written straight to
+         out_prefix+'.strike.npy' and out_prefix+'.dip.npy' as memory maps
+         and never need to fit in RAM
     
     :Outputs:
       - *D* array of Euclidean distances based on longitudes, latitudes, and depths
@@ -112,23 +122,33 @@ def subfault_distances_3D(home,project_name,fault_name,slab_name,projection_zone
 
     Distance in dip direction based on differences in depth and average dip of the fault.  
 
+    All pairs in a block of chunk_size rows are computed at once, the geodesic
+    inverse problem is solved on whole arrays and the slab contour projection
+    is done once per contour rather than once per pair.
+
     """
 
-    from numpy import sqrt,sin,cos,deg2rad,zeros,meshgrid,linspace,where,c_,unravel_index,sort,diff,genfromtxt,sign,argmin
+    from numpy import sqrt,sin,cos,deg2rad,zeros,meshgrid,linspace,where,c_,diff,genfromtxt,sign,argmin,arange,unique,r_,abs,tile,repeat,ones
+    from numpy.lib.format import open_memmap
     from scipy.interpolate import griddata
+    from scipy.spatial import cKDTree
     from matplotlib import pyplot as plt
-    from scipy.spatial.distance import cdist
     from pyproj import Geod
     
+    #Read fault geometry data
+    fault=genfromtxt(home+project_name+'/data/model_info/'+fault_name)
+    nsubfaults = len(fault)
+    
+    #Initalize distance output arrays, on disk if requested
+    if out_prefix is None:
+        Dstrike = zeros((nsubfaults,nsubfaults),dtype=precision)
+        Ddip = zeros((nsubfaults,nsubfaults),dtype=precision)
+    else:
+        Dstrike = open_memmap(out_prefix+'.strike.npy',mode='w+',dtype=precision,shape=(nsubfaults,nsubfaults))
+        Ddip = open_memmap(out_prefix+'.dip.npy',mode='w+',dtype=precision,shape=(nsubfaults,nsubfaults))
+    
     #if you want the simplified distances
     if slab_name==None:
-        #Read fault geometry data
-        fault=genfromtxt(home+project_name+'/data/model_info/'+fault_name)
-        
-        #Initalize distance output arrays
-        nsubfaults = len(fault)
-        Dstrike = zeros((nsubfaults,nsubfaults))
-        Ddip = zeros((nsubfaults,nsubfaults))  
         
         #What's the average dip of the fault model?? 
         dip=fault[:,5].mean()
@@ -139,84 +159,66 @@ def subfault_distances_3D(home,project_name,fault_name,slab_name,projection_zone
         #Instantiate projection object
         g = Geod(ellps='WGS84') 
         
-        #Loop over faults an compute distances
+        #Loop over blocks of rows and compute distances
         print('Getting inter-fault distances')
-        for i in range(len(fault)):
+        for i0 in range(0,nsubfaults,chunk_size):
             
-            if i%10==0:
-                print('... working on subfault '+str(i)+' of '+str(len(fault)))
+            i1=min(i0+chunk_size,nsubfaults)
+            print('... working on subfaults '+str(i0)+' to '+str(i1-1)+' of '+str(nsubfaults))
+            nrows=i1-i0
             
-            #For each subfault loop over every other subfault
-            for j in range(len(fault)):
-                
-                #Subfault distance with itslef is zero
-                if i==j:
-                    Ddip[i,j] = 0
-                    Dstrike[i,j] = 0
-                else:
-                    lon_origin=fault[i,1]
-                    lat_origin=fault[i,2]
-                    lon_target=fault[j,1]
-                    lat_target=fault[j,2]
-                    az,baz,dist=g.inv(lon_origin,lat_origin,lon_target,lat_target)
-                    
-                    #straight line distance
-                    delta_strike=dist/1000
-                    #define projection angel as azimuth minus average strike
-                    alpha=az-strike
-                    #Project distance
-                    delta_strike=abs(delta_strike*cos(deg2rad(alpha)))
-                    
-                    #Down dip is jsut depth difference / avg dip of model
-                    z_origin=fault[i,3]
-                    z_target=fault[j,3]
-                    delta_dip=abs(z_origin-z_target)/sin(deg2rad(dip))
-                    
-                    #get the correct signs
-                    if z_origin<z_target:
-                        dip_sign=-1.
-                    else:
-                        dip_sign=1.
-                        
-                        
-                    #Fix azimuth polarity
-                    if az<0:
-                        az+=360
-                        
-                    #Rotate and rectify azimuth
-                    azimuth_rotated=az-strike
-                    if azimuth_rotated<0:
-                        azimuth_rotated+=360
-                    
-                        
-                    if azimuth_rotated >=90 and azimuth_rotated <= 270:
-                        strike_sign = -1.
-                    else:
-                        strike_sign= 1.
-                    
-                    Ddip[i,j] = dip_sign*delta_dip
-                    Dstrike[i,j] = strike_sign*delta_strike
+            #Every (i,j) pair in the block as flat arrays
+            lon_origin=repeat(fault[i0:i1,1],nsubfaults)
+            lat_origin=repeat(fault[i0:i1,2],nsubfaults)
+            lon_target=tile(fault[:,1],nrows)
+            lat_target=tile(fault[:,2],nrows)
+            az,baz,dist=g.inv(lon_origin,lat_origin,lon_target,lat_target)
+            az=az.reshape(nrows,nsubfaults)
+            dist=dist.reshape(nrows,nsubfaults)
+            
+            #straight line distance projected along the average strike
+            alpha=az-strike
+            delta_strike=abs((dist/1000)*cos(deg2rad(alpha)))
+            
+            #Down dip is jsut depth difference / avg dip of model
+            z_origin=fault[i0:i1,3][:,None]
+            z_target=fault[:,3][None,:]
+            delta_dip=abs(z_origin-z_target)/sin(deg2rad(dip))
+            
+            #get the correct signs
+            dip_sign=ones((nrows,nsubfaults))
+            dip_sign[(z_origin<z_target).nonzero()]=-1.
+            
+            #Fix azimuth polarity, then rotate and rectify azimuth
+            az[az<0]+=360
+            azimuth_rotated=az-strike
+            azimuth_rotated[azimuth_rotated<0]+=360
+            strike_sign=ones((nrows,nsubfaults))
+            strike_sign[(azimuth_rotated>=90) & (azimuth_rotated<=270)]=-1.
+            
+            block_dip=dip_sign*delta_dip
+            block_strike=strike_sign*delta_strike
+            
+            #Subfault distance with itslef is zero
+            irow=arange(nrows)
+            block_dip[irow,irow+i0]=0
+            block_strike[irow,irow+i0]=0
+            
+            Ddip[i0:i1,:]=block_dip
+            Dstrike[i0:i1,:]=block_strike
            
                     
     #If there's a slab_model file and you want the onfault complicated to get distances
     else:
         
         #Load things
-        fault=genfromtxt(home+project_name+'/data/model_info/'+fault_name)
         slab_model=genfromtxt(home+project_name+'/data/model_info/'+slab_name)    
-    
-        #Initalize distance output arrays
-        nsubfaults = len(fault)
-        Dstrike = zeros((nsubfaults,nsubfaults))
-        Ddip = zeros((nsubfaults,nsubfaults))
         
         #Get average dip
         avg_dip=fault[:,5].mean()
         
         #get down-dip azimuths
         down_dip=fault[:,4]+90
-        # i=where(down_dip>360)[0]
-        # down_dip[i]=down_dip[i]-360
         
         #Convert slab1.0 to local UTM coordinates
         slab_x,slab_y=llz2utm(slab_model[:,0],slab_model[:,1],projection_zone)
@@ -229,15 +231,12 @@ def subfault_distances_3D(home,project_name,fault_name,slab_name,projection_zone
         fault_z=fault[:,3]
         
         #The goal is to only keep slab points close tot he actual fault, to accomplish this
-        # Calcualte the distance from each fault to slab point and only keep things
+        # find the nearest subfault to each slab point and only keep things
         #Within a minimum distance
         slab2fault_min_distance=30 #in km
-        keep_slab=zeros((len(fault_x),len(slab_x)))
-        for ksub in range(len(fault)):
-            dist=((fault_x[ksub]-slab_x)**2+(fault_y[ksub]-slab_y)**2)**0.5
-            i=where(dist<slab2fault_min_distance)[0]
-            keep_slab[ksub,i]=1
-        i=where(keep_slab.sum(axis=0)>0)[0]
+        tree=cKDTree(c_[fault_x,fault_y])
+        nearest_fault,foo=tree.query(c_[slab_x,slab_y])
+        i=where(nearest_fault<slab2fault_min_distance)[0]
         slab_x=slab_x[i]
         slab_y=slab_y[i]
         slab_z=slab_z[i]
@@ -254,102 +253,88 @@ def subfault_distances_3D(home,project_name,fault_name,slab_name,projection_zone
         x_range=slab_x.max()-slab_x.min()
         x_down_dip=linspace(-x_range/2,x_range/2,200)
         
-        #get contours
-        all_contours=[]
-        contour_lengths=zeros(len(fault))
-        print('Calculcating slab contours')
-        for i in range(len(fault)):
-            if i%10==0:
-                print('... working on subfault '+str(i)+' of '+str(len(fault)))
-            
-            contour=plt.contour(X,Y,Z,levels=[fault[i,3]])
-            contour=contour.collections[0].get_paths()[0].vertices
-            contour_lengths[i]=((contour[0,0]-contour[-1,0])**2+(contour[0,1]-contour[-1,1])**2)**0.5
-            all_contours.append(contour)
+        #get contours, these only depend on depth so do each unique depth once
+        unique_depths,depth_index=unique(fault[:,3],return_inverse=True)
+        unique_contours=[]
+        unique_lengths=zeros(len(unique_depths))
+        print('Calculcating slab contours at '+str(len(unique_depths))+' unique depths')
+        fig,ax=plt.subplots()
+        for k in range(len(unique_depths)):
+            contour=ax.contour(X,Y,Z,levels=[unique_depths[k]])
+            contour=contour.allsegs[0][0]
+            unique_lengths[k]=((contour[0,0]-contour[-1,0])**2+(contour[0,1]-contour[-1,1])**2)**0.5
+            unique_contours.append(contour)
+        plt.close(fig)
+        contour_lengths=unique_lengths[depth_index.ravel()]
         
         #if a contour is shorter than this number use the next deepest
         minimum_contour_length=0.95*contour_lengths.max()
         
+        #find most approriate contour for lenght calculation
+        icontour=where(contour_lengths>minimum_contour_length)[0]
+        
+        #For every subfault the contour that is long enough and closest in depth
+        icontour_correct=zeros(nsubfaults,dtype='int')
+        for i in range(nsubfaults):
+            deltaZ=abs(fault_z[i]-fault_z[icontour])
+            icontour_correct[i]=icontour[argmin(deltaZ)]
+        contour_id=depth_index.ravel()[icontour_correct]
+        
+        #Down-dip lines through every subfault, shape (nsubfaults,200)
+        x_down_dip_subfault=x_down_dip[None,:]+fault_x[:,None]
+        y_down_dip_subfault=x_down_dip[None,:]*(-cos(deg2rad(down_dip[:,None])))+fault_y[:,None]
         
-        #Loop over number of subfaults, we want the distance from i-th fault to all other (j) subfaults
+        #Loop over the contours that are actually used, all subfaults sharing 
+        #a contour get their rows at once
         print('Getting inter-fault distances')
-        for i in range(len(fault)):
-            if i%10==0:
-                print('... working on subfault '+str(i)+' of '+str(len(fault)))
-            #Current fault
-            xi = fault_x[i]
-            yi = fault_y[i]
-            zi = fault_z[i]
+        for kcontour in unique(contour_id):
             
-            #find most approriate contour for lenght calculation
-            icontour=where(contour_lengths>minimum_contour_length)[0]
+            contour=unique_contours[kcontour]
+            rows=where(contour_id==kcontour)[0]
+            print('... working on contour at '+str(unique_depths[kcontour])+'km with '+str(len(rows))+' subfaults')
             
-            #find closest depth_contour of the ones that pass the minimum length
-            deltaZ=abs(fault_z[i]-fault_z)
-            icontour_depth=argmin(deltaZ[icontour])
+            #Cumulative path length along the contour
+            arc_length=r_[0,sqrt(diff(contour[:,0])**2+diff(contour[:,1])**2).cumsum()]
             
-            #This si the contour that is long enough and closest in depth
-            icontour_correct=icontour[icontour_depth]
-            contour=all_contours[icontour_correct]
+            #Intersection between contour and every down-dip line by minimum 
+            #distance, batch size keeps the work array at ~20 million elements
+            intersect=zeros(nsubfaults,dtype='int')
+            nbatch=max(1,int(2e7/(len(contour)*len(x_down_dip))))
+            for j0 in range(0,nsubfaults,nbatch):
+                j1=min(j0+nbatch,nsubfaults)
+                dist=(contour[:,0,None,None]-x_down_dip_subfault[None,j0:j1,:])**2+(contour[:,1,None,None]-y_down_dip_subfault[None,j0:j1,:])**2
+                intersect[j0:j1]=dist.min(axis=2).argmin(axis=0)
+            ymin_j=contour[intersect,1]
             
-            
-#            # X, Y and Z are matrices with the grid info, now create one contour at each subfault centroid depth
-#            contour=plt.contour(X,Y,Z,levels=fault[i,3])
-#            
-#            #Get contour at depth of current subfault
-#            contour=contour.collections[0].get_paths()[0].vertices
-            
-            # Now find coordinates of point on this contour closest to subfault centroid
-            dist=sqrt((xi-contour[:,0])**2+(yi-contour[:,1])**2)
-            imin=dist.argmin()
-            
-            # These are coordinates on the contour
-            xmin_i=contour[imin,0]
-            ymin_i=contour[imin,1]
-            
-            #For each subfault loop over every other subfault
-            for j in range(len(fault)):
-                xj = fault_x[j]
-                yj = fault_y[j]
-                zj = fault_z[j]
+            for i0 in range(0,len(rows),chunk_size):
                 
-                #Get down_dip y coordinates
-                y_down_dip=x_down_dip*(-cos(deg2rad(down_dip[j])))
+                i=rows[i0:i0+chunk_size]
                 
-                #Move line origin to subfault being tested
-                x_down_dip_subfault=x_down_dip+xj
-                y_down_dip_subfault=y_down_dip+yj
+                # Coordinates of point on this contour closest to subfault centroid
+                dist=(fault_x[i,None]-contour[None,:,0])**2+(fault_y[i,None]-contour[None,:,1])**2
+                imin=dist.argmin(axis=1)
+                ymin_i=contour[imin,1]
                 
-                #Get coordinates of intersection point between contour and down-dip line by finding minimum distance
-                dist=cdist(contour,c_[x_down_dip_subfault,y_down_dip_subfault])
-                r,c=unravel_index(dist.argmin(),dist.shape)
-                xmin_j=contour[r,0]
-                ymin_j=contour[r,1]           
+                #Along strike distance is the path integral along contour between 
+                #the two points, negative if subfault is down_strike
+                delta_strike=abs(arc_length[intersect][None,:]-arc_length[imin][:,None])
+                strike_sign=sign(ymin_j[None,:]-ymin_i[:,None])
+                block_strike=strike_sign*delta_strike
                 
-                #Keep only points on the contour array that correspond to starting and stopping points along the path
-                keep=sort([r,imin])
-                contour_integral=contour[keep[0]:keep[1]+1]
+                #get down dip distance from depth and average dip
+                block_dip=(fault_z[i,None]-fault_z[None,:])/sin(deg2rad(avg_dip))
                 
-                #Along strike distance is the path integral along contour between (xmin_i,ymin_i) and (xmin_j,ymin_j)
-                dx=diff(contour_integral[:,0])
-                dy=diff(contour_integral[:,1])
-                delta_strike=sqrt(dx**2+dy**2).sum() #Phew, that was hard
-                #Give negative sign if subfault is down_strike
-                strike_sign=sign(ymin_j-ymin_i)
-                delta_strike=strike_sign*delta_strike
+                #Subfault distance with itslef is zero
+                irow=arange(len(i))
+                block_dip[irow,i]=0
+                block_strike[irow,i]=0
                 
+                Ddip[i,:]=block_dip
+                Dstrike[i,:]=block_strike
     
-                
-                #get down dip distance from depth and average dip
-                delta_dip=(zi-zj)/sin(deg2rad(avg_dip))
-            
-                #Now the outputs
-                if i==j:
-                    Ddip[i,j] = 0
-                    Dstrike[i,j] = 0
-                else:
-                    Ddip[i,j] = delta_dip
-                    Dstrike[i,j] = delta_strike
+    if out_prefix is not None:
+        Dstrike.flush()
+        Ddip.flush()
                 
     return Dstrike,Ddip
 
@@ -431,33 +416,89 @@ def get_covariance(mean_slip,C,target_Mw,fault_array,vel_mod,alpha=0.6):
     return Cov
            
                              
-def get_eigen(C):
+def get_eigen(C,num_modes=None):
     '''
     Get eigen vectors/values from correlation matrix and return sorted results
+    
+    C is symmetric so a symmetric solver is used, if num_modes is not None only
+    the num_modes largest eigenpairs are computed
     '''
-    from numpy.linalg import eig
-    from numpy import real,argsort
+    from scipy.linalg import eigh
     
-    eigenvals, V = eig(C)
-        
-    eigenvals = real(eigenvals)  # imaginary parts should be at rounding level
-    V = real(V)
+    #Symmetrize away roundoff in the distance matrices
+    C=(C+C.T)/2
     
-    # Sort eigenvalues:
-    i = list(argsort(eigenvals))
-    i.reverse()
-    eigenvals = eigenvals[i]
-    V = V[:,i]
+    N=len(C)
+    if num_modes==None or num_modes>=N:
+        eigenvals,V=eigh(C)
+    else:
+        eigenvals,V=eigh(C,subset_by_index=[N-num_modes,N-1])
+    
+    # Sort eigenvalues, largest first:
+    eigenvals = eigenvals[::-1]
+    V = V[:,::-1]
     
     return eigenvals,V
     
     
+def get_KL_basis(Dstrike,Ddip,ifaults,Ls,Ld,hurst,mean_slip,alpha,num_modes,lognormal=True,KL_cache=None,max_cached=20):
+    '''
+    Build the von Karman correlation of the selected subfaults, turn it into a
+    (lognormal) covariance and get its leading num_modes eigenpairs. 
+    
+    If KL_cache is a dictionary the eigenpairs are stored in it keyed by the 
+    subfault selection, Ls, Ld, hurst, alpha and the mean slip so later 
+    realizations with the same selection skip the decomposition. At most 
+    max_cached bases are kept, the oldest one is dropped first.
+    
+    IN:
+        Dstrike,Ddip: Inter-subfault distances for the whole fault
+        ifaults: Indices of the selected subfaults
+        Ls,Ld: Correlation lengths along strike and dip
+        hurst: Hurst exponent
+        mean_slip: Mean slip on the selected subfaults
+        alpha: Slip standard deviation as a fraction of the mean slip
+        num_modes: Number of KL modes
+        lognormal: Use the lognormal covariance
+        
+    OUT:
+        eigenvals,V: Sorted eigenvalues and eigenvectors
+        mean_slip: Mean of the KL expansion, log of the mean slip if lognormal=True
+    '''
+    
+    from numpy import log,diag
+    
+    #The lognormal covariance only depends on mean_slip through roundoff, but
+    #that's enough to make a cached basis differ from a fresh one
+    key=(ifaults.tobytes(),float(Ls),float(Ld),float(hurst),float(alpha),lognormal,mean_slip.tobytes())
+    
+    if KL_cache is not None and key in KL_cache:
+        eigenvals,V,Cov_diag=KL_cache[key]
+    else:
+        Dstrike_selected=Dstrike[ifaults,:][:,ifaults]
+        Ddip_selected=Ddip[ifaults,:][:,ifaults]
+        C=vonKarman_correlation(Dstrike_selected,Ddip_selected,Ls,Ld,hurst)
+        if lognormal==False:
+            Cov=get_covariance(mean_slip,C,None,None,None,alpha)
+        else:
+            Cov,foo=get_lognormal(mean_slip,C,None,None,None,alpha)
+        Cov_diag=diag(Cov).copy()
+        eigenvals,V=get_eigen(Cov,num_modes)
+        if KL_cache is not None:
+            if len(KL_cache)>=max_cached:
+                KL_cache.pop(next(iter(KL_cache)))
+            KL_cache[key]=(eigenvals,V,Cov_diag)
+    
+    if lognormal==True:
+        mean_slip=log(mean_slip)-Cov_diag/2.
+    
+    return eigenvals,V,mean_slip
+    
+    
 def make_KL_slip(fault,num_modes,eigenvals,V,mean_slip,max_slip,lognormal=True,maxiter=5,seed=12345):
     '''
     Make slip map using num_modes
     '''
-    from numpy import sqrt,exp
-    from numpy.random import randn
     from numpy.random import seed as random_seed
     
     iterations=0
@@ -470,20 +511,11 @@ def make_KL_slip(fault,num_modes,eigenvals,V,mean_slip,max_slip,lognormal=True,m
             #Is there a seed?
         if seed != None:
             random_seed(seed)
-        if len(fault)>num_modes:
-            z = randn(num_modes) 
-        else: #if fewer faults than requested modes then use all modes
-            z = randn(len(fault))
-        KL_slip = mean_slip.copy()  # start with the mean slip
-        # add in the terms in the K-L expansion:
-        for k in range(len(z)):
-            if eigenvals[k]>0: #only use positive eigenvals
-                KL_slip += z[k] * sqrt(eigenvals[k]) * V[:,k]
-        # exponentiate for lognormal:
-        if lognormal==True:
-            KL_slip = exp(KL_slip)
+        #One realization of the batch sampler, it draws the same random numbers
+        KL_slip,ok=make_KL_slip_batch(1,num_modes,eigenvals,V,mean_slip,max_slip,lognormal=lognormal)
+        KL_slip=KL_slip[0]
         #Check if max_slip condition is met, if so then you're done
-        if KL_slip.max()<=max_slip:
+        if ok[0]:
             success=True
             break
         iterations+=1
@@ -496,6 +528,71 @@ def make_KL_slip(fault,num_modes,eigenvals,V,mean_slip,max_slip,lognormal=True,m
     return KL_slip,success
 
 
+
+def make_KL_slip_batch(Nrealizations,num_modes,eigenvals,V,mean_slip,max_slip,lognormal=True,
+            moment_density=None,target_Mw=None,percent_reject=None):
+    '''
+    Draw many K-L slip realizations for the same subfault selection at once. 
+    All of them come out of one (Nrealizations x num_modes) x (num_modes x Nsubfaults)
+    matrix product, the lognormal transform, moment rescaling and the slip checks
+    are applied to the whole batch. Random numbers come from numpy's global 
+    random state in the same order as Nrealizations calls to make_KL_slip().
+    
+    The rupture generator does not call this with more than one realization,
+    every rupture there is seeded from its own run number and draws its own 
+    slip, use it directly to sample many slip maps on one selection.
+    
+    IN:
+        Nrealizations: Number of slip maps to draw
+        num_modes: Number of K-L modes, all of them if there are fewer subfaults
+        eigenvals,V: Sorted eigenpairs from get_KL_basis() or get_eigen()
+        mean_slip: Mean of the expansion (log of the mean slip if lognormal)
+        max_slip: Realizations with larger slip are flagged as failed
+        lognormal: Exponentiate the expansion
+        moment_density: Area times rigidity of each subfault, needed to rescale
+            to target_Mw
+        target_Mw: If not None every realization is scaled to this magnitude
+        percent_reject: For normal slip, realizations with more than this 
+            percentage of negative subfaults fail, the rest have their negative
+            slip set to zero (see rectify_slip()). None leaves slip as is
+        
+    OUT:
+        slip: (Nrealizations,Nsubfaults) slip realizations
+        success: Boolean array, False for realizations that failed a check
+    '''
+    
+    from numpy import sqrt,exp,where,ones
+    from numpy.random import randn
+    
+    Nmodes=min(num_modes,len(mean_slip))
+    Z=randn(Nrealizations,Nmodes)
+    
+    #only use positive eigenvals
+    scale=sqrt(where(eigenvals[:Nmodes]>0,eigenvals[:Nmodes],0))
+    slip=mean_slip+(Z*scale).dot(V[:,:Nmodes].T)
+    
+    # exponentiate for lognormal:
+    if lognormal==True:
+        slip=exp(slip)
+    
+    success=ones(Nrealizations,dtype=bool)
+    if percent_reject is not None:
+        percent_negative=100*(slip<0).mean(axis=1)
+        success=percent_negative<=percent_reject
+        slip[slip<0]=0
+    
+    #Force every realization to the target magnitude
+    if target_Mw is not None:
+        M0=slip.dot(moment_density)
+        M0_target=10**(1.5*target_Mw+9.1)
+        slip=slip*(M0_target/M0)[:,None]
+        
+    success=success & (slip.max(axis=1)<=max_slip)
+    
+    return slip,success
+
+
+
 def rectify_slip(slip_unrectified,percent_reject=10):
     '''
     Deal with negative slip values
@@ -519,15 +616,19 @@ def rectify_slip(slip_unrectified,percent_reject=10):
 
 def select_faults(whole_fault,Dstrike,Ddip,target_Mw,num_modes,scaling_law,
     force_area,no_shallow_epi=True,hypo_depth=10,param_norm=(0.0451,0.1681),no_random=False,
-    subfault_hypocenter=None,use_hypo_fraction=True,option=0):
+    subfault_hypocenter=None,use_hypo_fraction=True,option=0,neighbor_index=None):
     '''
     Select a random fault to be the hypocenter then based on scaling laws and a 
     target magnitude select only faults within the expected area plus some 
     buffer factor
+    
+    With the neighbor_index from build_neighbor_index() or load_neighbor_index()
+    the patch is found in time proportional to its size, the selection is the
+    same as without it
     '''
     
     from numpy.random import randint,normal
-    from numpy import array,where,argmin,arange,log10
+    from numpy import array,where,argmin,arange,log10,sort,ix_
     from scipy.stats import norm,expon
     from random import choice
     
@@ -632,10 +733,17 @@ def select_faults(whole_fault,Dstrike,Ddip,target_Mw,num_modes,scaling_law,
     # hypo_fault=int(hypo_fault)
     
     #Get max/min distances from hypocenter to all faults
-    dstrike_max=Dstrike[:,hypo_fault].max()
-    dstrike_min=Dstrike[:,hypo_fault].min()
-    ddip_max=Ddip[:,hypo_fault].max()
-    ddip_min=Ddip[:,hypo_fault].min()
+    if neighbor_index is None:
+        dstrike_max=Dstrike[:,hypo_fault].max()
+        dstrike_min=Dstrike[:,hypo_fault].min()
+        ddip_max=Ddip[:,hypo_fault].max()
+        ddip_min=Ddip[:,hypo_fault].min()
+    else: #first and last of the sorted neighbors
+        strike_order,dip_order=neighbor_index
+        dstrike_max=Dstrike[strike_order[hypo_fault,-1],hypo_fault]
+        dstrike_min=Dstrike[strike_order[hypo_fault,0],hypo_fault]
+        ddip_max=Ddip[dip_order[hypo_fault,-1],hypo_fault]
+        ddip_min=Ddip[dip_order[hypo_fault,0],hypo_fault]
     
     #Work on strike first
 #    strike_bounds=array([0,length/2])
@@ -660,11 +768,24 @@ def select_faults(whole_fault,Dstrike,Ddip,target_Mw,num_modes,scaling_law,
         dip_bounds[0]=dip_bounds[0]-abs(ddip_max-dip_bounds[1])
         dip_bounds[1]=ddip_max
     
-    Ds=Dstrike[:,hypo_fault]
-    Dd=Ddip[:,hypo_fault]
-    
     #Now select faults within those distances
-    selected_faults=where((Ds>=strike_bounds[0]) & (Ds<=strike_bounds[1]) & (Dd>=dip_bounds[0]) & (Dd<=dip_bounds[1]))[0]
+    if neighbor_index is None:
+        Ds=Dstrike[:,hypo_fault]
+        Dd=Ddip[:,hypo_fault]
+        selected_faults=where((Ds>=strike_bounds[0]) & (Ds<=strike_bounds[1]) & (Dd>=dip_bounds[0]) & (Dd<=dip_bounds[1]))[0]
+    else:
+        #Walk the narrower of the strike and dip bands and check the other distance
+        s0,s1=distance_band(Dstrike,strike_order,hypo_fault,strike_bounds[0],strike_bounds[1])
+        d0,d1=distance_band(Ddip,dip_order,hypo_fault,dip_bounds[0],dip_bounds[1])
+        if s1-s0<=d1-d0:
+            candidates=sort(strike_order[hypo_fault,s0:s1])
+            Dd=Ddip[candidates,hypo_fault]
+            selected_faults=candidates[(Dd>=dip_bounds[0]) & (Dd<=dip_bounds[1])]
+        else:
+            candidates=sort(dip_order[hypo_fault,d0:d1])
+            Ds=Dstrike[candidates,hypo_fault]
+            selected_faults=candidates[(Ds>=strike_bounds[0]) & (Ds<=strike_bounds[1])]
+        selected_faults=selected_faults.astype(int)
     
     ## This code block is for selecting any random subfault as the hypocenter as oppsoed to something
     ## based on lieklihood of strike fraction and dip fraction
@@ -704,8 +825,8 @@ def select_faults(whole_fault,Dstrike,Ddip,target_Mw,num_modes,scaling_law,
         #other faults
         
         
-        Dsmin=Dstrike[selected_faults,:] ; Dsmin=Dsmin[:,selected_faults]
-        Ddmin=Ddip[selected_faults,:] ; Ddmin=Ddmin[:,selected_faults]
+        Dsmin=Dstrike[ix_(selected_faults,selected_faults)]
+        Ddmin=Ddip[ix_(selected_faults,selected_faults)]
         
         min_dist=abs(Dsmin).max(axis=1) + abs(Ddmin).max(axis=1)
         imin=argmin(min_dist)
@@ -756,8 +877,8 @@ def select_faults(whole_fault,Dstrike,Ddip,target_Mw,num_modes,scaling_law,
                 
     #From the selected faults determine the actual along strike length (Leff) and down-dip width (Weff)
     #Check it doesn't exceed physically permissible thresholds
-    Lmax=Dstrike[selected_faults,:][:,selected_faults].max()    
-    Wmax=Ddip[selected_faults,:][:,selected_faults].max()
+    Lmax=Dstrike[ix_(selected_faults,selected_faults)].max()    
+    Wmax=Ddip[ix_(selected_faults,selected_faults)].max()
     
     #Convert to effective length/width
     Leff=0.85*Lmax
@@ -768,6 +889,140 @@ def select_faults(whole_fault,Dstrike,Ddip,target_Mw,num_modes,scaling_law,
 
     
         
+def build_neighbor_index(Dstrike,Ddip,chunk_size=256,out_prefix=None):
+    '''
+    Sort the along strike and along dip distances from every subfault to all
+    the others once per mesh. With this index select_faults() finds the 
+    subfaults of an L x W patch with binary searches and only touches the 
+    subfaults in the patch's strike or dip band instead of scanning whole 
+    columns of Dstrike and Ddip.
+    
+    IN:
+        Dstrike,Ddip: Inter-subfault distances from subfault_distances_3D()
+        chunk_size: Subfaults sorted per batch
+        out_prefix: If not None the index is written to 
+            out_prefix+'.strike_order.npy' and out_prefix+'.dip_order.npy',
+            each file is built under a temporary name and then moved into
+            place so readers never see a partial index
+        
+    OUT:
+        neighbor_index: (strike_order,dip_order), row j of strike_order lists
+            all subfaults by increasing Dstrike[:,j], same for dip_order
+    '''
+    
+    from numpy import zeros,argsort,int32,load
+    from numpy.lib.format import open_memmap
+    from os import replace,getpid
+    
+    nsubfaults=len(Dstrike)
+    if out_prefix is None:
+        strike_order=zeros((nsubfaults,nsubfaults),dtype=int32)
+        dip_order=zeros((nsubfaults,nsubfaults),dtype=int32)
+    else:
+        tmp_suffix='.'+str(getpid())+'.tmp'
+        strike_order=open_memmap(out_prefix+'.strike_order.npy'+tmp_suffix,mode='w+',dtype=int32,shape=(nsubfaults,nsubfaults))
+        dip_order=open_memmap(out_prefix+'.dip_order.npy'+tmp_suffix,mode='w+',dtype=int32,shape=(nsubfaults,nsubfaults))
+    
+    for j0 in range(0,nsubfaults,chunk_size):
+        j1=min(j0+chunk_size,nsubfaults)
+        strike_order[j0:j1,:]=argsort(Dstrike[:,j0:j1].T,axis=1,kind='stable')
+        dip_order[j0:j1,:]=argsort(Ddip[:,j0:j1].T,axis=1,kind='stable')
+    
+    if out_prefix is not None:
+        strike_order.flush()
+        dip_order.flush()
+        del strike_order,dip_order
+        replace(out_prefix+'.strike_order.npy'+tmp_suffix,out_prefix+'.strike_order.npy')
+        replace(out_prefix+'.dip_order.npy'+tmp_suffix,out_prefix+'.dip_order.npy')
+        strike_order=load(out_prefix+'.strike_order.npy',mmap_mode='r')
+        dip_order=load(out_prefix+'.dip_order.npy',mmap_mode='r')
+    
+    return strike_order,dip_order
+
+
+
+def load_neighbor_index(home,project_name,distances_name):
+    '''
+    Read the neighbor index stored next to a set of distances as memory maps.
+    Nothing is built here, see update_neighbor_index()
+    
+    OUT:
+        neighbor_index: (strike_order,dip_order) or None if the index is
+            missing or older than the distances
+    '''
+    
+    from numpy import load
+    from os import path
+    
+    prefix=home+project_name+'/data/distances/'+distances_name
+    distance_files=[prefix+'.strike.npy',prefix+'.dip.npy']
+    index_files=[prefix+'.strike_order.npy',prefix+'.dip_order.npy']
+    
+    for f in index_files:
+        if not path.exists(f):
+            return None
+        if any(path.exists(d) and path.getmtime(d)>path.getmtime(f) for d in distance_files):
+            return None
+    
+    return load(index_files[0],mmap_mode='r'),load(index_files[1],mmap_mode='r')
+
+
+
+def update_neighbor_index(home,project_name,distances_name):
+    '''
+    Build the neighbor index of a set of distances if it is missing or older 
+    than the distances. Call it once before starting the rupture workers, they
+    only read it with load_neighbor_index()
+    
+    OUT:
+        neighbor_index: (strike_order,dip_order)
+    '''
+    
+    from numpy import load
+    
+    neighbor_index=load_neighbor_index(home,project_name,distances_name)
+    if neighbor_index is None:
+        print('... building subfault neighbor index')
+        prefix=home+project_name+'/data/distances/'+distances_name
+        Dstrike=load(prefix+'.strike.npy',mmap_mode='r')
+        Ddip=load(prefix+'.dip.npy',mmap_mode='r')
+        neighbor_index=build_neighbor_index(Dstrike,Ddip,out_prefix=prefix)
+    
+    return neighbor_index
+
+
+
+def distance_band(D,order,j,lower,upper):
+    '''
+    Position in order[j] of the subfaults with lower<=D[:,j]<=upper, i.e. the
+    slice order[j][start:stop], found by bisection
+    '''
+    
+    N=len(order[j])
+    
+    #First position with D>=lower
+    start,stop=0,N
+    while start<stop:
+        mid=(start+stop)//2
+        if D[order[j,mid],j]<lower:
+            start=mid+1
+        else:
+            stop=mid
+    first=start
+    
+    #First position with D>upper
+    start,stop=first,N
+    while start<stop:
+        mid=(start+stop)//2
+        if D[order[j,mid],j]<=upper:
+            start=mid+1
+        else:
+            stop=mid
+    
+    return first,start
+
+
+
 def get_rise_times(M0,slip,fault_array,rise_time_depths,stoc_rake,rise_time='MH2017',rise_time_std=0.1,option=0):
     '''
     Calculate individual subfault rise times
@@ -865,17 +1120,26 @@ def get_rise_times(M0,slip,fault_array,rise_time_depths,stoc_rake,rise_time='MH2
     
     
 def get_rupture_onset(home,project_name,slip,fault_array,model_name,hypocenter,shypo,
-        rise_time_depths,M0,velmod,sigma_rise_time=0.2,shear_wave_fraction_shallow=0.49,shear_wave_fraction_deep=0.8):
+        rise_time_depths,M0,velmod,sigma_rise_time=0.2,shear_wave_fraction_shallow=0.49,shear_wave_fraction_deep=0.8,
+        Ptime_table=None,Ptime_tolerance=0.25):
     
     home,project_name,slip,fault_array,model_name,hypocenter,rise_time_depths,M0,velmod,shear_wave_fraction_shallow,shear_wave_fraction_deep
     '''
     Using a custom built tvel file ray trace from hypocenter to determine rupture
     onset times
+    
+    Straight ray path lengths through the layers are found for all subfaults at
+    once. If Ptime_table, the (depths,distances,Ptime) tuple from load_Ptime_table(), 
+    is supplied the hypocenter P-wave times are interpolated from it, otherwise 
+    each subfault is ray traced with velmod. Subfaults whose onset is within 
+    Ptime_tolerance seconds of the interpolated P time are still ray traced.
     '''
         
-    from numpy import genfromtxt,zeros,arctan2,sin,r_,where,log10,isnan,argmin,setxor1d,exp
+    from numpy import genfromtxt,zeros,ones,arctan2,sin,r_,c_,where,log10,isnan,argmin,setxor1d,exp,minimum,maximum,nan,abs
     from numpy .random import rand,randn,randint
-    from obspy.geodetics import gps2dist_azimuth, kilometer2degrees
+    from obspy.geodetics import kilometer2degrees
+    from scipy.interpolate import RegularGridInterpolator
+    from pyproj import Geod
     import warnings
     import numpy as np
     
@@ -938,54 +1202,38 @@ def get_rupture_onset(home,project_name,slip,fault_array,model_name,hypocenter,s
     R=rand(len(i_same_as_hypo))
     fault_array[i_same_as_hypo,3]=fault_array[i_same_as_hypo,3]+delta*R
     
-    #Loop over all faults
-    t_onset=zeros(len(slip))
-    length2fault=zeros(len(slip))
     #Perturb all subfault depths a tiny amount by some random number so that they NEVER lie on a layer interface
     z_perturb=(rand(len(fault_array))-0.5)*1e-6
     fault_array[:,3]=fault_array[:,3]+z_perturb
-    for kfault in range(len(slip)):
-        D,az,baz=gps2dist_azimuth(hypocenter[1],hypocenter[0],fault_array[kfault,2],fault_array[kfault,1])
-        D=D/1000
-        #Start and stop depths
-        if fault_array[kfault,3]<=hypocenter[2]:
-            zshallow=fault_array[kfault,3]
-            zdeep=hypocenter[2]
-        else:
-            zdeep=fault_array[kfault,3]
-            zshallow=hypocenter[2]
-        #Get angle between depths
-        theta=arctan2(zdeep-zshallow,D)
-        # get hypotenuse distance on all layers
-        delta_ray=vel[:,0]/sin(theta)
-        # Calculate distance in each layer
-        depth1=0
-        depth2=vel[0,0]
-        length_ray=zeros(len(vel))
-        for klayer in range(len(vel)):
-            if zshallow>depth1 and zdeep<depth2: #both points in same layer
-                length_ray[klayer]=abs(zshallow-zdeep)/sin(theta) 
-            elif zshallow>depth1 and zshallow<depth2: #This is the top
-                length_ray[klayer]=abs(depth2-zshallow)/sin(theta)
-            elif zdeep>depth1 and zdeep<depth2: #This is the bottom
-                length_ray[klayer]=abs(depth1-zdeep)/sin(theta)
-            elif depth1>zshallow and depth2<zdeep: #Use full layer thickness for ray path length
-                length_ray[klayer]=delta_ray[klayer]
-            else: #Some other layer, do nothing
-                pass
-            #Update reference depths
-            if klayer<len(vel)-1: #last layer:
-                depth1=depth2
-                depth2=depth2+vel[klayer+1,0]
-            else:
-                depth1=depth2
-                depth2=1e6
-        
-        
-        #Now multiply ray path length times rupture velocity
-        ray_times=length_ray/(vel[:,1]*rupture_multiplier)
-        t_onset[kfault]=ray_times.sum()  
-        length2fault[kfault]=(ray_times*vel[:,1]*rupture_multiplier).sum()
+    
+    #Epicentral distance to every subfault at once
+    g=Geod(ellps='WGS84')
+    hypo_lon=ones(len(fault_array))*hypocenter[0]
+    hypo_lat=ones(len(fault_array))*hypocenter[1]
+    az,baz,D=g.inv(hypo_lon,hypo_lat,fault_array[:,1],fault_array[:,2])
+    D=D/1000
+    
+    #Start and stop depths
+    zshallow=minimum(fault_array[:,3],hypocenter[2])
+    zdeep=maximum(fault_array[:,3],hypocenter[2])
+    
+    #Get angle between depths
+    theta=arctan2(zdeep-zshallow,D)
+    
+    #Layer tops and bottoms, the half space (last row, zero thickness) adds 
+    #nothing to the ray path
+    depth_to_bottom=depth_to_top+vel[:,0]
+    
+    #Vertical extent of the straight ray inside each layer (Nfaults x Nlayers) and 
+    #hypotenuse distance on all layers
+    dz_ray=minimum(zdeep[:,None],depth_to_bottom[None,:])-maximum(zshallow[:,None],depth_to_top[None,:])
+    dz_ray[dz_ray<0]=0
+    length_ray=dz_ray/sin(theta)[:,None]
+    
+    #Now multiply ray path length times rupture velocity
+    ray_times=length_ray/(vel[:,1]*rupture_multiplier)
+    t_onset=ray_times.sum(axis=1)
+    length2fault=(ray_times*vel[:,1]*rupture_multiplier).sum(axis=1)
         
     #Now perturb onset times according to Graves-Pitarka eq 5 and 6 (assumes 1:1 corelation with slip)
     delta_t0=((M0*1e7)**(1./3))*1.8e-9
@@ -1008,36 +1256,45 @@ def get_rupture_onset(home,project_name,slip,fault_array,model_name,hypocenter,s
     #print([M0,':',np.sum(np.sum(t_onset_final))])
 
     
-    #Check for subfaults that would create P-waves arriving *earlier* than those from hypocenter, and redo those stochastic perturbations until they're all > hypo P-wave time
-    for kfault in range(len(slip)):
-        D,az,baz=gps2dist_azimuth(hypocenter[1],hypocenter[0],fault_array[kfault,2],fault_array[kfault,1])
-        D=D/1000
-        D_deg=kilometer2degrees(D)
-        Ppaths=velmod.get_ray_paths(hypocenter[2],D_deg,phase_list=['P','p'])
-        
-        try:
-            Ptime=Ppaths[0].time
-        except:
-            print('Ptime ERROR')
-            print('   Target is:')
-            print('     '+str(fault_array[kfault,0:4]))
-            print('   Hypo is:')
-            print('     '+str(hypocenter))
-        attempt=1
-        while (t_onset_final[kfault] < Ptime) & (attempt < 500):
-            #if attempt == 1:
-                #print("Trying at subfault " + str(kfault)
-            #print(".....kfault " + str(kfault) + " is too early... recalculating!"
-            rand_numb=randn()
-            delta_t=delta_t0*exp(sigma_rise_time*rand_numb*(1./attempt))
-            perturbation=(log10(slip[kfault])-log10(slip_average))/(log10(slip.max())-log10(slip_average))
-            t_onset_final[kfault]=t_onset[kfault]-delta_t*perturbation
-            attempt+=1
-            if attempt == 500:
-                t_onset_final[kfault]=t_onset[kfault]
-                #print("...Failed at subfault " + str(kfault)
-            #GP 2015 extra perturbation to destroy the 1:1 correlation with slip
-            t_onset_final[kfault]=t_onset[kfault]
+    #Check for subfaults that would create P-waves arriving *earlier* than those from hypocenter
+    #and put back their unperturbed onsets
+    D_deg=kilometer2degrees(D)
+    if Ptime_table is None: #Live ray tracing
+        Ptime=zeros(len(slip))
+        for kfault in range(len(slip)):
+            Ppaths=velmod.get_ray_paths(hypocenter[2],D_deg[kfault],phase_list=['P','p'])
+            try:
+                Ptime[kfault]=Ppaths[0].time
+            except:
+                print('Ptime ERROR')
+                print('   Target is:')
+                print('     '+str(fault_array[kfault,0:4]))
+                print('   Hypo is:')
+                print('     '+str(hypocenter))
+                #Keep the previous subfault's P time, with none the onset is left as is
+                if kfault>0:
+                    Ptime[kfault]=Ptime[kfault-1]
+                else:
+                    Ptime[kfault]=nan
+    else: #Interpolate from the precomputed table
+        depths,distances,Ptimes=Ptime_table
+        interpolator=RegularGridInterpolator((depths,distances),Ptimes,bounds_error=False,fill_value=None)
+        Ptime=interpolator(c_[ones(len(D))*hypocenter[2],D])
+        #Ray trace the few subfaults too close to call from the interpolated times
+        i_close=where(abs(t_onset_final-Ptime)<Ptime_tolerance)[0]
+        for kfault in i_close:
+            Ppaths=velmod.get_ray_paths(hypocenter[2],D_deg[kfault],phase_list=['P','p'])
+            if len(Ppaths)>0:
+                Ptime[kfault]=Ppaths[0].time
+    i_early=where(t_onset_final<Ptime)[0] #nan P times are never early
+    
+    #The old redo loop always ended on the unperturbed onset, it drew one random 
+    #number per early subfault or 499 when even the unperturbed onset was early,
+    #keep drawing them so the random stream of later ruptures is unchanged
+    Ndraws=where(t_onset[i_early]<Ptime[i_early],499,1).sum()
+    if Ndraws>0:
+        randn(Ndraws)
+    t_onset_final[i_early]=t_onset[i_early]
 
     #Ensure hypocenter onset time is zero
     t_onset_final[i_hypo]=0
@@ -1152,11 +1409,19 @@ def build_TauPyModel(home,project_name,vel_mod_file,background_model='PREM'):
     and paste it on top of a pre computed mantle structure such as PREM.
     This assumes that the .mod file provided by the user ends with a 0 thickness 
     layer on the MANTLE side of the Moho
+    
+    Built models are kept in structure/taup_cache/ under a hash of the .mod file
+    and the background model, so an unchanged model is never rebuilt. The cached
+    model is copied to structure/<model>.npz, the file all the workers read.
     '''
     
     from numpy import genfromtxt
-    from os import environ,path
+    from os import environ,path,makedirs,replace,chmod
     from obspy.taup import taup_create, TauPyModel
+    from hashlib import sha1
+    from shutil import rmtree
+    from filecmp import cmp
+    from tempfile import mkdtemp
     
     #mudpy source folder
     
@@ -1168,12 +1433,29 @@ def build_TauPyModel(home,project_name,vel_mod_file,background_model='PREM'):
         
         bg_model_file=environ['MUD']+'/src/aux/prem.nd'
         
+        #Anything that changes the TauPy model changes its key
+        key=sha1()
+        key.update(open(vel_mod_file,'rb').read())
+        key.update(background_model.encode())
+        key.update(open(bg_model_file,'rb').read())
+        cache_path=home+project_name+'/structure/taup_cache/'
+        cache_file=cache_path+key.hexdigest()+'.npz'
+        nd_name=path.basename(vel_mod_file).split('.')[0]
+        model_file=home+project_name+'/structure/'+nd_name+'.npz'
+        
+        if path.exists(cache_file):
+            if path.exists(model_file) and cmp(cache_file,model_file,shallow=False):
+                print('... TauPy model '+path.basename(model_file)+' is up to date')
+            else:
+                print('... TauPy model '+path.basename(model_file)+' restored from cache')
+                install_TauPyModel(cache_file,model_file)
+            return
+        
         #Q values
         Qkappa=1300
         Qmu=600
         
         #Write new _nd file one line at a time
-        nd_name=path.basename(vel_mod_file).split('.')[0]
         nd_name=nd_name+'.nd'
         f=open(home+project_name+'/structure/'+nd_name,'w')
         
@@ -1228,14 +1510,151 @@ def build_TauPyModel(home,project_name,vel_mod_file,background_model='PREM'):
         fprem.close()
         f.close()
 
-        # make TauPy npz
+        # make TauPy npz, built aside and moved into the cache in one step so
+        # a half written model is never picked up
         taup_in=home+project_name+'/structure/'+nd_name
-        taup_out=home+project_name+'/structure/'
+        makedirs(cache_path,exist_ok=True)
+        taup_out=mkdtemp(dir=cache_path)
         taup_create.build_taup_model(taup_in,output_folder=taup_out)
+        replace(taup_out+'/'+nd_name.split('.')[0]+'.npz',cache_file)
+        rmtree(taup_out)
+        chmod(cache_file,0o444)
+        install_TauPyModel(cache_file,model_file)
         
     else: #To be done later (ha)
         print('ERROR: That background velocity model does not exist')
         
+        
+        
+def install_TauPyModel(cache_file,model_file):
+    '''
+    Atomically replace model_file with a copy of the cached TauPy model, workers
+    that already opened the old one are not affected
+    '''
+    
+    from shutil import copyfile
+    from os import replace,getpid
+    
+    tmp_file=model_file+'.'+str(getpid())+'.tmp'
+    copyfile(cache_file,tmp_file)
+    replace(tmp_file,model_file)
+    
+    
+    
+#TauPy models already loaded by this process
+_TauPyModels={}
+        
+        
+        
+def load_TauPyModel(model_file):
+    '''
+    Load a TauPy model once per process, later calls get the same read-only
+    object back unless the file has been rebuilt in the meantime
+    
+    IN:
+        model_file: Path to the TauPy .npz, with or without extension
+        
+    OUT:
+        velmod: TauPyModel
+    '''
+    
+    from os import path
+    from obspy.taup import TauPyModel
+    
+    if not model_file.endswith('.npz'):
+        model_file=model_file+'.npz'
+    mtime=path.getmtime(model_file)
+    if model_file in _TauPyModels and _TauPyModels[model_file][0]==mtime:
+        return _TauPyModels[model_file][1]
+    velmod=TauPyModel(model=model_file)
+    _TauPyModels[model_file]=(mtime,velmod)
+    
+    return velmod
+        
+    
+    
+    
+    
+def build_Ptime_table(home,project_name,fault_name,model_name,dz=1.0,dx=5.0):
+    '''
+    Tabulate first P-wave arrival times on a regular (hypocentral depth x epicentral
+    distance) grid spanning every hypocenter and subfault in the fault model. The
+    table is written to structure/<model>.<fault>.ptimes.npz and get_rupture_onset
+    interpolates it instead of ray tracing every subfault of every rupture. An 
+    existing table built for the same velocity model and grid is reused.
+    
+    IN:
+        home: Home directory
+        project_name: Name of the problem
+        fault_name: Name of .fault file
+        model_name: Name of .mod file, the TauPy .npz must already exist
+        dz: Depth spacing of the table in km
+        dx: Distance spacing of the table in km, it is five times finer within 
+            5*dx of the hypocenter
+        
+    OUT:
+        Nothing
+    '''
+    
+    from numpy import genfromtxt,arange,ceil,zeros,nan,savez,load,isnan,array_equal,r_
+    from os import path
+    from obspy.geodetics import kilometer2degrees
+    from pyproj import Geod
+    
+    table_file=home+project_name+'/structure/'+model_name.split('.')[0]+'.'+fault_name.split('.')[0]+'.ptimes.npz'
+    structure=genfromtxt(home+project_name+'/structure/'+model_name)
+    fault=genfromtxt(home+project_name+'/data/model_info/'+fault_name)
+    
+    #Depth grid covers all possible hypocenters, distance grid the fault's diagonal
+    zmin=max(fault[:,3].min()-dz,0)
+    zmax=fault[:,3].max()+dz
+    depths=zmin+dz*arange(int(ceil((zmax-zmin)/dz))+1)
+    g=Geod(ellps='WGS84')
+    az,baz,Dmax=g.inv(fault[:,1].min(),fault[:,2].min(),fault[:,1].max(),fault[:,2].max())
+    Dmax=Dmax/1000+dx
+    #Travel time curves bend the most close to the hypocenter, sample it finely there
+    distances=r_[(dx/5)*arange(25),dx*arange(5,int(ceil(Dmax/dx))+1)]
+    
+    #Already done?
+    if path.exists(table_file):
+        table=load(table_file)
+        if array_equal(table['structure'],structure) and array_equal(table['depths'],depths) and array_equal(table['distances'],distances):
+            print('... P-wave travel time table '+path.basename(table_file)+' is up to date')
+            return
+    
+    velmod=load_TauPyModel(home+project_name+'/structure/'+model_name.split('.')[0])
+    print('... building P-wave travel time table ('+str(len(depths))+' depths x '+str(len(distances))+' distances)')
+    Ptime=zeros((len(depths),len(distances)))
+    for kdepth in range(len(depths)):
+        for kdist in range(len(distances)):
+            arrivals=velmod.get_travel_times(depths[kdepth],kilometer2degrees(distances[kdist]),phase_list=['P','p'])
+            if len(arrivals)>0:
+                Ptime[kdepth,kdist]=arrivals[0].time
+            else:
+                Ptime[kdepth,kdist]=nan
+    if isnan(Ptime).any():
+        print('... ... WARNING: no P arrival at '+str(isnan(Ptime).sum())+' table nodes, those subfaults will not be checked')
+    savez(table_file,depths=depths,distances=distances,Ptime=Ptime,structure=structure)
+    
+    
+    
+def load_Ptime_table(home,project_name,fault_name,model_name):
+    '''
+    Read the P-wave travel time table made by build_Ptime_table()
+    
+    OUT:
+        (depths,distances,Ptime) or None if there is no table
+    '''
+    
+    from numpy import load
+    from os import path
+    
+    table_file=home+project_name+'/structure/'+model_name.split('.')[0]+'.'+fault_name.split('.')[0]+'.ptimes.npz'
+    if not path.exists(table_file):
+        return None
+    table=load(table_file)
+    
+    return table['depths'],table['distances'],table['Ptime']
     
     
     
@@ -1272,60 +1691,636 @@ def write_rupt_list(home,project_name,run_name,target_Mw,Nrealizations,ncpus):
         
     
 
+def write_rupt_file(outfile,fault_out):
+    '''
+    Write one rupture in the 15 column .rupt text format
+    '''
+    
+    from numpy import savetxt
+    
+    #                             'No,   lon,    lat,  z(km),strike,   dip, rise,  dura,  ss(m),ds(m),ss_len(m),ds_len(m),rupt_time(s),rigidity(Pa)
+    savetxt(outfile,fault_out,fmt='%d\t%10.6f\t%10.6f\t%8.4f\t%7.2f\t%7.2f\t%4.1f\t%.9e\t%.4e\t%.4e\t%10.2f\t%10.2f\t%.9e\t%.6e\t%.6e',header='No,lon,lat,z(km),strike,dip,rise,dura,ss-slip(m),ds-slip(m),ss_len(m),ds_len(m),rupt_time(s),rigidity(Pa),velocity(km/s)')
+
+
+
+def write_rupt_log(logfile,run_info,meta):
+    '''
+    Write the .log file of one rupture
+    
+    IN:
+        logfile: Output file name
+        run_info: Dictionary with the settings common to the whole run, see 
+            init_rupture_catalog()
+        meta: One record of the catalog metadata (or a dictionary with the same 
+            fields)
+    '''
+    
+    f=open(logfile,'w')
+    f.write('Scenario calculated at '+str(meta['created'])+' GMT\n')
+    f.write('Project name: '+str(run_info['project_name'])+'\n')
+    f.write('Run name: '+str(run_info['run_name'])+'\n')
+    f.write('Run number: '+str(int(meta['run_number'])).rjust(6,'0')+'\n')
+    f.write('Velocity model: '+str(run_info['model_name'])+'\n')
+    f.write('No. of KL modes: '+str(run_info['num_modes'])+'\n')
+    f.write('Hurst exponent: '+str(run_info['hurst'])+'\n')
+    f.write('Corr. length used Lstrike: %.2f km\n' % meta['Ls'])
+    f.write('Corr. length used Ldip: %.2f km\n' % meta['Ld'])
+    f.write('Slip std. dev.: %.3f km\n' % run_info['slip_standard_deviation'])
+    f.write('Maximum length Lmax: %.2f km\n' % meta['Lmax'])
+    f.write('Maximum width Wmax: %.2f km\n' % meta['Wmax'])
+    f.write('Effective length Leff: %.2f km\n' % meta['Leff'])
+    f.write('Effective width Weff: %.2f km\n' % meta['Weff'])
+    f.write('Target magnitude: Mw %.4f\n' % meta['target_Mw'])
+    f.write('Actual magnitude: Mw %.4f\n' % meta['actual_Mw'])
+    f.write('Hypocenter (lon,lat,z[km]): (%.6f,%.6f,%.2f)\n' %(meta['hypo_lon'],meta['hypo_lat'],meta['hypo_z']))
+    f.write('Hypocenter time: %s\n' % meta['time_epi'])
+    f.write('Centroid (lon,lat,z[km]): (%.6f,%.6f,%.2f)\n' %(meta['centroid_lon'],meta['centroid_lat'],meta['centroid_z']))
+    f.write('Source time function type: %s\n' % run_info['source_time_function'])
+    f.write('Average Risetime (s): %.9e\n' % meta['avg_rise'])
+    f.write('Average Rupture Velocity (km/s): %.9e\n' % meta['avg_vrupt'])
+    f.write('Avg. length: %.2f km\n' % meta['Lmean'])
+    f.write('Avg. width: %.2f km\n' % meta['Wmean'])
+    f.write('Class: %d type' % meta['rupture_class'])
+    f.close()
+    
+    
+
+#Per rupture metadata kept in the catalog, the ragged per-subfault arrays of 
+#rupture k start at 'offset' and have 'Nsubfaults' entries
+rupture_catalog_dtype=[('run_number','i8'),('created','U19'),('target_Mw','f8'),
+    ('actual_Mw','f8'),('Ls','f8'),('Ld','f8'),('Lmax','f8'),('Wmax','f8'),('Leff','f8'),
+    ('Weff','f8'),('Lmean','f8'),('Wmean','f8'),('hypo_lon','f8'),('hypo_lat','f8'),
+    ('hypo_z','f8'),('time_epi','U32'),('centroid_lon','f8'),('centroid_lat','f8'),
+    ('centroid_z','f8'),('avg_rise','f8'),('avg_vrupt','f8'),('rupture_class','i8'),
+    ('offset','i8'),('Nsubfaults','i8')]
+
+#Catalogs already indexed by this process
+_rupture_catalogs={}
+
+
+
+def clear_rupture_catalog(home,project_name,run_name):
+    '''
+    Delete the shards of an earlier rupture catalog with this run name so their
+    run numbers can't mix with those of a new run
+    '''
+    
+    from glob import glob
+    from os import remove
+    
+    catalog_path=home+project_name+'/output/ruptures/'+run_name+'.catalog/'
+    for shard in glob(catalog_path+'shard.*.npz'):
+        remove(shard)
+    _rupture_catalogs.pop(catalog_path,None)
+        
+        
+
+def remove_rupture_catalog(home,project_name,run_name):
+    '''
+    Delete the whole rupture catalog of a run name. Text (.rupt/.log) runs call 
+    this so readers that look for a catalog first can't pick up the ruptures of 
+    an earlier catalog run with the same name
+    '''
+    
+    from shutil import rmtree
+    from os import path
+    
+    catalog_path=home+project_name+'/output/ruptures/'+run_name+'.catalog/'
+    if path.exists(catalog_path):
+        print('... removing old rupture catalog '+catalog_path)
+        rmtree(catalog_path)
+    _rupture_catalogs.pop(catalog_path,None)
+
+
+
+def init_rupture_catalog(home,project_name,run_name,fault_template,run_info,remove_shards=True):
+    '''
+    Start the columnar rupture catalog of a run. This replaces the .rupt and .log
+    text files of every realization with a folder 
+    output/ruptures/<run_name>.catalog/ holding the fault geometry once 
+    (fault.npz) and npz shards that each hold a batch of ruptures. Shards are 
+    only ever added, so every MPI rank appends its own without locking. Shards
+    left by an earlier run of the same name are removed first, with MPI this 
+    must happen before the ranks start, see clear_rupture_catalog()
+    
+    IN:
+        home: Home directory
+        project_name: Name of the problem
+        run_name: Name of the rupture run
+        fault_template: 15 column .rupt array with the geometry and rigidity 
+            columns filled in, the rupture dependent columns are ignored
+        run_info: Dictionary with project_name, run_name, model_name, num_modes,
+            hurst, slip_standard_deviation and source_time_function
+        remove_shards: False if clear_rupture_catalog() was already called
+        
+    OUT:
+        Nothing
+    '''
+    
+    from numpy import savez,array
+    from os import makedirs
+    
+    catalog_path=home+project_name+'/output/ruptures/'+run_name+'.catalog/'
+    makedirs(catalog_path,exist_ok=True)
+    if remove_shards==True:
+        clear_rupture_catalog(home,project_name,run_name)
+    fault=fault_template.copy()
+    fault[:,[7,8,9,12,14]]=0
+    info={}
+    for key in run_info:
+        info['info_'+key]=array(run_info[key])
+    savez(catalog_path+'fault.npz',fault=fault,**info)
+
+
+
+def make_catalog_record(run_number,fault_out,ifaults,slip,rake,option,Ls,Ld,Lmax,Wmax,Leff,Weff,
+            Lmean,Wmean,target_Mw,Mw,hypocenter,time_epi,centroid,avg_rise,avg_vrupt):
+    '''
+    Pack one realization for write_rupture_catalog_shard()
+    
+    OUT:
+        record: (meta,arrays) with meta a dictionary of rupture_catalog_dtype 
+            fields and arrays the per-subfault values on the selected subfaults
+    '''
+    
+    from time import gmtime,strftime
+    
+    meta={'run_number':int(run_number),'created':strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+        'target_Mw':target_Mw,'actual_Mw':Mw,'Ls':Ls,'Ld':Ld,'Lmax':Lmax,'Wmax':Wmax,
+        'Leff':Leff,'Weff':Weff,'Lmean':Lmean,'Wmean':Wmean,'hypo_lon':hypocenter[0],
+        'hypo_lat':hypocenter[1],'hypo_z':hypocenter[2],'time_epi':str(time_epi),
+        'centroid_lon':centroid[0],'centroid_lat':centroid[1],'centroid_z':centroid[2],
+        'avg_rise':avg_rise,'avg_vrupt':avg_vrupt,'rupture_class':option}
+    arrays={'subfaults':ifaults,'slip':slip,'rake':rake,'rise_time':fault_out[ifaults,7],
+        'onset':fault_out[ifaults,12],'velocity':fault_out[ifaults,14]}
+    
+    return meta,arrays
+
+
+
+def write_rupture_catalog_shard(home,project_name,run_name,records):
+    '''
+    Append a batch of ruptures to the catalog as one new shard named after its
+    first run number
+    
+    IN:
+        records: List of (meta,arrays) from make_catalog_record()
+    '''
+    
+    from numpy import savez,zeros,concatenate,r_,cumsum
+    from os import makedirs
+    
+    if len(records)==0:
+        return
+    #Other ranks can get here before rank 0 has made the folder
+    catalog_path=home+project_name+'/output/ruptures/'+run_name+'.catalog/'
+    makedirs(catalog_path,exist_ok=True)
+    meta=zeros(len(records),dtype=rupture_catalog_dtype)
+    for k in range(len(records)):
+        for key in records[k][0]:
+            meta[key][k]=records[k][0][key]
+    Nsubfaults=[len(record[1]['subfaults']) for record in records]
+    meta['Nsubfaults']=Nsubfaults
+    meta['offset']=r_[0,cumsum(Nsubfaults)[:-1]]
+    arrays={}
+    for key in records[0][1]:
+        arrays[key]=concatenate([record[1][key] for record in records])
+    shard=catalog_path+'shard.'+str(meta['run_number'][0]).rjust(6,'0')+'.npz'
+    savez(shard,meta=meta,**arrays)
+    
+    
+    
+def read_rupture_catalog(home,project_name,run_name):
+    '''
+    Index a rupture catalog, only the metadata of each shard is read. The index
+    is kept for the life of the process and refreshed when shards are added.
+    
+    IN:
+        home: Home directory
+        project_name: Name of the problem
+        run_name: Name of the rupture run
+        
+    OUT:
+        catalog: Dictionary with the 'fault' geometry, 'run_info', the 'meta' 
+            records of all ruptures sorted by run number and the 'shard' each 
+            one is in. None if the run has no catalog
+    '''
+    
+    return read_rupture_catalog_folder(home+project_name+'/output/ruptures/'+run_name+'.catalog/')
+
+
+
+def read_rupture_catalog_folder(catalog_path):
+    '''
+    Same as read_rupture_catalog() for a catalog folder given by its path, e.g.
+    a rupture folder plus <run_name>.catalog/
+    '''
+    
+    from numpy import load,concatenate,argsort,array,full,unique
+    from glob import glob
+    from os import path
+    
+    catalog_path=path.join(catalog_path,'')
+    if not path.exists(catalog_path+'fault.npz'):
+        return None
+    shards=sorted(glob(catalog_path+'shard.*.npz'))
+    #A rerun rewrites fault.npz, so its time tells shards of the same name apart
+    shards_key=[path.getmtime(catalog_path+'fault.npz')]+shards
+    if catalog_path in _rupture_catalogs and _rupture_catalogs[catalog_path]['shards_key']==shards_key:
+        return _rupture_catalogs[catalog_path]
+    
+    f=load(catalog_path+'fault.npz')
+    run_info={}
+    for key in f.files:
+        if key.startswith('info_'):
+            run_info[key[5:]]=f[key][()]
+    meta=[]
+    shard_index=[]
+    for kshard in range(len(shards)):
+        m=load(shards[kshard])['meta']
+        meta.append(m)
+        shard_index.append(full(len(m),kshard))
+    if len(meta)>0:
+        meta=concatenate(meta)
+        shard_index=concatenate(shard_index)
+    else:
+        meta=array([],dtype=rupture_catalog_dtype)
+        shard_index=array([],dtype='int')
+    if len(unique(meta['run_number']))<len(meta):
+        raise ValueError('Duplicate run numbers in '+catalog_path+', it holds shards from more than one run')
+    isort=argsort(meta['run_number'],kind='stable')
+    catalog={'path':catalog_path,'fault':f['fault'],'run_info':run_info,'shards':shards,
+        'shards_key':shards_key,'meta':meta[isort],'shard':shard_index[isort],'loaded':(None,None)}
+    _rupture_catalogs[catalog_path]=catalog
+    
+    return catalog
+
+
+
+def find_catalog_rupture(home,project_name,rupture_name):
+    '''
+    Look a rupture up in its run's catalog by name
+    
+    IN:
+        rupture_name: As in ruptures.list, e.g. run.000012.rupt
+        
+    OUT:
+        catalog: From read_rupture_catalog(), None if the run has no catalog
+        meta: Metadata record of the rupture, None if it's not in the catalog
+    '''
+    
+    from numpy import searchsorted
+    
+    name=rupture_name.replace('.rupt','').rsplit('.',1)
+    if len(name)<2 or not name[1].isdigit():
+        return None,None
+    catalog=read_rupture_catalog(home,project_name,name[0])
+    if catalog is None:
+        return None,None
+    k=searchsorted(catalog['meta']['run_number'],int(name[1]))
+    if k==len(catalog['meta']) or catalog['meta']['run_number'][k]!=int(name[1]):
+        return catalog,None
+    
+    return catalog,catalog['meta'][k]
+
+
+
+def get_catalog_rupture(catalog,run_number):
+    '''
+    Random access to one rupture of a catalog
+    
+    IN:
+        catalog: From read_rupture_catalog()
+        run_number: Integer or zero padded string run number
+        
+    OUT:
+        fault_out: The rupture as the 15 column .rupt array
+        mask: Boolean mask of the subfaults selected for the rupture
+        meta: Its metadata record
+    '''
+    
+    from numpy import searchsorted,zeros,cos,sin,deg2rad,load
+    
+    run_number=int(run_number)
+    k=searchsorted(catalog['meta']['run_number'],run_number)
+    if k==len(catalog['meta']) or catalog['meta']['run_number'][k]!=run_number:
+        raise KeyError('Rupture '+str(run_number).rjust(6,'0')+' is not in '+catalog['path'])
+    meta=catalog['meta'][k]
+    
+    #Consecutive requests usually hit the same shard, keep the last one in memory
+    kshard=catalog['shard'][k]
+    if catalog['loaded'][0]!=kshard:
+        shard=load(catalog['shards'][kshard])
+        catalog['loaded']=(kshard,dict((key,shard[key]) for key in shard.files if key!='meta'))
+    arrays=catalog['loaded'][1]
+    i=slice(meta['offset'],meta['offset']+meta['Nsubfaults'])
+    ifaults=arrays['subfaults'][i]
+    
+    fault_out=catalog['fault'].copy()
+    fault_out[ifaults,7]=arrays['rise_time'][i]
+    fault_out[ifaults,8]=arrays['slip'][i]*cos(deg2rad(arrays['rake'][i]))
+    fault_out[ifaults,9]=arrays['slip'][i]*sin(deg2rad(arrays['rake'][i]))
+    fault_out[ifaults,12]=arrays['onset'][i]
+    fault_out[ifaults,14]=arrays['velocity'][i]
+    mask=zeros(len(fault_out),dtype=bool)
+    mask[ifaults]=True
+    
+    return fault_out,mask,meta
+    
+    
+    
+def export_rupture_catalog(home,project_name,run_name,run_numbers=None):
+    '''
+    Write ruptures of a catalog out as legacy .rupt and .log files in
+    output/ruptures/
+    
+    IN:
+        run_numbers: Which ruptures to export, all of them if None
+    '''
+    
+    catalog=read_rupture_catalog(home,project_name,run_name)
+    if catalog is None:
+        print('ERROR: No rupture catalog for run '+run_name)
+        return
+    if run_numbers is None:
+        run_numbers=catalog['meta']['run_number']
+    for run_number in run_numbers:
+        fault_out,mask,meta=get_catalog_rupture(catalog,run_number)
+        outfile=home+project_name+'/output/ruptures/'+run_name+'.'+str(int(run_number)).rjust(6,'0')
+        write_rupt_file(outfile+'.rupt',fault_out)
+        write_rupt_log(outfile+'.log',catalog['run_info'],meta)
+        
+        
+
+def load_rupture(home,project_name,rupture_name):
+    '''
+    Read a fakequakes rupture from the run's catalog or, if it has none, from
+    its .rupt file in output/ruptures/
+    
+    IN:
+        rupture_name: As in ruptures.list, e.g. run.000012.rupt
+    
+    OUT:
+        fault_out: 15 column .rupt array
+    '''
+    
+    from numpy import genfromtxt
+    
+    catalog,meta=find_catalog_rupture(home,project_name,rupture_name)
+    if meta is not None:
+        fault_out,mask,meta=get_catalog_rupture(catalog,meta['run_number'])
+    else:
+        fault_out=genfromtxt(home+project_name+'/output/ruptures/'+rupture_name)
+    
+    return fault_out
+    
+    
+    
+
+@dataclass
+class RuptureConfig:
+    '''
+    All the settings of a rupture generation run. The fields are the arguments
+    of generate_ruptures(), plus:
+        rupture_catalog: Write a rupture catalog instead of .rupt/.log files
+        seed: Base random seed, rupture k is made from (seed,k) so a run is 
+            reproducible whatever the number of workers. None draws a new seed
+        precision: dtype of the distance matrices when load_distances!=1, 
+            'float32' halves their size on disk and in memory
+    '''
+    
+    home: str
+    project_name: str
+    run_name: str
+    fault_name: str
+    slab_name: Optional[str]
+    mesh_name: Optional[str]
+    load_distances: int
+    distances_name: str
+    UTM_zone: str
+    target_Mw: Any
+    model_name: str
+    hurst: float
+    Ldip: Union[str,float]
+    Lstrike: Union[str,float]
+    num_modes: int
+    Nrealizations: int
+    rake: float
+    rise_time: str
+    rise_time_depths: Any
+    time_epi: Any
+    max_slip: float
+    source_time_function: str
+    lognormal: bool
+    slip_standard_deviation: float
+    scaling_law: str
+    ncpus: int=1
+    force_magnitude: bool=False
+    force_area: bool=False
+    mean_slip_name: Optional[str]=None
+    hypocenter: Any=None
+    slip_tol: float=1e-2
+    force_hypocenter: bool=False
+    no_random: bool=False
+    use_hypo_fraction: bool=True
+    shear_wave_fraction_shallow: float=0.49
+    shear_wave_fraction_deep: float=0.8
+    max_slip_rule: bool=True
+    rupture_catalog: bool=False
+    seed: Optional[int]=None
+    precision: str='float64'
+    
+    
+
 def generate_ruptures(home,project_name,run_name,fault_name,slab_name,mesh_name,
 		load_distances,distances_name,UTM_zone,target_Mw,model_name,hurst,Ldip,
 		Lstrike,num_modes,Nrealizations,rake,rise_time,rise_time_depths,time_epi,
 		max_slip,source_time_function,lognormal,slip_standard_deviation,scaling_law,ncpus,
 		force_magnitude=False,force_area=False,mean_slip_name=None,hypocenter=None,
 		slip_tol=1e-2,force_hypocenter=False,no_random=False,use_hypo_fraction=True,
-		shear_wave_fraction_shallow=0.49,shear_wave_fraction_deep=0.8,max_slip_rule=True):
+		shear_wave_fraction_shallow=0.49,shear_wave_fraction_deep=0.8,max_slip_rule=True,
+		rupture_catalog=False,backend='mpi',seed=None,precision='float64'):
     '''
-    Set up rupture generation-- use ncpus if available
+    Set up rupture generation-- use ncpus if available. With rupture_catalog=True
+    the ruptures go to output/ruptures/<run_name>.catalog/ instead of one .rupt
+    and .log file each, use export_rupture_catalog() to get the text files back.
+    
+    backend='mpi' runs ncpus ranks under mpiexec, backend='pool' a local process 
+    pool, see run_ruptures(). precision is the dtype the distance matrices are
+    written with when load_distances!=1
     '''
     
     # shear_wave_fraction_shallow=1/60/60/24*3
     # shear_wave_fraction_deep=1/60/60/24*3
     
+    config=RuptureConfig(home,project_name,run_name,fault_name,slab_name,mesh_name,
+        load_distances,distances_name,UTM_zone,target_Mw,model_name,hurst,Ldip,
+        Lstrike,num_modes,Nrealizations,rake,rise_time,rise_time_depths,time_epi,
+        max_slip,source_time_function,lognormal,slip_standard_deviation,scaling_law,ncpus,
+        force_magnitude=force_magnitude,force_area=force_area,mean_slip_name=mean_slip_name,
+        hypocenter=hypocenter,slip_tol=slip_tol,force_hypocenter=force_hypocenter,
+        no_random=no_random,use_hypo_fraction=use_hypo_fraction,
+        shear_wave_fraction_shallow=shear_wave_fraction_shallow,
+        shear_wave_fraction_deep=shear_wave_fraction_deep,max_slip_rule=max_slip_rule,
+        rupture_catalog=rupture_catalog,seed=seed,precision=precision)
+    run_ruptures(config,backend=backend)
+    
+    
+    
+def run_ruptures(config,backend='pool',catalog_shard_size=100):
+    '''
+    Generate and write all the ruptures of a run
+    
+    IN:
+        config: RuptureConfig
+        backend: 'pool' makes the ruptures with iter_ruptures() in this process
+            and numbers them 0 to len(target_Mw)*Nrealizations-1. 'mpi' starts
+            generate_ruptures_parallel.py under mpiexec with the same numbering,
+            rank r makes ruptures r, r+ncpus, r+2*ncpus...
+        catalog_shard_size: Ruptures per catalog shard for the 'pool' backend
+        
+    OUT:
+        Nothing
+    '''
+    
+    from dataclasses import replace
+    from numpy.random import SeedSequence
+    from mudpy import generate_ruptures_parallel
+    
+    if config.seed is None:
+        config=replace(config,seed=SeedSequence().entropy)
+    print('... rupture seed is '+str(config.seed))
+    
     #Things that need to be done before deciding whether to ship the work off to the 
     #parallel or serial functions
     
     #Need to make tauPy file
-    vel_mod_file=home+project_name+'/structure/'+model_name
+    vel_mod_file=config.home+config.project_name+'/structure/'+config.model_name
     #Get TauPyModel
-    build_TauPyModel(home,project_name,vel_mod_file,background_model='PREM')
+    build_TauPyModel(config.home,config.project_name,vel_mod_file,background_model='PREM')
+    
+    #Tabulate hypocenter P-wave times used by the rupture onset check
+    build_Ptime_table(config.home,config.project_name,config.fault_name,config.model_name)
+    
+    #Distances, if needed, and their neighbor index are made here once, the 
+    #workers only read them
+    if config.load_distances!=1:
+        subfault_distances_3D(config.home,config.project_name,config.fault_name,config.slab_name,config.UTM_zone,
+            precision=config.precision,out_prefix=config.home+config.project_name+'/data/distances/'+config.distances_name)
+        config=replace(config,load_distances=1)
+    update_neighbor_index(config.home,config.project_name,config.distances_name)
+    
+    #Text output replaces any catalog written earlier under this run name
+    if config.rupture_catalog!=True:
+        remove_rupture_catalog(config.home,config.project_name,config.run_name)
+    
+    if backend=='mpi':
+        #Write ruptures.list file
+        write_rupt_list(config.home,config.project_name,config.run_name,config.target_Mw,config.Nrealizations,1)
+        
+        #Old shards go before any rank can write new ones
+        if config.rupture_catalog==True:
+            clear_rupture_catalog(config.home,config.project_name,config.run_name)
+        
+        #Generate rupture models
+        run_generate_ruptures_parallel(config.home,config.project_name,config.run_name,config.fault_name,
+            config.slab_name,config.mesh_name,config.load_distances,config.distances_name,config.UTM_zone,
+            config.target_Mw,config.model_name,config.hurst,config.Ldip,config.Lstrike,config.num_modes,
+            config.Nrealizations,config.rake,config.rise_time,config.rise_time_depths,config.time_epi,
+            config.max_slip,config.source_time_function,config.lognormal,config.slip_standard_deviation,
+            config.scaling_law,config.ncpus,config.force_magnitude,config.force_area,config.mean_slip_name,
+            config.hypocenter,config.slip_tol,config.force_hypocenter,config.no_random,config.use_hypo_fraction,
+            config.shear_wave_fraction_shallow,config.shear_wave_fraction_deep,config.max_slip_rule,
+            rupture_catalog=config.rupture_catalog,seed=config.seed)
+    
+    elif backend=='pool':
+        write_rupt_list(config.home,config.project_name,config.run_name,config.target_Mw,config.Nrealizations,1)
+        
+        context=generate_ruptures_parallel.setup_ruptures(config)
+        if config.rupture_catalog==True:
+            init_rupture_catalog(config.home,config.project_name,config.run_name,context['fault_template'],context['run_info'])
+            catalog_records=[]
+        
+        print('Generating rupture scenarios')
+        for run_number,fault_out,record in iter_ruptures(config):
+            if config.rupture_catalog==True:
+                catalog_records.append(record)
+                if len(catalog_records)==catalog_shard_size:
+                    write_rupture_catalog_shard(config.home,config.project_name,config.run_name,catalog_records)
+                    catalog_records=[]
+            else:
+                generate_ruptures_parallel.write_rupture(context,fault_out,record)
+            print('Run number: '+run_number)
+        if config.rupture_catalog==True:
+            write_rupture_catalog_shard(config.home,config.project_name,config.run_name,catalog_records)
+    
+    else:
+        print('ERROR: Unknown rupture generation backend '+str(backend))
+        
+        
 
-    #Write ruptures.list file
-    write_rupt_list(home,project_name,run_name,target_Mw,Nrealizations,ncpus)
+def iter_ruptures(config,run_numbers=None):
+    '''
+    Make ruptures in a local pool of config.ncpus worker processes. Rupture k 
+    has target magnitude target_Mw[k//Nrealizations] and its random draws come
+    from (config.seed,k), so it's the same for any number of workers. The
+    TauPy model and P-wave table must exist, see run_ruptures().
+    
+    IN:
+        config: RuptureConfig
+        run_numbers: Only make these ruptures, all of them if None
+        
+    OUT:
+        Yields (run_number,fault_out,record) in run number order, fault_out is
+        the 15 column .rupt array and record the metadata and per subfault 
+        arrays from make_catalog_record()
+    '''
+    
+    from dataclasses import replace
+    from multiprocessing import Pool
+    from numpy.random import SeedSequence
+    from mudpy import generate_ruptures_parallel
+    
+    if config.seed is None:
+        config=replace(config,seed=SeedSequence().entropy)
+        print('... rupture seed is '+str(config.seed))
+    
+    #Don't have every worker compute the distances or the neighbor index
+    if config.load_distances!=1:
+        subfault_distances_3D(config.home,config.project_name,config.fault_name,config.slab_name,config.UTM_zone,
+            precision=config.precision,out_prefix=config.home+config.project_name+'/data/distances/'+config.distances_name)
+        config=replace(config,load_distances=1)
+    update_neighbor_index(config.home,config.project_name,config.distances_name)
+    
+    if run_numbers is None:
+        run_numbers=range(len(config.target_Mw)*config.Nrealizations)
+    tasks=[(int(k)//config.Nrealizations,str(int(k)).rjust(6,'0')) for k in run_numbers]
+    
+    if config.ncpus==1:
+        context=generate_ruptures_parallel.setup_ruptures(config)
+        for kmag,run_number in tasks:
+            fault_out,record=generate_ruptures_parallel.make_rupture(context,kmag,run_number)
+            yield run_number,fault_out,record
+    else:
+        with Pool(config.ncpus,initializer=generate_ruptures_parallel.init_rupture_worker,initargs=(config,)) as pool:
+            for result in pool.imap(generate_ruptures_parallel.rupture_worker,tasks):
+                yield result
+    
     
     
-    #Generate rupture models
-    run_generate_ruptures_parallel(home,project_name,run_name,fault_name,slab_name,mesh_name,
-    load_distances,distances_name,UTM_zone,target_Mw,model_name,hurst,Ldip,
-    Lstrike,num_modes,Nrealizations,rake,rise_time,rise_time_depths,time_epi,
-    max_slip,source_time_function,lognormal,slip_standard_deviation,scaling_law,ncpus,
-    force_magnitude,force_area,mean_slip_name,hypocenter,slip_tol,force_hypocenter,
-    no_random,use_hypo_fraction,shear_wave_fraction_shallow,shear_wave_fraction_deep,max_slip_rule)
-
-
-
-
-                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                          
 def run_generate_ruptures_parallel(home,project_name,run_name,fault_name,slab_name,mesh_name,
         load_distances,distances_name,UTM_zone,target_Mw,model_name,hurst,Ldip,
         Lstrike,num_modes,Nrealizations,rake,rise_time,rise_time_depths,time_epi,
         max_slip,source_time_function,lognormal,slip_standard_deviation,scaling_law,ncpus,
         force_magnitude,force_area,mean_slip_name,hypocenter,slip_tol,force_hypocenter,
-        no_random,use_hypo_fraction,shear_wave_fraction_shallow,shear_wave_fraction_deep,max_slip_rule):
+        no_random,use_hypo_fraction,shear_wave_fraction_shallow,shear_wave_fraction_deep,max_slip_rule,
+        rupture_catalog=False,seed=None):
     
-    from numpy import ceil
     from os import environ
     import subprocess
     from shlex import split
     
-    #calculate number of realizations per CPU:
-    Nrealizations_parallel=int(ceil(float(Nrealizations)/float(ncpus)))
-    if (Nrealizations_parallel*ncpus > Nrealizations):
-        print("Extra CPUS-- have " + str(Nrealizations_parallel*ncpus-Nrealizations) + " free ruptures!!")
+    #The ranks share the len(target_Mw)*Nrealizations ruptures between them
     rise_time_depths0=rise_time_depths[0]
     rise_time_depths1=rise_time_depths[1]
     tMw=target_Mw[0]
@@ -1333,10 +2328,10 @@ def run_generate_ruptures_parallel(home,project_name,run_name,fault_name,slab_na
         #tMw.append(target_Mw[r])
         tMw=str(tMw)+','+str(target_Mw[r+1])
     #Make mpi system call
-    print("MPI: Starting " + str(Nrealizations_parallel*ncpus) + " FakeQuakes Rupture Generations on ", ncpus, "CPUs")
+    print("MPI: Starting " + str(Nrealizations*len(target_Mw)) + " FakeQuakes Rupture Generations on ", ncpus, "CPUs")
     mud_source=environ['MUD']+'/src/python/mudpy/'
 
-    mpi='mpiexec -n '+str(ncpus)+' python '+mud_source+'generate_ruptures_parallel.py run_parallel_generate_ruptures '+home+' '+project_name+' '+run_name+' '+fault_name+' '+str(slab_name)+' '+str(mesh_name)+' '+str(load_distances)+' '+distances_name+' '+UTM_zone+' '+str(tMw)+' '+model_name+' '+str(hurst)+' '+Ldip+' '+Lstrike+' '+str(num_modes)+' '+str(Nrealizations_parallel)+' '+str(rake)+' '+str(rise_time)+' '+str(rise_time_depths0)+' '+str(rise_time_depths1)+' '+str(time_epi)+' '+str(max_slip)+' '+source_time_function+' '+str(lognormal)+' '+str(slip_standard_deviation)+' '+scaling_law+' '+str(ncpus)+' '+str(force_magnitude)+' '+str(force_area)+' '+str(mean_slip_name)+' "'+str(hypocenter)+'" '+str(slip_tol)+' '+str(force_hypocenter)+' '+str(no_random)+' '+str(use_hypo_fraction)+' '+str(shear_wave_fraction_shallow)+' '+str(shear_wave_fraction_deep)+' '+str(max_slip_rule)
+    mpi='mpiexec -n '+str(ncpus)+' python '+mud_source+'generate_ruptures_parallel.py run_parallel_generate_ruptures '+home+' '+project_name+' '+run_name+' '+fault_name+' '+str(slab_name)+' '+str(mesh_name)+' '+str(load_distances)+' '+distances_name+' '+UTM_zone+' '+str(tMw)+' '+model_name+' '+str(hurst)+' '+Ldip+' '+Lstrike+' '+str(num_modes)+' '+str(Nrealizations)+' '+str(rake)+' '+str(rise_time)+' '+str(rise_time_depths0)+' '+str(rise_time_depths1)+' '+str(time_epi)+' '+str(max_slip)+' '+source_time_function+' '+str(lognormal)+' '+str(slip_standard_deviation)+' '+scaling_law+' '+str(ncpus)+' '+str(force_magnitude)+' '+str(force_area)+' '+str(mean_slip_name)+' "'+str(hypocenter)+'" '+str(slip_tol)+' '+str(force_hypocenter)+' '+str(no_random)+' '+str(use_hypo_fraction)+' '+str(shear_wave_fraction_shallow)+' '+str(shear_wave_fraction_deep)+' '+str(max_slip_rule)+' '+str(rupture_catalog)+' '+str(seed)
     mpi=split(mpi)
     p=subprocess.Popen(mpi)
     p.communicate()
@@ -1355,19 +2350,19 @@ def run_generate_ruptures(home,project_name,run_name,fault_name,slab_name,mesh_n
     Depending on user selected flags parse the work out to different functions
     '''
     
-    from numpy import load,save,genfromtxt,log10,cos,sin,deg2rad,savetxt,zeros,where
+    from numpy import load,genfromtxt,log10,cos,sin,deg2rad,savetxt,zeros,where
     from time import gmtime, strftime
-    from obspy.taup import TauPyModel
 
+    #Text output replaces any catalog written earlier under this run name
+    remove_rupture_catalog(home,project_name,run_name)
 
     #Should I calculate or load the distances?
     if load_distances==1:  
         Dstrike=load(home+project_name+'/data/distances/'+distances_name+'.strike.npy')
         Ddip=load(home+project_name+'/data/distances/'+distances_name+'.dip.npy')
     else:
-        Dstrike,Ddip=subfault_distances_3D(home,project_name,fault_name,slab_name,UTM_zone)
-        save(home+project_name+'/data/distances/'+distances_name+'.strike.npy',Dstrike)
-        save(home+project_name+'/data/distances/'+distances_name+'.dip.npy',Ddip)
+        Dstrike,Ddip=subfault_distances_3D(home,project_name,fault_name,slab_name,UTM_zone,
+            out_prefix=home+project_name+'/data/distances/'+distances_name)
     
 
     #Read fault and prepare output variable
@@ -1377,7 +2372,7 @@ def run_generate_ruptures(home,project_name,run_name,fault_name,slab_name,mesh_n
     vel_mod_file=home+project_name+'/structure/'+model_name
     
     #Get TauPyModel
-    velmod = TauPyModel(model=home+project_name+'/structure/'+model_name.split('.')[0])
+    velmod = load_TauPyModel(home+project_name+'/structure/'+model_name.split('.')[0])
 
 
     #Now loop over the number of realizations
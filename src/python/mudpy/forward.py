@@ -258,7 +258,8 @@ def waveforms_matrix(home,project_name,fault_name,rupture_name,station_file,GF_l
 def waveforms_fakequakes(home,project_name,fault_name,rupture_list,GF_list,
                 model_name,run_name,dt,NFFT,G_from_file,G_name,source_time_function='dreger',zeta=0.2,
                 stf_falloff_rate=4.0,rupture_name=None,epicenter=None,time_epi=None,hot_start=0,
-                ncpus=1):
+                ncpus=1,GF_store=False,fft_convolution=False,direct_synthesis=False,station_chunk=10,
+                rupture_workers=1,skip_finished=False):
     '''
     To supplant waveforms_matrix() it needs to include resmapling and all that jazz...
     
@@ -278,14 +279,27 @@ def waveforms_fakequakes(home,project_name,fault_name,rupture_list,GF_list,
         station_file: File with coordinates of stations
         model_Name: Name of Earth structure model file
         integrate: =0 if you want output to be velocity, =1 if you want output to de displacement
+        GF_store: True to use the binary GF store (see make_fakequakes_GF_store) instead
+            of the miniSEED files, it's built from the SAC files if G_from_file=False
+        fft_convolution: True to transform the impulse GFs once and do the slip rate
+            convolutions of every rupture in the frequency domain, see 
+            get_fakequakes_G_and_m_fft
+        direct_synthesis: True to add up the waveforms station_chunk stations at a time
+            without building each rupture's G matrix, see synthesize_fakequakes_waveforms
+        rupture_workers: Number of processes that each take whole ruptures. The impulse
+            GFs (or their spectra) are shared through a .npy memory map in GFs/matrices/
+            and ncpus is then used inside each rupture only when rupture_workers=1
+        skip_finished: True to skip ruptures that already have a _summary file, to 
+            resume a run that stopped part way through
        
     OUT:
         Nothing
     '''
-    from numpy import genfromtxt,array
-    from obspy import UTCDateTime
+    from numpy import genfromtxt,array,memmap,save
+    from os import path,remove
+    from multiprocessing import Pool
+    from functools import partial
     import datetime
-    import time
     from dask.distributed import Client
     
     print('Solving for kinematic problem(s)')
@@ -304,77 +318,187 @@ def waveforms_fakequakes(home,project_name,fault_name,rupture_list,GF_list,
     
     
     
-    #Load all synthetics
-    print('... loading all synthetics into memory')
-    Nss,Ess,Zss,Nds,Eds,Zds=load_fakequakes_synthetics(home,project_name,fault_name,model_name,GF_list,
-                                                       G_from_file,G_name)
-    print('... ... ... done')
-    
-
-    # Need to know how many sites and delta t
-    station_file=home+project_name+'/data/station_info/'+GF_list
-    staname=genfromtxt(station_file,dtype="U",usecols=0)
-    Nsta=len(staname)
-    dt = Nss[0].stats.delta
-    
     # Need epicetrnal time from log file to trim synthetics
     print('... reading epicentral time from log file. REMEMBER: All ruptures in ruptures.list should have a common epicentral time')
-    log_file = home + project_name + '/output/ruptures/' + all_sources[0].replace('.rupt','.log')
-    flog = open(log_file,'r')
-    while True:
-        line = flog.readline()
-        if 'Hypocenter time' in line:                
-            hypocenter_time = line.replace('Hypocenter time: ','')
-            hypocenter_time = UTCDateTime(hypocenter_time)
-            break
-        elif line == '':
-            break 
-    flog.close()
+    _,hypocenter_time = read_fakequakes_hypo_time(home,project_name,all_sources[0])
     
-    #Now get the impulse response G for all sites and all subfaults
-    print('... broadcast to G matrix')
-    Gimpulse_all = stream2matrix(Nss,Ess,Zss,Nds,Eds,Zds,hypocenter_time,Nsta)
-    print('... ... done')
+    if GF_store==True:
+        
+        if G_from_file==False:
+            print('... writing all synthetics to the binary GF store')
+            make_fakequakes_GF_store(home,project_name,fault_name,model_name,GF_list,G_name)
+            print('... ... ... done')
+        
+        #Memory map straight into the G matrix layout
+        print('... loading impulse G matrix from the binary GF store')
+        Gimpulse_all,dt = load_fakequakes_GF_store(home,project_name,G_name,hypocenter_time)
+        print('... ... done')
     
-    #clean up
-    print('... clean up: removing obspy streams from memory')
-    del Nss,Ess,Zss,Nds,Eds,Zds
-    print('... ... done')
+    else:
+        
+        #Load all synthetics
+        print('... loading all synthetics into memory')
+        Nss,Ess,Zss,Nds,Eds,Zds=load_fakequakes_synthetics(home,project_name,fault_name,model_name,GF_list,
+                                                           G_from_file,G_name)
+        print('... ... ... done')
+        
+        # Need to know how many sites and delta t
+        station_file=home+project_name+'/data/station_info/'+GF_list
+        staname=genfromtxt(station_file,dtype="U",usecols=0)
+        Nsta=len(staname)
+        dt = Nss[0].stats.delta
+        
+        #Now get the impulse response G for all sites and all subfaults
+        print('... broadcast to G matrix')
+        Gimpulse_all = stream2matrix(Nss,Ess,Zss,Nds,Eds,Zds,hypocenter_time,Nsta)
+        print('... ... done')
+        
+        #clean up
+        print('... clean up: removing obspy streams from memory')
+        del Nss,Ess,Zss,Nds,Eds,Zds
+        print('... ... done')
     
     # print('... opening DASK client')
     # client = Client(n_workers=ncpus)
     
+    #Transform impulse responses only once
+    if fft_convolution==True:
+        print('... Fourier transforming impulse G matrix')
+        Nsta=int(Gimpulse_all.shape[0]/(3*NFFT))
+        GF_spectra,Nfft_pad = impulse_GF_spectra(Gimpulse_all,Nsta,NFFT,ncpus=ncpus)
+        del Gimpulse_all
+        print('... ... done')
+    
+    #What's the GF matrix every rupture is made from?
+    if fft_convolution==True:
+        GF=GF_spectra
+    else:
+        GF=Gimpulse_all
+        Nfft_pad=None
     
-    #Now loop over rupture models
+    #Which ruptures still need doing?
+    ruptures_to_do=[]
     for ksource in range(hot_start,len(all_sources)):
+        rupture = all_sources[ksource].rsplit('.', 1)[0]
+        summary_file = home+project_name+'/output/waveforms/'+rupture+'/_summary.'+rupture+'.txt'
+        if skip_finished==True and path.exists(summary_file):
+            print('... skipping finished source '+str(ksource)+': '+all_sources[ksource])
+        else:
+            ruptures_to_do.append(ksource)
+    forward = rupture_list == None #This controls where we look for the rupture file
+    
+    if rupture_workers>1:
+        
+        #Workers memory map the GFs instead of each getting a copy
+        if isinstance(GF,memmap):
+            GF_file=GF.filename
+            remove_GF_file=False
+        else:
+            GF_file=home+project_name+'/GFs/matrices/'+G_name+'.workers.npy'
+            print('... writing GFs to shared memory map '+GF_file)
+            save(GF_file,GF)
+            remove_GF_file=True
+        
+        print('... solving '+str(len(ruptures_to_do))+' sources on '+str(rupture_workers)+' workers')
+        rupture_function=partial(fakequakes_rupture_waveforms,home=home,project_name=project_name,
+                                 GF_list=GF_list,GF=GF_file,NFFT=NFFT,dt=dt,
+                                 source_time_function=source_time_function,stf_falloff_rate=stf_falloff_rate,
+                                 zeta=zeta,forward=forward,epicenter=epicenter,time_epi=time_epi,
+                                 Nfft_pad=Nfft_pad,direct_synthesis=direct_synthesis,
+                                 station_chunk=station_chunk,ncpus=1)
+        pool=Pool(rupture_workers)
+        #The pool and the GF copy are cleaned up even if a rupture fails
+        try:
+            #imap hands results back in rupture order
+            for kdone,rupture_name in enumerate(pool.imap(rupture_function,all_sources[ruptures_to_do])):
+                print('... finished source '+str(ruptures_to_do[kdone])+' of '+str(len(all_sources))+': '+rupture_name)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+            pool.join()
+            if remove_GF_file==True:
+                remove(GF_file)
+        return
+    
+    #Now loop over rupture models
+    for ksource in ruptures_to_do:
        
         rupture_name = all_sources[ksource]
         print('... solving for source '+str(ksource)+' of '+str(len(all_sources))+': '+rupture_name)
+        fakequakes_rupture_waveforms(rupture_name,home,project_name,GF_list,GF,NFFT,dt,source_time_function,
+                                     stf_falloff_rate,zeta=zeta,forward=forward,epicenter=epicenter,
+                                     time_epi=time_epi,Nfft_pad=Nfft_pad,direct_synthesis=direct_synthesis,
+                                     station_chunk=station_chunk,ncpus=ncpus)
+        print('... ... finished with this rupture')
         
-        if rupture_list != None:
-            #Get epicentral time
-            epicenter,time_epi = read_fakequakes_hypo_time(home,project_name,rupture_name)
-            forward = False
-        else:
-            forward = True #This controls where we look for the rupture file
+    # print('... clean up: closing distributed client')
+    # client.close()
+
+
+
+def fakequakes_rupture_waveforms(rupture_name,home,project_name,GF_list,GF,NFFT,dt,source_time_function,
+                stf_falloff_rate,zeta=0.2,forward=False,epicenter=None,time_epi=None,Nfft_pad=None,
+                direct_synthesis=False,station_chunk=10,ncpus=1):
+    '''
+    Make and write the waveforms of a single rupture for waveforms_fakequakes
+    
+    IN:
+        GF: Impulse response G matrix, or its spectra if Nfft_pad is given. Can 
+            also be the name of a .npy file with either, it's then memory mapped
+        forward: False to read the rupture from output/ruptures/ and its 
+            epicenter and time from the .log, True for forward_models/ with the
+            epicenter and time_epi given here
         
+    OUT:
+        rupture_name
+    '''
+    
+    from numpy import load
+    import time
+    
+    if isinstance(GF,str):
+        GF=load(GF,mmap_mode='r')
+        if GF.ndim==5: #Layout of the binary GF store
+            GF=GF.reshape(GF.shape[0]*GF.shape[1]*GF.shape[2],GF.shape[3]*GF.shape[4])
+    
+    if forward==False:
+        #Get epicentral time
+        epicenter,time_epi = read_fakequakes_hypo_time(home,project_name,rupture_name)
+    
+    t1=time.time()
+    if direct_synthesis==True: #Straight to waveforms
+        if Nfft_pad is not None:
+            waveforms = synthesize_fakequakes_waveforms(None,home,project_name,rupture_name,NFFT,
+                                   source_time_function,stf_falloff_rate,dt=dt,zeta=zeta,forward=forward,
+                                   GF_spectra=GF,Nfft_pad=Nfft_pad,station_chunk=station_chunk,ncpus=ncpus)
+        else:
+            waveforms = synthesize_fakequakes_waveforms(GF,home,project_name,rupture_name,NFFT,
+                                   source_time_function,stf_falloff_rate,dt=dt,zeta=zeta,forward=forward,
+                                   station_chunk=station_chunk,ncpus=ncpus)
+        t2=time.time()
+        print('... ... direct synthesis completed: wall time {:.1f}s'.format(t2-t1))
+    else:
         # Put in matrix
-        t1=time.time()
         # m,G=get_fakequakes_G_and_m(Nss,Ess,Zss,Nds,Eds,Zds,home,project_name,rupture_name,time_epi,GF_list,epicenter,NFFT,source_time_function,stf_falloff_rate,zeta,forward=forward)
-        m,G = get_fakequakes_G_and_m(Gimpulse_all,home,project_name,rupture_name,time_epi,GF_list,
-                                   epicenter,NFFT,source_time_function,stf_falloff_rate,zeta=zeta,
-                                   forward=forward,dt=dt,ncpus=ncpus,reconvolution=False)
+        if Nfft_pad is not None:
+            m,G = get_fakequakes_G_and_m_fft(GF,Nfft_pad,home,project_name,rupture_name,NFFT,
+                                       source_time_function,stf_falloff_rate,dt=dt,zeta=zeta,
+                                       forward=forward,ncpus=ncpus)
+        else:
+            m,G = get_fakequakes_G_and_m(GF,home,project_name,rupture_name,time_epi,GF_list,
+                                       epicenter,NFFT,source_time_function,stf_falloff_rate,zeta=zeta,
+                                       forward=forward,dt=dt,ncpus=ncpus,reconvolution=False)
         t2=time.time()
         print('... ... slip rate convolutions completed: wall time {:.1f}s'.format(t2-t1))
         # Solve
         print('... ... solve for waveforms (ncpus = %d)' % ncpus)
         waveforms = G.dot(m)
-        #Write output
-        write_fakequakes_waveforms(home,project_name,rupture_name,waveforms,GF_list,NFFT,time_epi,dt)
-        print('... ... finished with this rupture')
-        
-    # print('... clean up: closing distributed client')
-    # client.close()
+    
+    #Write output
+    write_fakequakes_waveforms(home,project_name,rupture_name,waveforms,GF_list,NFFT,time_epi,dt)
+    
+    return rupture_name
         
    
     
@@ -477,7 +601,6 @@ def tele_waveforms(home,project_name,fault_name,rupture_list,GF_list_teleseismic
     from numpy import genfromtxt,array
     import datetime
     import gc
-    from obspy import UTCDateTime
     
     print('Solving for kinematic problem(s)')
     #Time for log file
@@ -505,17 +628,7 @@ def tele_waveforms(home,project_name,fault_name,rupture_list,GF_list_teleseismic
     
     # Need epicetrnal time from log file to trim synthetics
     print('... reading epicentral time from log file. REMEMBER: All ruptures in ruptures.list should have a common epicentral time')
-    log_file = home + project_name + '/output/ruptures/' + all_sources[0].replace('.rupt','.log')
-    flog = open(log_file,'r')
-    while True:
-        line = flog.readline()
-        if 'Hypocenter time' in line:                
-            hypocenter_time = line.replace('Hypocenter time: ','')
-            hypocenter_time = UTCDateTime(hypocenter_time)
-            break
-        elif line == '':
-            break 
-    flog.close()
+    _,hypocenter_time = read_fakequakes_hypo_time(home,project_name,all_sources[0])
     
     #Now get the impulse response G for all sites and all subfaults
     print('... broadcast to G matrix')
@@ -728,14 +841,29 @@ def hf_waveforms(home,project_name,fault_name,rupture_list,GF_list,model_name,ru
             G_name,rise_time_depths,moho_depth_in_km,ncpus,source_time_function='dreger',duration=100.0,
             stf_falloff_rate=4.0,hf_dt=0.02,Pwave=False,Swave=True,hot_start=0,stress_parameter=50,
             high_stress_depth=1e4,kappa=None,Qexp=0.6,Qmethod='shallowest',scattering='off',Qc_exp=0,
-            baseline_Qc=100):
+            baseline_Qc=100,single_mpi_job=False,ray_cache=False):
 
     '''
     Make semistochastic high frequency accelerograms
+    
+    With single_mpi_job=True everything runs in one mpiexec call with a pool of
+    ncpus-1 workers, see make_hfsims_queue
+    
+    With ray_cache=True the P and S ray geometry of every (subfault depth,distance)
+    pair is stored in structure/ray_cache/ and traced only once for all 
+    components and all ruptures on the same fault, editing the .mod file or
+    rebuilding the TauPy model starts a new cache
     '''
     from numpy import genfromtxt,ones
     from mudpy import hfsims
     
+    if single_mpi_job==True:
+        make_hfsims_queue(home,project_name,rupture_list,GF_list,ncpus,model_name,rise_time_depths[0],
+                    rise_time_depths[1],moho_depth_in_km,total_duration=duration,hf_dt=hf_dt,Pwave=Pwave,
+                    Swave=Swave,stress_parameter=stress_parameter,kappa=kappa,Qexp=Qexp,
+                    high_stress_depth=high_stress_depth,Qmethod=Qmethod,scattering=scattering,
+                    Qc_exp=Qc_exp,baseline_Qc=baseline_Qc,hot_start=hot_start,ray_cache=ray_cache)
+        return
     
     all_sources=genfromtxt(home+project_name+'/data/'+rupture_list,dtype='U')
     #Now loop over rupture models
@@ -774,7 +902,7 @@ def hf_waveforms(home,project_name,fault_name,rupture_list,GF_list,model_name,ru
                 make_parallel_hfsims(home,project_name,rupture_name,ncpus,sta[ksta],sta_lon[ksta],sta_lat[ksta],
                     comp[kcomp],model_name,rise_time_depths[0],rise_time_depths[1],moho_depth_in_km,total_duration=duration,hf_dt=hf_dt,
                     Pwave=Pwave,Swave=Swave,stress_parameter=stress_parameter,high_stress_depth=high_stress_depth,Qexp=Qexp,
-                    Qmethod=Qmethod,scattering=scattering,Qc_exp=Qc_exp,baseline_Qc=baseline_Qc)
+                    Qmethod=Qmethod,scattering=scattering,Qc_exp=Qc_exp,baseline_Qc=baseline_Qc,ray_cache=ray_cache)
 
                 #Combine the separate MPI outputs into one full waveform
                 write_parallel_hfsims(home,project_name,rupture_name,sta[ksta],comp[kcomp],remove=True)
@@ -784,7 +912,7 @@ def hf_waveforms(home,project_name,fault_name,rupture_list,GF_list,model_name,ru
 def make_parallel_hfsims(home,project_name,rupture_name,ncpus,sta,sta_lon,sta_lat,component,model_name,rise_time_depths0,
                          rise_time_depths1,moho_depth_in_km,total_duration,hf_dt,Pwave,Swave,stress_parameter,
                          kappa=0.04,Qexp=0.6,high_stress_depth=30,Qmethod='shallowest',scattering='off',Qc_exp=0,
-                         baseline_Qc=100):
+                         baseline_Qc=100,ray_cache=False):
 
 
     '''
@@ -814,7 +942,32 @@ def make_parallel_hfsims(home,project_name,rupture_name,ncpus,sta,sta_lon,sta_la
     #Make mpi system call
     print("MPI: Starting Stochastic High Frequency Simulation on ", ncpus, "CPUs")
     mud_source=environ['MUD']+'/src/python/mudpy/'
-    mpi='mpiexec -n '+str(ncpus)+' python '+mud_source+'hfsims_parallel.py run_parallel_hfsims '+home+' '+project_name+' '+rupture_name+' '+str(N)+' '+str(M0)+' '+sta+' '+str(sta_lon)+' '+str(sta_lat)+' '+model_name+' '+str(rise_time_depths0)+' '+str(rise_time_depths1)+' '+str(moho_depth_in_km)+' '+component+' '+str(total_duration)+' '+str(hf_dt)+' '+str(stress_parameter)+' '+str(kappa)+' '+str(Qexp)+' '+str(Pwave)+' '+str(Swave)+' '+str(high_stress_depth)+' '+str(Qmethod)+' '+str(scattering)+' '+str(Qc_exp)+' '+str(baseline_Qc)
+    mpi='mpiexec -n '+str(ncpus)+' python '+mud_source+'hfsims_parallel.py run_parallel_hfsims '+home+' '+project_name+' '+rupture_name+' '+str(N)+' '+str(M0)+' '+sta+' '+str(sta_lon)+' '+str(sta_lat)+' '+model_name+' '+str(rise_time_depths0)+' '+str(rise_time_depths1)+' '+str(moho_depth_in_km)+' '+component+' '+str(total_duration)+' '+str(hf_dt)+' '+str(stress_parameter)+' '+str(kappa)+' '+str(Qexp)+' '+str(Pwave)+' '+str(Swave)+' '+str(high_stress_depth)+' '+str(Qmethod)+' '+str(scattering)+' '+str(Qc_exp)+' '+str(baseline_Qc)+' '+str(ray_cache)
+    mpi=split(mpi)
+    p=subprocess.Popen(mpi)
+    p.communicate()
+    
+    
+
+
+def make_hfsims_queue(home,project_name,rupture_list,GF_list,ncpus,model_name,rise_time_depths0,
+                         rise_time_depths1,moho_depth_in_km,total_duration,hf_dt,Pwave,Swave,stress_parameter,
+                         kappa=None,Qexp=0.6,high_stress_depth=30,Qmethod='shallowest',scattering='off',Qc_exp=0,
+                         baseline_Qc=100,hot_start=0,ray_cache=False):
+    '''
+    Start ONE MPI job for the HF stochastics of every rupture, station and 
+    component. Rank 0 hands out tasks and ncpus-1 workers compute them, each 
+    worker loads the velocity model once. Output goes straight to the same 
+    .HN?.mpi.sac files write_parallel_hfsims makes.
+    '''
+    from os import environ
+    import subprocess
+    from shlex import split
+    
+    #Make mpi system call
+    print("MPI: Starting Stochastic High Frequency Simulation queue on ", ncpus, "CPUs")
+    mud_source=environ['MUD']+'/src/python/mudpy/'
+    mpi='mpiexec -n '+str(ncpus)+' python '+mud_source+'hfsims_parallel.py run_hfsims_queue '+home+' '+project_name+' '+rupture_list+' '+GF_list+' '+model_name+' '+str(rise_time_depths0)+' '+str(rise_time_depths1)+' '+str(moho_depth_in_km)+' '+str(total_duration)+' '+str(hf_dt)+' '+str(stress_parameter)+' '+str(kappa)+' '+str(Qexp)+' '+str(Pwave)+' '+str(Swave)+' '+str(high_stress_depth)+' '+str(Qmethod)+' '+str(scattering)+' '+str(Qc_exp)+' '+str(baseline_Qc)+' '+str(hot_start)+' '+str(ray_cache)
     mpi=split(mpi)
     p=subprocess.Popen(mpi)
     p.communicate()
@@ -1121,6 +1274,131 @@ def load_fakequakes_synthetics(home,project_name,fault_name,model_name,GF_list,G
     return Nss,Ess,Zss,Nds,Eds,Zds
 
 
+def make_fakequakes_GF_store(home,project_name,fault_name,model_name,GF_list,G_name,from_mseed=False):
+    '''
+    Write the impulse response synthetics of all stations and subfaults to one
+    contiguous binary GF store that load_fakequakes_GF_store can memory map.
+
+    The data go to GFs/matrices/G_name.disp.gfs.npy as float32 with shape
+    (Nsta,3,Npts,Nfaults,2) i.e. station, component (N,E,Z), time, subfault and
+    rake (SS,DS). That is the same row and column order as the G matrix from
+    stream2matrix. Start times, sample interval, station names and subfault
+    numbers go to GFs/matrices/G_name.disp.gfs.npz
+
+    IN:
+        from_mseed: True to convert the G_name.???.disp.mseed files made by
+            load_fakequakes_synthetics instead of reading the SAC files
+
+    OUT:
+        Nothing
+    '''
+
+    from numpy import genfromtxt,loadtxt,zeros,savez
+    from numpy.lib.format import open_memmap
+    from obspy import read
+
+    vord='disp'
+    components=['n','e','z']
+    rakes=['SS','DS']
+    matrix_path=home+project_name+'/GFs/matrices/'+G_name+'.'+vord
+
+    #Load station info
+    station_file=home+project_name+'/data/station_info/'+GF_list
+    staname=genfromtxt(station_file,dtype="U",usecols=0,ndmin=1)
+    Nsta=len(staname)
+    #Load fault model
+    source=loadtxt(home+project_name+'/data/model_info/'+fault_name,ndmin=2)
+    Nfaults=source.shape[0] #Number of subfaults
+
+    if from_mseed==True:
+        print('... ... read from miniSEED into stream objects')
+        streams={}
+        for comp in components:
+            for rake in rakes:
+                streams[comp+rake]=read(matrix_path.replace('.'+vord,'.'+comp.upper()+rake.lower()+'.'+vord+'.mseed'))
+
+    def get_trace(ksta,kfault,kcomp,krake):
+        if from_mseed==True:
+            return streams[components[kcomp]+rakes[krake]][ksta*Nfaults+kfault]
+        nsub='sub'+str(int(source[kfault,0])).rjust(4,'0')
+        nfault='subfault'+str(int(source[kfault,0])).rjust(4,'0')
+        strdepth='%.4f' % source[kfault,3]
+        syn_path=home+project_name+'/GFs/dynamic/'+model_name+'_'+strdepth+'.'+nsub+'/'
+        return read(syn_path+staname[ksta]+'.'+nfault+'.'+rakes[krake]+'.'+vord+'.'+components[kcomp])[0]
+
+    #First synthetic sets the length and sampling for all of them
+    tr=get_trace(0,0,0,0)
+    Npts=tr.stats.npts
+    delta=tr.stats.delta
+    reference_time=tr.stats.starttime
+
+    store=open_memmap(matrix_path+'.gfs.npy',mode='w+',dtype='float32',shape=(Nsta,3,Npts,Nfaults,2))
+    starttime=zeros((Nsta,3,Nfaults,2))
+    for ksta in range(Nsta):
+        print('... ... storing green functions for station #'+str(ksta+1)+' of '+str(Nsta))
+        station_block=zeros((3,Npts,Nfaults,2),dtype='float32')
+        for kfault in range(Nfaults):
+            for kcomp in range(3):
+                for krake in range(2):
+                    tr=get_trace(ksta,kfault,kcomp,krake)
+                    station_block[kcomp,:,kfault,krake]=tr.data[0:Npts]
+                    starttime[ksta,kcomp,kfault,krake]=tr.stats.starttime-reference_time
+        store[ksta]=station_block
+    store.flush()
+    del store
+
+    savez(matrix_path+'.gfs.npz',reference_time=str(reference_time),starttime=starttime,delta=delta,
+          stations=staname,subfaults=source[:,0])
+
+
+def load_fakequakes_GF_store(home,project_name,G_name,hypocenter_time):
+    '''
+    Memory map the GF store from make_fakequakes_GF_store as the impulse response
+    G matrix of stream2matrix, (Nsta*3*Npts rows by Nfaults*2 columns), with
+    every synthetic trimmed and padded to start at hypocenter_time like
+    trim_to_hypo_time_and_pad does. If all synthetics already start at
+    hypocenter_time nothing is copied and the memory map itself is returned.
+
+    OUT:
+        G: Impulse response G matrix
+        dt: Sample interval of the synthetics
+    '''
+
+    from numpy import load,zeros,arange,clip,around,take_along_axis
+    from obspy import UTCDateTime
+
+    vord='disp'
+    matrix_path=home+project_name+'/GFs/matrices/'+G_name+'.'+vord
+    header=load(matrix_path+'.gfs.npz')
+    store=load(matrix_path+'.gfs.npy',mmap_mode='r')
+    Nsta,Ncomp,Npts,Nfaults,Nrake=store.shape
+    dt=float(header['delta'])
+
+    #How many samples each synthetic has to move to start at hypocenter time, positive is later
+    reference_offset=UTCDateTime(str(header['reference_time']))-hypocenter_time
+    shift=around((reference_offset+header['starttime'])/dt).astype('int')
+
+    if (shift==0).all():
+        return store.reshape(Nsta*Ncomp*Npts,Nfaults*Nrake),dt
+
+    G=zeros((Nsta*Ncomp*Npts,Nfaults*Nrake))
+    t=arange(Npts)
+    row_start=0
+    for ksta in range(Nsta):
+        for kcomp in range(Ncomp):
+            block_shift=shift[ksta,kcomp].ravel()
+            block=store[ksta,kcomp].reshape(Npts,Nfaults*Nrake)
+            #Zeros before a late start, last sample repeated after an early one
+            isample=t[:,None]-block_shift[None,:]
+            shifted=take_along_axis(block,clip(isample,0,Npts-1),axis=0)
+            shifted[isample<0]=0
+            shifted[:,abs(block_shift)>Npts]=0 #way too far into the future
+            G[row_start:row_start+Npts,:]=shifted
+            row_start+=Npts
+
+    return G,dt
+
+
 def list2stream(st_list):
     
     from obspy import Stream
@@ -1268,13 +1546,14 @@ def get_fakequakes_G_and_m(Gimpulse,home,project_name,rupture_name,time_epi,GF_l
     '''
     
     from numpy import genfromtxt,convolve,where,zeros,arange,unique,r_,sort,ones
-    from numpy import expand_dims,squeeze,roll,float64,array
+    from numpy import expand_dims,squeeze,roll,float64,asarray
     import dask.array as da
+    from mudpy.fakequakes import load_rupture
 
     if forward==True:
         source=genfromtxt(home+project_name+'/forward_models/'+rupture_name)
     else:
-        source=genfromtxt(home+project_name+'/output/ruptures/'+rupture_name)
+        source=load_rupture(home,project_name,rupture_name)
     rise_times=source[:,7]
     fraction=source[:,6]
     rupture_onset=source[:,12]
@@ -1402,7 +1681,11 @@ def get_fakequakes_G_and_m(Gimpulse,home,project_name,rupture_name,time_epi,GF_l
     
     G = da.map_blocks(block_convolution_and_shift, Gimpulse, slip_rates,
             rupture_onset,NFFT,old_stf,reconvolution,chunks=(NFFT*Nsta*3,2),
-            dtype=float64).persist(num_workers=ncpus)
+            dtype=float64)
+    if ncpus==1: #No thread pool, dask's pool also hangs in processes forked after it's been used
+        G = G.compute(scheduler='synchronous')
+    else:
+        G = G.persist(num_workers=ncpus)
 
     
     #Get slip model vector
@@ -1412,7 +1695,189 @@ def get_fakequakes_G_and_m(Gimpulse,home,project_name,rupture_name,time_epi,GF_l
     m[iss,0]=source[i_non_zero_original,8]
     m[ids,0]=source[i_non_zero_original,9]
 
-    return m,array(G)
+    return m,asarray(G)
+
+
+
+def impulse_GF_spectra(Gimpulse,Nsta,NFFT,ncpus=1):
+    '''
+    Fourier transform the impulse response G matrix (from stream2matrix or
+    load_fakequakes_GF_store) once so get_fakequakes_G_and_m_fft can reuse it
+    for every rupture. The transforms are zero padded to Nfft_pad>=3*NFFT-2
+    samples so the slip rate convolution (2*NFFT-1 samples) delayed by any
+    onset shorter than NFFT never wraps around.
+
+    OUT:
+        GF_spectra: complex array (Nsta*3,Nfft_pad//2+1,Ncolumns) with the rfft
+            of every station/component block of Gimpulse
+        Nfft_pad: padded FFT length
+    '''
+
+    from numpy import zeros,complex128
+    from scipy.fft import rfft,next_fast_len
+
+    Nfft_pad=next_fast_len(3*NFFT-2,real=True)
+    Ncolumns=Gimpulse.shape[1]
+
+    GF_spectra=zeros((Nsta*3,Nfft_pad//2+1,Ncolumns),dtype=complex128)
+    for ksta in range(Nsta):
+        block=Gimpulse[ksta*3*NFFT:(ksta+1)*3*NFFT,:].reshape(3,NFFT,Ncolumns).astype('float64')
+        GF_spectra[3*ksta:3*ksta+3,:,:]=rfft(block,n=Nfft_pad,axis=1,workers=ncpus)
+
+    return GF_spectra,Nfft_pad
+
+
+
+def fakequakes_slip_rate_spectra(home,project_name,rupture_name,NFFT,Nfft_pad,source_time_function,
+                stf_falloff_rate,dt=1.0,zeta=0.2,forward=False,ncpus=1):
+    '''
+    Spectra of the slip rate functions of the non-zero subfaults of a rupture
+    times a phase shift for each subfault's rupture onset, padded to Nfft_pad.
+    Onsets past the end of the synthetics get an all zero spectrum.
+
+    OUT:
+        multiplier: complex array (Nfft_pad//2+1,2*N_non_zero), one column per
+            subfault and rake in the same order as the G matrix columns
+        i_non_zero: Columns of the impulse G matrix that are used
+        m: Slip vector
+    '''
+
+    from numpy import genfromtxt,where,zeros,arange,r_,sort,ones,exp,pi,repeat
+    from scipy.fft import rfft
+    from mudpy.fakequakes import load_rupture
+
+    if forward==True:
+        source=genfromtxt(home+project_name+'/forward_models/'+rupture_name)
+    else:
+        source=load_rupture(home,project_name,rupture_name)
+    rise_times=source[:,7]
+    fraction=source[:,6]
+    rupture_onset=source[:,12]
+
+    #How many subfaults are non-zero?
+    i_non_zero_original=where(rise_times>0)[0]
+    N_non_zero=len(i_non_zero_original)
+    rise_times = rise_times[i_non_zero_original]
+    fraction = fraction[i_non_zero_original]
+    rupture_onset = rupture_onset[i_non_zero_original]
+
+    #Convert rupture onsets to itneger number of samples
+    rupture_onset = (rupture_onset/dt).astype('int')
+
+    #Now convert to indices according to how G matrix is ordered
+    i_non_zero = sort(r_[i_non_zero_original*2,i_non_zero_original*2+1])
+
+    #Slip rate functions for all subfaults
+    slip_rates = ones((NFFT,N_non_zero))
+    total_time = (NFFT-1) * dt
+    for ksub in range(N_non_zero):
+        sr = build_source_time_function(rise_times[ksub],dt,total_time,stf_type=source_time_function,
+                        zeta=zeta,dreger_falloff_rate=stf_falloff_rate,scale=True,scale_value=dt,
+                        ji_fraction = fraction[ksub])
+        t_stf,slip_rates[:,ksub] = sr
+
+    #Slip rate spectra times the onset delay, one column per subfault and rake
+    k=arange(Nfft_pad//2+1)
+    multiplier=rfft(slip_rates,n=Nfft_pad,axis=0,workers=ncpus)
+    multiplier=multiplier*exp(-2j*pi*k[:,None]*rupture_onset[None,:]/Nfft_pad)
+    multiplier[:,rupture_onset>=NFFT]=0 #Starts after the end of the synthetics
+    multiplier=repeat(multiplier,2,axis=1)
+
+    #Get slip model vector
+    m=zeros((N_non_zero*2,1))
+    iss=arange(0,len(m),2)
+    ids=arange(1,len(m),2)
+    m[iss,0]=source[i_non_zero_original,8]
+    m[ids,0]=source[i_non_zero_original,9]
+
+    return multiplier,i_non_zero,m
+
+
+
+def get_fakequakes_G_and_m_fft(GF_spectra,Nfft_pad,home,project_name,rupture_name,NFFT,
+                source_time_function,stf_falloff_rate,dt=1.0,zeta=0.2,forward=False,ncpus=1):
+    '''
+    Same G and m as get_fakequakes_G_and_m (reconvolution=False) but the
+    convolutions are done in the frequency domain and all at once. The spectra
+    of the impulse GFs from impulse_GF_spectra are multiplied by the slip rate
+    spectrum of each subfault and by a phase shift for its rupture onset, then
+    transformed back one station at a time. Cost per rupture is linear in the
+    number of subfaults.
+
+    IN:
+        GF_spectra,Nfft_pad: From impulse_GF_spectra
+
+    OUT:
+        m: Slip vector
+        G: Kinematic G matrix for the non-zero subfaults
+    '''
+
+    from numpy import zeros
+    from scipy.fft import irfft
+
+    multiplier,i_non_zero,m=fakequakes_slip_rate_spectra(home,project_name,rupture_name,NFFT,Nfft_pad,
+                source_time_function,stf_falloff_rate,dt=dt,zeta=zeta,forward=forward,ncpus=ncpus)
+    Ncolumns=len(i_non_zero)
+
+    #Convolve and shift, station by station to keep the temporary arrays small
+    Nsta=int(GF_spectra.shape[0]/3)
+    G=zeros((Nsta*3*NFFT,Ncolumns))
+    for ksta in range(Nsta):
+        spectra=GF_spectra[3*ksta:3*ksta+3,:,:][:,:,i_non_zero]*multiplier[None,:,:]
+        G[ksta*3*NFFT:(ksta+1)*3*NFFT,:]=irfft(spectra,n=Nfft_pad,axis=1,workers=ncpus)[:,0:NFFT,:].reshape(3*NFFT,Ncolumns)
+
+    return m,G
+
+
+
+def synthesize_fakequakes_waveforms(Gimpulse,home,project_name,rupture_name,NFFT,source_time_function,
+                stf_falloff_rate,dt=1.0,zeta=0.2,forward=False,GF_spectra=None,Nfft_pad=None,
+                station_chunk=10,ncpus=1):
+    '''
+    Waveforms of a rupture without building its G matrix. For a chunk of
+    stations at a time the impulse GF spectra are weighted by slip, slip rate
+    spectrum and onset phase shift, summed over subfaults and transformed
+    back straight into the output vector. Peak memory is the output plus
+    one station chunk, no matter how many subfaults there are.
+
+    IN:
+        Gimpulse: Impulse response G matrix (can be the memory map from
+            load_fakequakes_GF_store), ignored if GF_spectra is given
+        GF_spectra,Nfft_pad: Output of impulse_GF_spectra, None to transform
+            the needed columns of Gimpulse chunk by chunk for every rupture
+        station_chunk: Number of stations done together
+
+    OUT:
+        waveforms: Same as G.dot(m) from get_fakequakes_G_and_m
+    '''
+
+    from numpy import zeros,einsum
+    from scipy.fft import rfft,irfft,next_fast_len
+
+    if GF_spectra is None:
+        Nfft_pad=next_fast_len(3*NFFT-2,real=True)
+        Nsta=int(Gimpulse.shape[0]/(3*NFFT))
+    else:
+        Nsta=int(GF_spectra.shape[0]/3)
+
+    multiplier,i_non_zero,m=fakequakes_slip_rate_spectra(home,project_name,rupture_name,NFFT,Nfft_pad,
+                source_time_function,stf_falloff_rate,dt=dt,zeta=zeta,forward=forward,ncpus=ncpus)
+    weights=multiplier*m[:,0][None,:]
+    Ncolumns=len(i_non_zero)
+
+    waveforms=zeros((Nsta*3*NFFT,1))
+    for ksta in range(0,Nsta,station_chunk):
+        Nchunk=min(station_chunk,Nsta-ksta)
+        if GF_spectra is None:
+            block=Gimpulse[ksta*3*NFFT:(ksta+Nchunk)*3*NFFT,:][:,i_non_zero]
+            spectra=rfft(block.reshape(3*Nchunk,NFFT,Ncolumns).astype('float64'),n=Nfft_pad,axis=1,workers=ncpus)
+        else:
+            spectra=GF_spectra[3*ksta:3*(ksta+Nchunk),:,:][:,:,i_non_zero]
+        #Sum of all subfaults for every station and component in the chunk
+        spectra=einsum('rfk,fk->rf',spectra,weights)
+        waveforms[ksta*3*NFFT:(ksta+Nchunk)*3*NFFT,0]=irfft(spectra,n=Nfft_pad,axis=1,workers=ncpus)[:,0:NFFT].ravel()
+
+    return waveforms
 
 
 
@@ -1613,11 +2078,12 @@ def get_fakequakes_G_and_m_dynGF(Nss,Ess,Zss,Nds,Eds,Zds,home,project_name,ruptu
 
     from numpy import genfromtxt,loadtxt,convolve,where,zeros,arange,unique,save
     import numpy as np
+    from mudpy.fakequakes import load_rupture
 
     if forward==True:
         source=genfromtxt(home+project_name+'/forward_models/'+rupture_name)
     else:
-        source=genfromtxt(home+project_name+'/output/ruptures/'+rupture_name)
+        source=load_rupture(home,project_name,rupture_name)
     rise_times=source[:,7]
     rupture_onset=source[:,12]
 
@@ -4051,17 +4517,29 @@ def make_gnss_noise(percentile=50,dt=1,duration=600):
     
 def read_fakequakes_hypo_time(home,project_name,rupture_name,get_Mw=False):
     '''
-    Read a fakequkaes log file and extrat hypocentral time
+    Read a fakequkaes log file and extrat hypocentral time, ruptures in a 
+    rupture catalog are looked up there instead
     '''
     
     from obspy.core import UTCDateTime
     from numpy import array
+    from mudpy.fakequakes import find_catalog_rupture
     
     #old
     #rupture = rupture_name.split('.')[0]+'.'+rupture_name.split('.')[1]
     #new (Tara's fix)
     rupture = rupture_name.rsplit('.', 1)[0]
     
+    catalog,meta=find_catalog_rupture(home,project_name,rupture)
+    if meta is not None:
+        epicenter=array([meta['hypo_lon'],meta['hypo_lat'],meta['hypo_z']])
+        time_epi=UTCDateTime(str(meta['time_epi']))
+        Mw=float(meta['actual_Mw'])
+        if get_Mw==True:
+            return epicenter,time_epi,Mw
+        else:
+            return epicenter,time_epi
+    
     log_file=home+project_name+'/output/ruptures/'+rupture+'.log'
     f=open(log_file,'r')
     while True:
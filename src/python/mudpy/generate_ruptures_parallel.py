@@ -12,19 +12,23 @@ def run_parallel_generate_ruptures(home,project_name,run_name,fault_name,slab_na
         source_time_function,lognormal,slip_standard_deviation,scaling_law,ncpus,force_magnitude,
         force_area,mean_slip_name,hypocenter,slip_tol,force_hypocenter,
         no_random,use_hypo_fraction,shear_wave_fraction_shallow,shear_wave_fraction_deep,
-        max_slip_rule,rank,size):
+        max_slip_rule,rank,size,rupture_catalog=False,catalog_shard_size=100,seed=None):
     
     '''
     Depending on user selected flags parse the work out to different functions
+    
+    With rupture_catalog=True the realizations are appended to the columnar
+    catalog in output/ruptures/<run_name>.catalog/ in shards of 
+    catalog_shard_size ruptures instead of being written as .rupt/.log files
+    
+    Nrealizations is per magnitude for the whole run. Rupture k (0 to 
+    len(target_Mw)*Nrealizations-1) is made by rank k%size with magnitude 
+    k//Nrealizations and run number k, the same numbering as the 'pool' backend
+    so the ruptures don't depend on the number of ranks
     '''
     
-    from numpy import load,save,genfromtxt,log10,cos,sin,deg2rad,savetxt,zeros,where,argmin
-    from time import gmtime, strftime
-    from numpy.random import shuffle
+    from numpy import zeros
     from mudpy import fakequakes
-    from obspy import UTCDateTime
-    from obspy.taup import TauPyModel
-    import geopy.distance
     import warnings
 
     #I don't condone it but this cleans up the warnings
@@ -33,37 +37,110 @@ def run_parallel_generate_ruptures(home,project_name,run_name,fault_name,slab_na
     # Fix input formats
     rank=int(rank)
     size=int(size)
-    if time_epi=='None':
-        time_epi=None
-    else:
-        time_epi=UTCDateTime(time_epi)
     rise_time_depths=[rise_time_depths0,rise_time_depths1]
     tMw=tMw.split(',')
     target_Mw=zeros(len(tMw))
     for rMw in range(len(tMw)):
         target_Mw[rMw]=float(tMw[rMw])
+    
+    config=fakequakes.RuptureConfig(home,project_name,run_name,fault_name,slab_name,mesh_name,
+        load_distances,distances_name,UTM_zone,target_Mw,model_name,hurst,Ldip,Lstrike,
+        num_modes,Nrealizations,rake,rise_time,rise_time_depths,time_epi,max_slip,
+        source_time_function,lognormal,slip_standard_deviation,scaling_law,ncpus,
+        force_magnitude=force_magnitude,force_area=force_area,mean_slip_name=mean_slip_name,
+        hypocenter=hypocenter,slip_tol=slip_tol,force_hypocenter=force_hypocenter,
+        no_random=no_random,use_hypo_fraction=use_hypo_fraction,
+        shear_wave_fraction_shallow=shear_wave_fraction_shallow,
+        shear_wave_fraction_deep=shear_wave_fraction_deep,max_slip_rule=max_slip_rule,
+        rupture_catalog=rupture_catalog,seed=seed)
+    context=setup_ruptures(config)
+    
+    #Geometry and run settings are stored once for the whole catalog
+    if rupture_catalog==True:
+        catalog_records=[]
+        if rank==0:
+            fakequakes.init_rupture_catalog(home,project_name,run_name,context['fault_template'],context['run_info'],
+                remove_shards=(size==1))
+    elif rank==0: #Text output replaces any catalog written earlier under this run name
+        fakequakes.remove_rupture_catalog(home,project_name,run_name)
+    
+    #Now loop over the realizations, ranks take every size-th rupture
+    Nruptures=len(target_Mw)*Nrealizations
+    if rank==0:
+        print('Generating rupture scenarios')
+    for k in range(rank,Nruptures,size):
+        kmag=k//Nrealizations
+        if rank==0:
+            print('... ... working on ruptures '+str(k)+' to ' + str(min(k+size,Nruptures)-1) + ' of '+str(Nruptures)+', target magnitude Mw = '+str(target_Mw[kmag]))
+        
+        run_number=str(k).rjust(6,'0')
+        fault_out,record=make_rupture(context,kmag,run_number)
+        
+        #Write to file
+        if rupture_catalog==True:
+            catalog_records.append(record)
+            if len(catalog_records)==catalog_shard_size:
+                fakequakes.write_rupture_catalog_shard(home,project_name,run_name,catalog_records)
+                catalog_records=[]
+        else:
+            write_rupture(context,fault_out,record)
         
+        print('Run number: '+run_number+'\n')
+    
+    #Whatever is left of the last shard
+    if rupture_catalog==True:
+        fakequakes.write_rupture_catalog_shard(home,project_name,run_name,catalog_records)
+
+
 
+def setup_ruptures(config):
+    '''
+    Load what all realizations of a run share: the fault, subfault distances,
+    TauPy model, P-wave time table and the hypocenter subfault
+    
+    IN:
+        config: fakequakes.RuptureConfig
+        
+    OUT:
+        context: Dictionary handed to make_rupture() and write_rupture()
+    '''
+    
+    from numpy import load,genfromtxt,zeros,argmin
+    from mudpy import fakequakes
+    from obspy import UTCDateTime
+    
+    home=config.home
+    project_name=config.project_name
+    distances_name=config.distances_name
+    
     #Should I calculate or load the distances?
-    if load_distances==1:  
+    if config.load_distances==1:  
         Dstrike=load(home+project_name+'/data/distances/'+distances_name+'.strike.npy')
         Ddip=load(home+project_name+'/data/distances/'+distances_name+'.dip.npy')
     else:
-        Dstrike,Ddip=fakequakes.subfault_distances_3D(home,project_name,fault_name,slab_name,UTM_zone)
-        save(home+project_name+'/data/distances/'+distances_name+'.strike.npy',Dstrike)
-        save(home+project_name+'/data/distances/'+distances_name+'.dip.npy',Ddip)
+        Dstrike,Ddip=fakequakes.subfault_distances_3D(home,project_name,config.fault_name,config.slab_name,config.UTM_zone,
+            precision=config.precision,out_prefix=home+project_name+'/data/distances/'+distances_name)
+    
+    #Sorted neighbors so select_faults() doesn't scan whole distance columns,
+    #built by fakequakes.run_ruptures() before the workers start
+    neighbor_index=fakequakes.load_neighbor_index(home,project_name,distances_name)
+    if neighbor_index is None:
+        print('... no current neighbor index for '+distances_name+', scanning full distance columns')
     
-
     #Read fault and prepare output variable
-    whole_fault=genfromtxt(home+project_name+'/data/model_info/'+fault_name)
+    whole_fault=genfromtxt(home+project_name+'/data/model_info/'+config.fault_name)
     
     #Get structure model
-    vel_mod_file=home+project_name+'/structure/'+model_name
+    vel_mod_file=home+project_name+'/structure/'+config.model_name
+    
+    #Get TauPyModel, every rank reads the same cached copy
+    velmod = fakequakes.load_TauPyModel(home+project_name+'/structure/'+config.model_name.split('.')[0])
     
-    #Get TauPyModel
-    velmod = TauPyModel(model=home+project_name+'/structure/'+model_name.split('.')[0])
+    #Precomputed P-wave times for the onset check, None means ray trace every subfault
+    Ptime_table=fakequakes.load_Ptime_table(home,project_name,config.fault_name,config.model_name)
     
     # Define the subfault hypocenter (if hypocenter is prescribed)
+    hypocenter=config.hypocenter
     if hypocenter is None:
         shypo=None
     else:
@@ -73,256 +150,341 @@ def run_parallel_generate_ruptures(home,project_name,run_name,fault_name,slab_na
         # Re-define hypocenter as the coordinates of the hypocenter subfault in
         # case the original hypocenter did not perfectly align with a subfault
         hypocenter = whole_fault[shypo,1:4]
+    
+    time_epi=config.time_epi
+    if time_epi=='None':
+        time_epi=None
+    elif isinstance(time_epi,str):
+        time_epi=UTCDateTime(time_epi)
+    
+    #Settings common to all the .log files
+    run_info={'project_name':project_name,'run_name':config.run_name,'model_name':config.model_name,
+        'num_modes':config.num_modes,'hurst':config.hurst,'slip_standard_deviation':config.slip_standard_deviation,
+        'source_time_function':config.source_time_function}
+    if config.seed is not None:
+        run_info['seed']=config.seed
+    
+    #Rupture independent columns of the .rupt files
+    fault_template=zeros((len(whole_fault),15))
+    fault_template[:,0:8]=whole_fault[:,0:8]
+    fault_template[:,10:12]=whole_fault[:,8:]
+    foo,fault_template[:,13]=fakequakes.get_mean_slip(config.target_Mw[0],whole_fault,vel_mod_file)
+    
+    context={'config':config,'whole_fault':whole_fault,'Dstrike':Dstrike,'Ddip':Ddip,
+        'neighbor_index':neighbor_index,
+        'vel_mod_file':vel_mod_file,'velmod':velmod,'Ptime_table':Ptime_table,'shypo':shypo,
+        'hypocenter':hypocenter,'time_epi':time_epi,'run_info':run_info,
+        'fault_template':fault_template,'KL_cache':{}}
+    
+    return context
 
-    #Now loop over the number of realizations
-    realization=0
-    if rank==0:
-        print('Generating rupture scenarios')
-    for kmag in range(len(target_Mw)):
-        if rank==0:
-            print('... Calculating ruptures for target magnitude Mw = '+str(target_Mw[kmag]))
-        for kfault in range(Nrealizations):
-            if kfault%1==0 and rank==0:
-                print('... ... working on ruptures '+str(ncpus*realization)+' to ' + str(ncpus*(realization+1)-1) + ' of '+str(Nrealizations*size*len(target_Mw)))
-                #print '... ... working on ruptures '+str(ncpus*realization+rank)+' of '+str(Nrealizations*size-1)
+
+
+def make_rupture(context,kmag,run_number):
+    '''
+    Make one rupture realization
+    
+    IN:
+        context: From setup_ruptures()
+        kmag: Index of the target magnitude
+        run_number: Run number of the rupture, if the run has a seed the random
+            state is set from the seed and the run number so the rupture comes 
+            out the same no matter which process makes it
+        
+    OUT:
+        fault_out: The rupture as the 15 column .rupt array
+        record: Metadata and per subfault arrays from fakequakes.make_catalog_record()
+    '''
+    
+    from numpy import genfromtxt,log10,cos,sin,deg2rad,zeros,where
+    from numpy.random import seed as random_seed
+    from numpy.random import SeedSequence
+    from random import seed as python_seed
+    from mudpy import fakequakes
+    import numpy as np
+    
+    config=context['config']
+    whole_fault=context['whole_fault']
+    Dstrike=context['Dstrike']
+    Ddip=context['Ddip']
+    vel_mod_file=context['vel_mod_file']
+    velmod=context['velmod']
+    Ptime_table=context['Ptime_table']
+    shypo=context['shypo']
+    hypocenter=context['hypocenter']
+    if hypocenter is not None: #get_rupture_onset() perturbs it in place
+        hypocenter=hypocenter.copy()
+    time_epi=context['time_epi']
+    KL_cache=context['KL_cache']
+    home=config.home
+    project_name=config.project_name
+    model_name=config.model_name
+    target_Mw=config.target_Mw
+    num_modes=config.num_modes
+    scaling_law=config.scaling_law
+    force_area=config.force_area
+    no_random=config.no_random
+    use_hypo_fraction=config.use_hypo_fraction
+    Lstrike=config.Lstrike
+    Ldip=config.Ldip
+    mean_slip_name=config.mean_slip_name
+    slip_tol=config.slip_tol
+    hurst=config.hurst
+    slip_standard_deviation=config.slip_standard_deviation
+    lognormal=config.lognormal
+    max_slip=config.max_slip
+    max_slip_rule=config.max_slip_rule
+    force_magnitude=config.force_magnitude
+    force_hypocenter=config.force_hypocenter
+    rake=config.rake
+    rise_time=config.rise_time
+    rise_time_depths=config.rise_time_depths
+    shear_wave_fraction_shallow=config.shear_wave_fraction_shallow
+    shear_wave_fraction_deep=config.shear_wave_fraction_deep
+    
+    #Same run number, same random draws (select_faults also uses the random module)
+    if config.seed is not None:
+        state=SeedSequence([config.seed,int(run_number)]).generate_state(8)
+        random_seed(state)
+        python_seed(int(state[0]))
+    
+    #Prepare output
+    fault_out=zeros((len(whole_fault),15))
+    fault_out[:,0:8]=whole_fault[:,0:8]
+    fault_out[:,10:12]=whole_fault[:,8:]   
+    
+    #Sucess criterion
+    success=False
+    while success==False:
+        #Select only a subset of the faults based on magnitude scaling
+        current_target_Mw=target_Mw[kmag]
+        ifaults,hypo_fault,Lmax,Wmax,Leff,Weff,option,Lmean,Wmean=fakequakes.select_faults(whole_fault,Dstrike,Ddip,current_target_Mw,num_modes,scaling_law,
+                            force_area,no_shallow_epi=False,no_random=no_random,subfault_hypocenter=shypo,use_hypo_fraction=use_hypo_fraction,
+                            neighbor_index=context['neighbor_index'])
+        fault_array=whole_fault[ifaults,:]
+        
+        #Determine correlation lengths from effective length.width Leff and Weff
+        if Lstrike=='MB2002': #Use scaling
+            #Ls=10**(-2.43+0.49*target_Mw)
+            Ls=2.0+(1./3)*Leff
+        elif Lstrike=='auto':
+            Ls=17.7+0.34*Leff
+        else:
+            Ls=Lstrike
+        if Ldip=='MB2002': #Use scaling
+            #Ld=10**(-1.79+0.38*target_Mw)
+            Ld=1.0+(1./3)*Weff
+        elif Ldip=='auto':
+            Ld=6.8+0.4*Weff
+        else:
+            Ld=Ldip
+        
+        #Get the mean uniform slip for the target magnitude
+        if mean_slip_name==None:
+            mean_slip,mu=fakequakes.get_mean_slip(target_Mw[kmag],fault_array,vel_mod_file)
+        else:
+            foo,mu=fakequakes.get_mean_slip(target_Mw[kmag],fault_array,vel_mod_file)
+            mean_fault=genfromtxt(mean_slip_name)
+            mean_slip=(mean_fault[:,8]**2+mean_fault[:,9]**2)**0.5
             
-            #Prepare output
-            fault_out=zeros((len(whole_fault),15))
-            fault_out[:,0:8]=whole_fault[:,0:8]
-            fault_out[:,10:12]=whole_fault[:,8:]   
+            #keep onlt faults that have man slip inside the fault_array seelcted faults
+            mean_slip=mean_slip[ifaults]
             
-            #Sucess criterion
-            success=False
-            while success==False:
-                #Select only a subset of the faults based on magnitude scaling
-                current_target_Mw=target_Mw[kmag]
-                ifaults,hypo_fault,Lmax,Wmax,Leff,Weff,option,Lmean,Wmean=fakequakes.select_faults(whole_fault,Dstrike,Ddip,current_target_Mw,num_modes,scaling_law,
-                                    force_area,no_shallow_epi=False,no_random=no_random,subfault_hypocenter=shypo,use_hypo_fraction=use_hypo_fraction)
-                fault_array=whole_fault[ifaults,:]
-                Dstrike_selected=Dstrike[ifaults,:][:,ifaults]
-                Ddip_selected=Ddip[ifaults,:][:,ifaults]
-                
-                #Determine correlation lengths from effective length.width Leff and Weff
-                if Lstrike=='MB2002': #Use scaling
-                    #Ls=10**(-2.43+0.49*target_Mw)
-                    Ls=2.0+(1./3)*Leff
-                elif Lstrike=='auto':
-                    Ls=17.7+0.34*Leff
-                else:
-                    Ls=Lstrike
-                if Ldip=='MB2002': #Use scaling
-                    #Ld=10**(-1.79+0.38*target_Mw)
-                    Ld=1.0+(1./3)*Weff
-                elif Ldip=='auto':
-                    Ld=6.8+0.4*Weff
-                else:
-                    Ld=Ldip
-                
-                #Get the mean uniform slip for the target magnitude
-                if mean_slip_name==None:
-                    mean_slip,mu=fakequakes.get_mean_slip(target_Mw[kmag],fault_array,vel_mod_file)
-                else:
-                    foo,mu=fakequakes.get_mean_slip(target_Mw[kmag],fault_array,vel_mod_file)
-                    mean_fault=genfromtxt(mean_slip_name)
-                    mean_slip=(mean_fault[:,8]**2+mean_fault[:,9]**2)**0.5
-                    
-                    #keep onlt faults that have man slip inside the fault_array seelcted faults
-                    mean_slip=mean_slip[ifaults]
-                    
-                    #get the area in those selected faults
-                    area=fault_array[:,-2]*fault_array[:,-1]
-                    
-                    #get the moment in those selected faults
-                    moment_on_selected=(area*mu*mean_slip).sum()
-                    
-                    #target moment
-                    target_moment=10**(1.5*target_Mw[kmag]+9.1)
-                    
-                    #How much do I need to upscale?
-                    scale_factor=target_moment/moment_on_selected
-                    
-                    #rescale the slip
-                    mean_slip = mean_slip*scale_factor
-                    
-                    
-                    #Make sure mean_slip has no zero slip faults
-                    izero=where(mean_slip==0)[0]
-                    mean_slip[izero]=slip_tol
-                
-                #Get correlation matrix
-                C=fakequakes.vonKarman_correlation(Dstrike_selected,Ddip_selected,Ls,Ld,hurst)
-                
-                # Lognormal or not?
-                if lognormal==False:
-                    #Get covariance matrix
-                    C_nonlog=fakequakes.get_covariance(mean_slip,C,target_Mw[kmag],fault_array,vel_mod_file,slip_standard_deviation) 
-                    #Get eigen values and eigenvectors
-                    eigenvals,V=fakequakes.get_eigen(C_nonlog)
-                    #Generate fake slip pattern
-                    rejected=True
-                    while rejected==True:
-#                        slip_unrectified,success=make_KL_slip(fault_array,num_modes,eigenvals,V,mean_slip,max_slip,lognormal=False,seed=kfault)
-                        slip_unrectified,success=fakequakes.make_KL_slip(fault_array,num_modes,eigenvals,V,mean_slip,max_slip,lognormal=False,seed=None)
-                        slip,rejected,percent_negative=fakequakes.rectify_slip(slip_unrectified,percent_reject=13)
-                        if rejected==True:
-                            print('... ... ... negative slip threshold exceeeded with %d%% negative slip. Recomputing...' % (percent_negative))
-                else:
-                    #Get lognormal values
-                    C_log,mean_slip_log=fakequakes.get_lognormal(mean_slip,C,target_Mw[kmag],fault_array,vel_mod_file,slip_standard_deviation)               
-                    #Get eigen values and eigenvectors
-                    eigenvals,V=fakequakes.get_eigen(C_log)
-                    #Generate fake slip pattern
-#                    slip,success=make_KL_slip(fault_array,num_modes,eigenvals,V,mean_slip_log,max_slip,lognormal=True,seed=kfault)
-                    slip,success=fakequakes.make_KL_slip(fault_array,num_modes,eigenvals,V,mean_slip_log,max_slip,lognormal=True,seed=None)
+            #get the area in those selected faults
+            area=fault_array[:,-2]*fault_array[:,-1]
             
-                #Slip pattern sucessfully made, moving on.
-                #Rigidities
-                foo,mu=fakequakes.get_mean_slip(target_Mw[kmag],whole_fault,vel_mod_file)
-                fault_out[:,13]=mu
-                
-                #Calculate moment and magnitude of fake slip pattern
-                M0=sum(slip*fault_out[ifaults,10]*fault_out[ifaults,11]*mu[ifaults])
-                Mw=(2./3)*(log10(M0)-9.1)
-                
-                #Check max_slip_rule
-                if max_slip_rule==True:
-                    
-                    max_slip_from_rule=10**(-4.94+0.71*Mw) #From Allen & Hayes, 2017
-                    max_slip_tolerance = 3
-                    
-                    if slip.max() > max_slip_tolerance*max_slip_from_rule:
-                        success = False
-                        print('... ... ... max slip condition violated max_slip_rule, recalculating...')
-                
-                #Force to target magnitude
-                if force_magnitude==True:
-                    M0_target=10**(1.5*target_Mw[kmag]+9.1)
-                    M0_ratio=M0_target/M0
-                    #Multiply slip by ratio
-                    slip=slip*M0_ratio
-                    #Recalculate
-                    M0=sum(slip*fault_out[ifaults,10]*fault_out[ifaults,11]*mu[ifaults])
-                    Mw=(2./3)*(log10(M0)-9.1)
-                    
-                #check max_slip again
-                if slip.max() > max_slip:
-                    success=False
-                    print('... ... ... max slip condition violated due to force_magnitude=True, recalculating...')
+            #get the moment in those selected faults
+            moment_on_selected=(area*mu*mean_slip).sum()
             
+            #target moment
+            target_moment=10**(1.5*target_Mw[kmag]+9.1)
             
-            #Get stochastic rake vector
-            stoc_rake=fakequakes.get_stochastic_rake(rake,len(slip))
+            #How much do I need to upscale?
+            scale_factor=target_moment/moment_on_selected
             
-            #Place slip values in output variable
-            fault_out[ifaults,8]=slip*cos(deg2rad(stoc_rake))
-            fault_out[ifaults,9]=slip*sin(deg2rad(stoc_rake))
+            #rescale the slip
+            mean_slip = mean_slip*scale_factor
             
-            #Move hypocenter to somewhere with a susbtantial fraction of peak slip
-#            slip_fraction=0.25
-#            islip=where(slip>slip.max()*slip_fraction)[0]
-#            shuffle(islip) #randomize
-#            hypo_fault=ifaults[islip[0]] #select first from randomized vector
             
-            #Calculate and scale rise times
-            rise_times=fakequakes.get_rise_times(M0,slip,fault_array,rise_time_depths,stoc_rake,rise_time,option=option)
+            #Make sure mean_slip has no zero slip faults
+            izero=where(mean_slip==0)[0]
+            mean_slip[izero]=slip_tol
+        
+        #Get eigen values and eigenvectors of the (lognormal) covariance, reused when the selection repeats
+        eigenvals,V,mean_slip_KL=fakequakes.get_KL_basis(Dstrike,Ddip,ifaults,Ls,Ld,hurst,mean_slip,
+                            slip_standard_deviation,num_modes,lognormal=lognormal,KL_cache=KL_cache)
+        
+        # Lognormal or not?
+        if lognormal==False:
+            #Generate fake slip pattern
+            rejected=True
+            while rejected==True:
+#                slip_unrectified,success=make_KL_slip(fault_array,num_modes,eigenvals,V,mean_slip,max_slip,lognormal=False,seed=kfault)
+                slip_unrectified,success=fakequakes.make_KL_slip(fault_array,num_modes,eigenvals,V,mean_slip_KL,max_slip,lognormal=False,seed=None)
+                slip,rejected,percent_negative=fakequakes.rectify_slip(slip_unrectified,percent_reject=13)
+                if rejected==True:
+                    print('... ... ... negative slip threshold exceeeded with %d%% negative slip. Recomputing...' % (percent_negative))
+        else:
+            #Generate fake slip pattern
+#            slip,success=make_KL_slip(fault_array,num_modes,eigenvals,V,mean_slip_log,max_slip,lognormal=True,seed=kfault)
+            slip,success=fakequakes.make_KL_slip(fault_array,num_modes,eigenvals,V,mean_slip_KL,max_slip,lognormal=True,seed=None)
+    
+        #Slip pattern sucessfully made, moving on.
+        #Rigidities
+        foo,mu=fakequakes.get_mean_slip(target_Mw[kmag],whole_fault,vel_mod_file)
+        fault_out[:,13]=mu
+        
+        #Calculate moment and magnitude of fake slip pattern
+        M0=sum(slip*fault_out[ifaults,10]*fault_out[ifaults,11]*mu[ifaults])
+        Mw=(2./3)*(log10(M0)-9.1)
+        
+        #Check max_slip_rule
+        if max_slip_rule==True:
             
-            #Place rise_times in output variable
-            fault_out[:,7]=0
-            fault_out[ifaults,7]=rise_times
+            max_slip_from_rule=10**(-4.94+0.71*Mw) #From Allen & Hayes, 2017
+            max_slip_tolerance = 3
             
-            #Calculate rupture onset times
-            if force_hypocenter==False: #Use random hypo, otehrwise force hypo to user specified
-                hypocenter=whole_fault[hypo_fault,1:4]
-
+            if slip.max() > max_slip_tolerance*max_slip_from_rule:
+                success = False
+                print('... ... ... max slip condition violated max_slip_rule, recalculating...')
+        
+        #Force to target magnitude
+        if force_magnitude==True:
+            M0_target=10**(1.5*target_Mw[kmag]+9.1)
+            M0_ratio=M0_target/M0
+            #Multiply slip by ratio
+            slip=slip*M0_ratio
+            #Recalculate
+            M0=sum(slip*fault_out[ifaults,10]*fault_out[ifaults,11]*mu[ifaults])
+            Mw=(2./3)*(log10(M0)-9.1)
             
-            # edit ...
-            # if rise_time==2:
-            #     shear_wave_fraction_shallow=1/60/60/24*2
-            #     shear_wave_fraction_deep=   1/60/60/24*2
-            #     print("c")
-            # else:
-            #     L_rescale=(Lmax/1500)+2.5
-            #     shear_wave_fraction_shallow=1/60/60/24*2*(3.5/L_rescale)**2
-            #     shear_wave_fraction_deep=   1/60/60/24*2*(3.5/L_rescale)**2
-            #     print("m")
-            if rise_time=='SSE':
-                shear_wave_fraction_shallow=1/60/60/24*2
-                shear_wave_fraction_deep=   1/60/60/24*2
-            else: #regular EQs, do nothing
-                pass
+        #check max_slip again
+        if slip.max() > max_slip:
+            success=False
+            print('... ... ... max slip condition violated due to force_magnitude=True, recalculating...')
+    
+    
+    #Get stochastic rake vector
+    stoc_rake=fakequakes.get_stochastic_rake(rake,len(slip))
+    
+    #Place slip values in output variable
+    fault_out[ifaults,8]=slip*cos(deg2rad(stoc_rake))
+    fault_out[ifaults,9]=slip*sin(deg2rad(stoc_rake))
+    
+    #Move hypocenter to somewhere with a susbtantial fraction of peak slip
+#    slip_fraction=0.25
+#    islip=where(slip>slip.max()*slip_fraction)[0]
+#    shuffle(islip) #randomize
+#    hypo_fault=ifaults[islip[0]] #select first from randomized vector
+    
+    #Calculate and scale rise times
+    rise_times=fakequakes.get_rise_times(M0,slip,fault_array,rise_time_depths,stoc_rake,rise_time,option=option)
+    
+    #Place rise_times in output variable
+    fault_out[:,7]=0
+    fault_out[ifaults,7]=rise_times
+    
+    #Calculate rupture onset times
+    if force_hypocenter==False: #Use random hypo, otehrwise force hypo to user specified
+        hypocenter=whole_fault[hypo_fault,1:4].copy()
 
-            t_onset,length2fault=fakequakes.get_rupture_onset(home,project_name,slip,fault_array,model_name,hypocenter,shypo,rise_time_depths,
-                                                 M0,velmod,shear_wave_fraction_shallow=shear_wave_fraction_shallow,
-                                                 shear_wave_fraction_deep=shear_wave_fraction_deep)
-            fault_out[:,12]=0
-            fault_out[ifaults,12]=t_onset
-            
-            fault_out[:,14]=0
-            fault_out[ifaults,14]=length2fault/t_onset
-            
-            
-            #Calculate location of moment centroid
-            centroid_lon,centroid_lat,centroid_z=fakequakes.get_centroid(fault_out)
-            
-            #Calculate average risetime
-            rise = fault_out[:,7]
-            avg_rise = np.mean(rise[np.where(rise>0)[0]])
-            
-            # Calculate average rupture velocity
-            lon_array = fault_out[:,1]
-            lat_array = fault_out[:,2]
-            vrupt = []
-            
-            for i in range(len(fault_array)):
-                if t_onset[i] > 0:
-                    # r = geopy.distance.geodesic((hypocenter[1], hypocenter[0]), (lat_array[i], lon_array[i])).km
-                    # vrupt.append(r/t_onset[i])
-                    vrupt.append(length2fault[i]/t_onset[i])
-            
-            avg_vrupt = np.mean(vrupt)
-            
-            #Write to file
-            run_number=str(ncpus*realization+rank).rjust(6,'0')
-            outfile=home+project_name+'/output/ruptures/'+run_name+'.'+run_number+'.rupt'
-            #                             'No,   lon,    lat,  z(km),strike,   dip, rise,  dura,  ss(m),ds(m),ss_len(m),ds_len(m),rupt_time(s),rigidity(Pa)
-            savetxt(outfile,fault_out,fmt='%d\t%10.6f\t%10.6f\t%8.4f\t%7.2f\t%7.2f\t%4.1f\t%.9e\t%.4e\t%.4e\t%10.2f\t%10.2f\t%.9e\t%.6e\t%.6e',header='No,lon,lat,z(km),strike,dip,rise,dura,ss-slip(m),ds-slip(m),ss_len(m),ds_len(m),rupt_time(s),rigidity(Pa),velocity(km/s)')
-            # savetxt(outfile,fault_out,fmt='%d\t%10.6f\t%10.6f\t%8.4f\t%7.2f\t%7.2f\t%4.1f\t%5.2f\t%5.2f\t%5.2f\t%10.2f\t%10.2f\t%5.2f\t%.6e',header='No,lon,lat,z(km),strike,dip,rise,dura,ss-slip(m),ds-slip(m),ss_len(m),ds_len(m),rupt_time(s),rigidity(Pa)')
+    
+    # edit ...
+    # if rise_time==2:
+    #     shear_wave_fraction_shallow=1/60/60/24*2
+    #     shear_wave_fraction_deep=   1/60/60/24*2
+    #     print("c")
+    # else:
+    #     L_rescale=(Lmax/1500)+2.5
+    #     shear_wave_fraction_shallow=1/60/60/24*2*(3.5/L_rescale)**2
+    #     shear_wave_fraction_deep=   1/60/60/24*2*(3.5/L_rescale)**2
+    #     print("m")
+    if rise_time=='SSE':
+        shear_wave_fraction_shallow=1/60/60/24*2
+        shear_wave_fraction_deep=   1/60/60/24*2
+    else: #regular EQs, do nothing
+        pass
 
-            #Write log file
-            logfile=home+project_name+'/output/ruptures/'+run_name+'.'+run_number+'.log'
-            f=open(logfile,'w')
-            f.write('Scenario calculated at '+strftime("%Y-%m-%d %H:%M:%S", gmtime())+' GMT\n')
-            f.write('Project name: '+project_name+'\n')
-            f.write('Run name: '+run_name+'\n')
-            f.write('Run number: '+run_number+'\n')
-            f.write('Velocity model: '+model_name+'\n')
-            f.write('No. of KL modes: '+str(num_modes)+'\n')
-            f.write('Hurst exponent: '+str(hurst)+'\n')
-            f.write('Corr. length used Lstrike: %.2f km\n' % Ls)
-            f.write('Corr. length used Ldip: %.2f km\n' % Ld)
-            f.write('Slip std. dev.: %.3f km\n' % slip_standard_deviation)
-            f.write('Maximum length Lmax: %.2f km\n' % Lmax)
-            f.write('Maximum width Wmax: %.2f km\n' % Wmax)
-            f.write('Effective length Leff: %.2f km\n' % Leff)
-            f.write('Effective width Weff: %.2f km\n' % Weff)
-            f.write('Target magnitude: Mw %.4f\n' % target_Mw[kmag])
-            f.write('Actual magnitude: Mw %.4f\n' % Mw)
-            f.write('Hypocenter (lon,lat,z[km]): (%.6f,%.6f,%.2f)\n' %(hypocenter[0],hypocenter[1],hypocenter[2]))
-            f.write('Hypocenter time: %s\n' % time_epi)
-            f.write('Centroid (lon,lat,z[km]): (%.6f,%.6f,%.2f)\n' %(centroid_lon,centroid_lat,centroid_z))
-            f.write('Source time function type: %s\n' % source_time_function)
-            f.write('Average Risetime (s): %.9e\n' % avg_rise)
-            f.write('Average Rupture Velocity (km/s): %.9e\n' % avg_vrupt)
-            f.write('Avg. length: %.2f km\n' % Lmean)
-            f.write('Avg. width: %.2f km\n' % Wmean)
-            f.write('Class: %d type' % option)
-            # f.write('Average Risetime (s): %.2f\n' % avg_rise)
-            # f.write('Average Rupture Velocity (km/s): %.2f' % avg_vrupt)
-            f.close()
-            
-            realization+=1
-            
-            print('Run number: '+run_number+'\n')
+    t_onset,length2fault=fakequakes.get_rupture_onset(home,project_name,slip,fault_array,model_name,hypocenter,shypo,rise_time_depths,
+                                         M0,velmod,shear_wave_fraction_shallow=shear_wave_fraction_shallow,
+                                         shear_wave_fraction_deep=shear_wave_fraction_deep,Ptime_table=Ptime_table)
+    fault_out[:,12]=0
+    fault_out[ifaults,12]=t_onset
+    
+    fault_out[:,14]=0
+    fault_out[ifaults,14]=length2fault/t_onset
+    
+    
+    #Calculate location of moment centroid
+    centroid_lon,centroid_lat,centroid_z=fakequakes.get_centroid(fault_out)
+    
+    #Calculate average risetime
+    rise = fault_out[:,7]
+    avg_rise = np.mean(rise[np.where(rise>0)[0]])
+    
+    # Calculate average rupture velocity
+    lon_array = fault_out[:,1]
+    lat_array = fault_out[:,2]
+    vrupt = []
+    
+    for i in range(len(fault_array)):
+        if t_onset[i] > 0:
+            # r = geopy.distance.geodesic((hypocenter[1], hypocenter[0]), (lat_array[i], lon_array[i])).km
+            # vrupt.append(r/t_onset[i])
+            vrupt.append(length2fault[i]/t_onset[i])
+    
+    avg_vrupt = np.mean(vrupt)
+        
+    record=fakequakes.make_catalog_record(run_number,fault_out,ifaults,slip,stoc_rake,
+            option,Ls,Ld,Lmax,Wmax,Leff,Weff,Lmean,Wmean,target_Mw[kmag],Mw,hypocenter,time_epi,
+            (centroid_lon,centroid_lat,centroid_z),avg_rise,avg_vrupt)
+    
+    return fault_out,record
+
+
+
+def write_rupture(context,fault_out,record):
+    '''
+    Write one realization as .rupt and .log files in output/ruptures/
+    '''
+    
+    from mudpy import fakequakes
+    
+    config=context['config']
+    run_number=str(record[0]['run_number']).rjust(6,'0')
+    outfile=config.home+config.project_name+'/output/ruptures/'+config.run_name+'.'+run_number
+    fakequakes.write_rupt_file(outfile+'.rupt',fault_out)
+    fakequakes.write_rupt_log(outfile+'.log',context['run_info'],record[0])
+
+
+
+#Context of the pool workers of fakequakes.iter_ruptures()
+_context=None
+
+
+
+def init_rupture_worker(config):
+    '''
+    Pool initializer, each worker loads the shared inputs once
+    '''
+    
+    import warnings
+    global _context
+    
+    warnings.filterwarnings("ignore")
+    _context=setup_ruptures(config)
+
+
+
+def rupture_worker(task):
+    '''
+    Make the rupture task=(kmag,run_number) in a pool worker
+    '''
+    
+    kmag,run_number=task
+    fault_out,record=make_rupture(_context,kmag,run_number)
+    
+    return run_number,fault_out,record
 
 #If main entry point
 if __name__ == '__main__':
@@ -415,6 +577,12 @@ if __name__ == '__main__':
             max_slip_rule=True
         if max_slip_rule=='False':
             max_slip_rule=False
+        rupture_catalog=False
+        if len(sys.argv)>40 and sys.argv[40]=='True':
+            rupture_catalog=True
+        seed=None
+        if len(sys.argv)>41 and sys.argv[41]!='None':
+            seed=int(sys.argv[41])
         
         run_parallel_generate_ruptures(home,project_name,run_name,fault_name,slab_name,mesh_name,
         load_distances,distances_name,UTM_zone,tMw,model_name,hurst,Ldip,Lstrike,
@@ -422,7 +590,7 @@ if __name__ == '__main__':
         source_time_function,lognormal,slip_standard_deviation,scaling_law,ncpus,force_magnitude,
         force_area,mean_slip_name,hypocenter,slip_tol,force_hypocenter,
         no_random,use_hypo_fraction,shear_wave_fraction_shallow,shear_wave_fraction_deep,
-        max_slip_rule,rank,size)
+        max_slip_rule,rank,size,rupture_catalog=rupture_catalog,seed=seed)
     else:
         print("ERROR: You're not allowed to run "+sys.argv[1]+" from the shell or it does not exist")
         
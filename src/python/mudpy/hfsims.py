@@ -662,6 +662,51 @@ def get_attenuation(f,structure,ray,Qexp,Qtype='S',scattering='on',Qc_exp=0,base
     return Q
 
 
+def get_ray_tstar(structure,ray):
+    '''
+    Path integrated intrinsic S attenuation sum(dt/Qs) and total travel time
+    of a ray. These two numbers are all get_attenuation needs so they can be
+    stored instead of the ray itself, see get_attenuation_tstar
+    '''
+
+    from numpy import diff,zeros
+    from mudpy.forward import get_Q
+
+    time=ray.path['time']
+    time_in_layer=diff(time)
+    depth=ray.path['depth']
+
+    Qs=zeros(len(time_in_layer))
+    for k in range(len(Qs)):
+        Qp,Qs[k]=get_Q(structure,depth[k])
+
+    tstar=(time_in_layer/Qs).sum()
+    travel_time=time_in_layer.sum()
+
+    return tstar,travel_time
+
+
+def get_attenuation_tstar(f,tstar,travel_time,Qexp,scattering='on',Qc_exp=0,baseline_Qc=100):
+    '''
+    Same as get_attenuation with Qtype='S' but from the output of get_ray_tstar.
+    Scattering Q doesn't depend on depth so its share of the travel time
+    weighted sum is just travel_time/Qscatter
+    '''
+
+    from numpy import exp,pi
+
+    if scattering=='on':
+        Qscatter = baseline_Qc*(f**Qc_exp) #From BSSA paper on CSZ Qcoda
+        weightedQ=tstar+travel_time/Qscatter
+    elif scattering=='off':
+        weightedQ=tstar
+
+    #get frequency dependence
+    Q=exp(-pi*weightedQ*f**(1-Qexp))
+
+    return Q
+
+
 def get_attenuation_old(f,structure,ray,Qexp,Qtype='S'):
     '''
     Get effect of intrinsic aptimeenuation along the ray path
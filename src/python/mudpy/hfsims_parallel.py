@@ -2,90 +2,162 @@
 Module for high frequency simulations in parallel
 '''
 
-def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,component,model_name,
-                        rise_time_depths0,rise_time_depths1,moho_depth_in_km,total_duration,
-                        hf_dt,stress_parameter,kappa,Qexp,Pwave,Swave,high_stress_depth,
-                        Qmethod,scattering,Qc_exp,baseline_Qc,rank,size): 
+def get_direct_rays(velmod,structure,zs,dist_in_degs,Qmethod):
     '''
-    Run stochastic HF sims
+    Ray trace the direct P and S waves from a source at zs (km) to a site 
+    dist_in_degs away and keep only the numbers the stochastic sims need, 
+    these don't depend on the component so they can be cached, see 
+    load_ray_cache
     
-    stress parameter is in bars
+    IN:
+        velmod: TauPyModel object
+        structure: Array from the .mod file
+        Qmethod: Which S ray to keep, 'no_moho', 'shallowest', 'fastest' or 'direct'
+        
+    OUT:
+        ray: array with P takeoff angle, P incidence angle, P travel time,
+            S takeoff angle, S travel time, S path length (m) and S path 
+            integrated 1/Qs (see hfsims.get_ray_tstar)
     '''
     
-    from numpy import genfromtxt,pi,logspace,log10,mean,where,exp,arange,zeros,argmin,rad2deg,arctan2,real,savetxt,c_
-    from pyproj import Geod
-    from obspy.geodetics import kilometer2degrees
-    from obspy.taup import TauPyModel
-    from mudpy.forward import get_mu, read_fakequakes_hypo_time
+    from numpy import zeros,argmin,where,array
     from mudpy import hfsims
-    from obspy import Stream,Trace
-    from sys import stdout
-    from os import path,makedirs
-    from mudpy.hfsims import is_subfault_in_smga
-    import warnings
+    
+    #Tau=p perturbation
+    tau_perturb=0.1
+    
+    #Get ray paths for all direct P arrivals
+    try:
+        Ppaths=velmod.get_ray_paths(zs,dist_in_degs,phase_list=['P','p'])
+    except:
+        zs = zs+0.0001
+        Ppaths=velmod.get_ray_paths(zs,dist_in_degs,phase_list=['P','p'])
+
+    #Get ray paths for all direct S arrivals
+    try:
+        Spaths=velmod.get_ray_paths(zs,dist_in_degs,phase_list=['S','s'])
+    except:
+        Spaths=velmod.get_ray_paths(zs+tau_perturb,dist_in_degs,phase_list=['S','s'])
+
+    #sometimes there's no S, weird I know. Check twice.
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs+tau_perturb,dist_in_degs,phase_list=['S','s'])
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs+5*tau_perturb,dist_in_degs,phase_list=['S','s'])   
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs-5*tau_perturb,dist_in_degs,phase_list=['S','s'])
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs+5*tau_perturb,dist_in_degs,phase_list=['S','s'])  
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs-10*tau_perturb,dist_in_degs,phase_list=['S','s'])
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs+10*tau_perturb,dist_in_degs,phase_list=['S','s']) 
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs-50*tau_perturb,dist_in_degs,phase_list=['S','s'])
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs+50*tau_perturb,dist_in_degs,phase_list=['S','s']) 
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs-75*tau_perturb,dist_in_degs,phase_list=['S','s'])
+    if len(Spaths)==0:
+        Spaths=velmod.get_ray_paths(zs+75*tau_perturb,dist_in_degs,phase_list=['S','s']) 
+    if len(Spaths)==0:
+        print('ERROR: I give up, no direct S in spite of multiple attempts at depth '+str(zs)+'km and distance '+str(dist_in_degs)+'deg')
+
+    #Which ray should I keep? 
+
+    #This is the fastest arriving P
+    directP=Ppaths[0]
+
+    #Get moho depth from velmod
+    moho_depth  = velmod.model.moho_depth
+
+    # In this method here are the rules:
+    #For S do not allow Moho turning rays, keep the fastest non Moho turning ray. If
+    #only Moho rays are available, then keep the one that turns the shallowest.
+    if Qmethod == 'no_moho':
+
+        #get turning depths and arrival times of S rays
+        turning_depths = zeros(len(Spaths))
+        S_ray_times = zeros(len(Spaths))
+
+        for kray in range(len(Spaths)):
+            turning_depths[kray] = Spaths[kray].path['depth'].max()
+            S_ray_times[kray] = Spaths[kray].path['time'].max()
+
+        #Keep only rays that turn above Moho
+        i=where(turning_depths < moho_depth)[0]
+
+        if len(i) == 0: #all rays turn below Moho, keep shallowest turning
+            i_min_depth = argmin(turning_depths)
+            directS = Spaths[i_min_depth]
+
+        else:  #Keep fastest arriving ray that turns above Moho
+            Spaths = [Spaths[j] for j in i]  #Rays turning above Moho, NOTE: I hate list comprehension
+            S_ray_times = S_ray_times[i]
+            i_min_time = argmin(S_ray_times)
+            directS = Spaths[i_min_time]
+
+    elif Qmethod =='shallowest':
+
+        #get turning depths and arrival times of S rays
+        turning_depths = zeros(len(Spaths))
+
+        for kray in range(len(Spaths)):
+            turning_depths[kray] = Spaths[kray].path['depth'].max()
+
+        i_min_depth = argmin(turning_depths)
+        directS = Spaths[i_min_depth]
+
+    elif Qmethod == 'fastest' or Qmethod=='direct':   #Pick first arriving S wave
+
+        directS = Spaths[0]
+
+
 
-    rank=int(rank)
     
-    if rank==0 and component=='N':
-        #print out what's going on:
-        out='''Running with input parameters:
-        home = %s
-        project_name = %s
-        rupture_name = %s
-        N = %s
-        M0 (N-m) = %s
-        sta = %s
-        sta_lon = %s
-        sta_lat = %s
-        model_name = %s
-        rise_time_depths = %s
-        moho_depth_in_km = %s
-        total_duration = %s
-        hf_dt = %s
-        stress_parameter = %s
-        kappa = %s
-        Qexp = %s
-        component = %s
-        Pwave = %s
-        Swave = %s
-        high_stress_depth = %s
-        Qmethod = %s
-        scattering = %s
-        Qc_exp = %s
-        baseline_Qc = %s
-        '''%(home,project_name,rupture_name,str(N),str(M0/1e7),sta,str(sta_lon),str(sta_lat),model_name,str([rise_time_depths0,rise_time_depths1]),
-        str(moho_depth_in_km),str(total_duration),str(hf_dt),str(stress_parameter),str(kappa),str(Qexp),str(component),str(Pwave),str(Swave),
-        str(high_stress_depth),str(Qmethod),str(scattering),str(Qc_exp),str(baseline_Qc))
-        print(out)
+    #Keep only what's needed
+    tstar_S,travel_time_S=hfsims.get_ray_tstar(structure,directS)
+    path_length_S=hfsims.get_path_length(directS,zs,dist_in_degs)
+    ray=array([directP.takeoff_angle,directP.incident_angle,directP.path['time'][-1],
+               directS.takeoff_angle,travel_time_S,path_length_S,tstar_S])
+    
+    return ray
 
-    if rank==0:
-        out='''
-        Rupture_Name = %s
-        Station = %s
-        Component (N,E,Z) = %s
-        Sample rate = %sHz
-        Duration = %ss
-        '''%(rupture_name,sta,component,str(1/hf_dt),str(total_duration))
-        print(out)
-        
-    #print 'stress is '+str(stress_parameter)
 
-    #I don't condone it but this cleans up the warnings
-    warnings.filterwarnings("ignore")
+
+def hfsims_waveform(fault,N,M0,sta,sta_lon,sta_lat,component,structure,velmod,epicenter,time_epi,
+                    rise_time_depths,total_duration,hf_dt,stress_parameter,kappa,Qexp,Pwave,Swave,
+                    Qmethod,scattering,Qc_exp,baseline_Qc,verbose=False,ray_cache=None):
+    '''
+    Stochastic HF accelerogram at one station and component from the subfaults 
+    in fault. Nothing is read from or written to disk so the same loaded 
+    structure and TauPyModel can be reused for as many calls as you want.
     
+    IN:
+        fault: .rupt array, all of the rupture or just a piece of it
+        N: Number of subfaults with non-zero slip in the whole rupture
+        M0: Moment of the whole rupture in dyne-cm
+        structure: Array from the .mod file
+        velmod: TauPyModel object
+        epicenter,time_epi: From read_fakequakes_hypo_time
+        ray_cache: None to ray trace every subfault or a dict from load_ray_cache,
+            rays not in it yet are traced and added to it
+        
+    OUT:
+        tr: obspy Trace with the accelerogram in m/s**2 and the sac header filled in
+    '''
     
-    #Fix input formats:
-    rise_time_depths=[rise_time_depths0,rise_time_depths1]
-    #Load the source
-    mpi_rupt=home+project_name+'/output/ruptures/mpi_rupt.'+str(rank)+'.'+rupture_name
-    fault=genfromtxt(mpi_rupt)  
+    from numpy import pi,logspace,log10,mean,where,exp,arange,zeros,argmin,rad2deg,arctan2,real,savetxt,c_
+    from pyproj import Geod
+    from obspy.geodetics import kilometer2degrees
+    from mudpy.forward import get_mu
+    from mudpy import hfsims
+    from obspy import Trace
+    from sys import stdout
     
     #Onset times for each subfault
     onset_times=fault[:,12]
     
-    #load velocity structure
-    structure=genfromtxt(home+project_name+'/structure/'+model_name)
-    
     #Frequencies vector
     f=logspace(log10(1/total_duration),log10(1/(2*hf_dt))+0.01,100)
     omega=2*pi*f
@@ -96,14 +168,6 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
     #Projection object for distance calculations
     g=Geod(ellps='WGS84')
     
-    #Create taup velocity model object, paste on top of iaspei91
-    #taup_create.build_taup_model(home+project_name+'/structure/bbp_norcal.tvel',output_folder=home+project_name+'/structure/')
-#    velmod=TauPyModel(model=home+project_name+'/structure/iquique',verbose=True)
-    velmod = TauPyModel(model=home+project_name+'/structure/'+model_name.split('.')[0]+'.npz')
-    
-    #Get epicentral time
-    epicenter,time_epi=read_fakequakes_hypo_time(home,project_name,rupture_name)
-    
     #Moments
     slip=(fault[:,8]**2+fault[:,9]**2)**0.5
     subfault_M0=slip*fault[:,10]*fault[:,11]*fault[:,13]
@@ -116,9 +180,6 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
     dl=mean((fault[:,10]+fault[:,11])/2) #predominant length scale
     dl=dl/1000 # to km
     
-    #Tau=p perturbation
-    tau_perturb=0.1
-    
     #Deep faults receive a higher stress
     stress_multiplier=1
 
@@ -135,7 +196,7 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
     
     #Loop over subfaults
     for kfault in range(len(fault)):
-        if rank==0:
+        if verbose==True:
             #Print status to screen            
             if kfault % 25 == 0:
                 if kfault==0:
@@ -268,93 +329,15 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
             ds=fault[kfault,9]
             rake=rad2deg(arctan2(ds,ss))
             
-            #Get ray paths for all direct P arrivals
-            try:
-                Ppaths=velmod.get_ray_paths(zs,dist_in_degs,phase_list=['P','p'])
-            except:
-                zs = zs+0.0001
-                Ppaths=velmod.get_ray_paths(zs,dist_in_degs,phase_list=['P','p'])
-            
-            #Get ray paths for all direct S arrivals
-            try:
-                Spaths=velmod.get_ray_paths(zs,dist_in_degs,phase_list=['S','s'])
-            except:
-                Spaths=velmod.get_ray_paths(zs+tau_perturb,dist_in_degs,phase_list=['S','s'])
-            
-            #sometimes there's no S, weird I know. Check twice.
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs+tau_perturb,dist_in_degs,phase_list=['S','s'])
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs+5*tau_perturb,dist_in_degs,phase_list=['S','s'])   
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs-5*tau_perturb,dist_in_degs,phase_list=['S','s'])
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs+5*tau_perturb,dist_in_degs,phase_list=['S','s'])  
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs-10*tau_perturb,dist_in_degs,phase_list=['S','s'])
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs+10*tau_perturb,dist_in_degs,phase_list=['S','s']) 
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs-50*tau_perturb,dist_in_degs,phase_list=['S','s'])
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs+50*tau_perturb,dist_in_degs,phase_list=['S','s']) 
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs-75*tau_perturb,dist_in_degs,phase_list=['S','s'])
-            if len(Spaths)==0:
-                Spaths=velmod.get_ray_paths(zs+75*tau_perturb,dist_in_degs,phase_list=['S','s']) 
-            if len(Spaths)==0:
-                print('ERROR: I give up, no direct S in spite of multiple attempts at subfault '+str(kfault))
-
-            #Which ray should I keep? 
-            
-            #This is the fastest arriving P
-            directP=Ppaths[0]
-            
-            #Get moho depth from velmod
-            moho_depth  = velmod.model.moho_depth
-            
-            # In this method here are the rules:
-            #For S do not allow Moho turning rays, keep the fastest non Moho turning ray. If
-            #only Moho rays are available, then keep the one that turns the shallowest.
-            if Qmethod == 'no_moho':
-            
-                #get turning depths and arrival times of S rays
-                turning_depths = zeros(len(Spaths))
-                S_ray_times = zeros(len(Spaths))
-                
-                for kray in range(len(Spaths)):
-                    turning_depths[kray] = Spaths[kray].path['depth'].max()
-                    S_ray_times[kray] = Spaths[kray].path['time'].max()
-                    
-                #Keep only rays that turn above Moho
-                i=where(turning_depths < moho_depth)[0]
-                
-                if len(i) == 0: #all rays turn below Moho, keep shallowest turning
-                    i_min_depth = argmin(turning_depths)
-                    directS = Spaths[i_min_depth]
-                
-                else:  #Keep fastest arriving ray that turns above Moho
-                    Spaths = [Spaths[j] for j in i]  #Rays turning above Moho, NOTE: I hate list comprehension
-                    S_ray_times = S_ray_times[i]
-                    i_min_time = argmin(S_ray_times)
-                    directS = Spaths[i_min_time]
-                    
-            elif Qmethod =='shallowest':
-                                
-                #get turning depths and arrival times of S rays
-                turning_depths = zeros(len(Spaths))
-                
-                for kray in range(len(Spaths)):
-                    turning_depths[kray] = Spaths[kray].path['depth'].max()
-
-                i_min_depth = argmin(turning_depths)
-                directS = Spaths[i_min_depth]
-                
-            elif Qmethod == 'fastest' or Qmethod=='direct':   #Pick first arriving S wave
-                
-                directS = Spaths[0]
-                
-                
+            #Ray geometry only depends on source depth and distance, reuse it if it's known
+            ray_key=(round(zs,4),round(dist_in_degs,6))
+            if ray_cache is not None and ray_key in ray_cache:
+                ray=ray_cache[ray_key]
+            else:
+                ray=get_direct_rays(velmod,structure,zs,dist_in_degs,Qmethod)
+                if ray_cache is not None:
+                    ray_cache[ray_key]=ray
+            take_off_angle_P,incidence_angle,time_P,take_off_angle_S,time_S,ray_length_S,tstar_S=ray
             
             #directS=Spaths[0]  #this is the old way, kept fastest S
             mohoS=None
@@ -380,7 +363,6 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
  
             #######         Build Direct P ray           ######
             if Pwave==True:
-                take_off_angle_P=directP.takeoff_angle
                 
                 # #Get attenuation due to geometrical spreading (from the path length)
                 # path_length_P=hfsims.get_path_length(directP,zs,dist_in_degs)
@@ -398,11 +380,10 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
                 # G_P=(I_P*Q_P)/path_length_P
                 
                 #Get attenuation due to geometrical spreading (from the path length)
-                path_length_S=hfsims.get_path_length(directS,zs,dist_in_degs)
-                path_length_S=path_length_S*100 #to cm
+                path_length_S=ray_length_S*100 #to cm
                 
                 #Get effect of intrinsic aptimeenuation for that ray (path integrated)
-                Q_S=hfsims.get_attenuation(f,structure,directS,Qexp)
+                Q_S=hfsims.get_attenuation_tstar(f,tstar_S,time_S,Qexp)
                 
                 #get quarter wavelength amplificationf actors
                 # pass rho in kg/m^3 (this units nightmare is what I get for following Graves' code)
@@ -419,7 +400,6 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
                 RP=abs(RP)
                    
                 #Get partition of Pwave into Z and N,E components 
-                incidence_angle=directP.incident_angle
                 Npartition,Epartition,Zpartition=hfsims.get_P_wave_partition(incidence_angle,azimuth)
                 if component=='Z':
                    Ppartition=Zpartition 
@@ -449,7 +429,7 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
                 
                 
                 #What time after OT should this time series start at?
-                time_insert=directP.path['time'][-1]+onset_times[kfault]
+                time_insert=time_P+onset_times[kfault]
                 i=argmin(abs(t-time_insert))
                 j=i+len(hf_seis_P)
                 
@@ -472,17 +452,15 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
             #######         Use already built S ray from above           ######
 
             if Swave==True:
-                take_off_angle_S=directS.takeoff_angle
                 
                 #Get attenuation due to geometrical spreading (from the path length)
-                path_length_S=hfsims.get_path_length(directS,zs,dist_in_degs)
-                path_length_S=path_length_S*100 #to cm
+                path_length_S=ray_length_S*100 #to cm
                 
                 #Get effect of intrinsic aptimeenuation for that ray (path integrated)
                 if Qmethod == 'direct':#No ray tracing use bulka ttenuation along path
                     Q_S = hfsims.get_attenuation_linear(f,structure,zs,dist,Qexp,Qtype='S')
                 else: #Use ray tracing
-                    Q_S = hfsims.get_attenuation(f,structure,directS,Qexp,scattering=scattering,
+                    Q_S = hfsims.get_attenuation_tstar(f,tstar_S,time_S,Qexp,scattering=scattering,
                                                Qc_exp=Qc_exp,baseline_Qc=baseline_Qc)
                 
                 #get quarter wavelength amplificationf actors
@@ -525,7 +503,7 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
                 #     savetxt(path_out+'.site',c_[f,P])
                 
                 #What time after OT should this time series start at?
-                time_insert=directS.path['time'][-1]+onset_times[kfault]
+                time_insert=time_S+onset_times[kfault]
                 #print 'ts = '+str(time_insert)+' , Td = '+str(duration)
                 #time_insert=Ppaths[0].path['time'][-1]
                 i=argmin(abs(t-time_insert))
@@ -601,6 +579,191 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
     #Add station location, event location, and first P-wave arrival time to SAC header
     tr.stats.update({'sac':{'stlo':sta_lon,'stla':sta_lat,'evlo':epicenter[0],'evla':epicenter[1],'evdp':epicenter[2],'dist':dist_in_km,'az':az,'baz':backaz,'mag':Mw}}) #,'idep':"ACC (m/s^2)" not sure why idep won't work
     
+    return tr
+
+
+
+#Content tags of the velocity models already hashed by this process
+_ray_cache_tags={}
+
+
+
+def ray_cache_prefix(home,project_name,model_name,Qmethod):
+    '''
+    Path and name start of the ray cache files for a velocity model and Qmethod.
+    The name carries a SHA-1 tag of the .mod file and of the TauPy .npz the rays
+    were traced with, so editing or rebuilding either one starts a new cache
+    
+    OUT:
+        prefix: structure/ray_cache/<model>.<Qmethod>.<tag>
+    '''
+    
+    from hashlib import sha1
+    from os import path
+    
+    mod_file=home+project_name+'/structure/'+model_name
+    npz_file=home+project_name+'/structure/'+model_name.split('.')[0]+'.npz'
+    key=(mod_file,path.getmtime(mod_file),npz_file,path.getmtime(npz_file))
+    if key not in _ray_cache_tags:
+        tag=sha1()
+        tag.update(open(mod_file,'rb').read())
+        tag.update(open(npz_file,'rb').read())
+        _ray_cache_tags[key]=tag.hexdigest()[0:12]
+    
+    return home+project_name+'/structure/ray_cache/'+model_name.split('.')[0]+'.'+Qmethod+'.'+_ray_cache_tags[key]
+
+
+
+def load_ray_cache(home,project_name,model_name,Qmethod):
+    '''
+    Read the ray geometry cache for a velocity model and Qmethod. It lives in 
+    structure/ray_cache/ as one text file per MPI rank so several ranks can add 
+    to it at the same time. Only files traced with the current .mod and TauPy
+    model are read, see ray_cache_prefix()
+    
+    OUT:
+        ray_cache: dict with the get_direct_rays output keyed by (depth,distance)
+    '''
+    
+    from numpy import genfromtxt
+    from glob import glob
+    
+    ray_cache={}
+    cache_files=glob(ray_cache_prefix(home,project_name,model_name,Qmethod)+'.*.rays')
+    for cache_file in sorted(cache_files):
+        rays=genfromtxt(cache_file,ndmin=2,invalid_raise=False)
+        for k in range(len(rays)):
+            ray_cache[(round(rays[k,0],4),round(rays[k,1],6))]=rays[k,2:]
+    
+    return ray_cache
+    
+    
+    
+def save_ray_cache(home,project_name,model_name,Qmethod,ray_cache,Nsaved,rank):
+    '''
+    Append the rays added to ray_cache after the first Nsaved to this rank's
+    cache file.
+    
+    OUT:
+        Nsaved: Number of rays in ray_cache that are now on disk
+    '''
+    
+    from os import makedirs
+    
+    keys=list(ray_cache.keys())[Nsaved:]
+    if len(keys)>0:
+        makedirs(home+project_name+'/structure/ray_cache/',exist_ok=True)
+        f=open(ray_cache_prefix(home,project_name,model_name,Qmethod)+'.'+str(rank)+'.rays','a')
+        for key in keys:
+            line='%.4f\t%.6f\t' % key
+            line+='\t'.join(['%.10e' % value for value in ray_cache[key]])
+            f.write(line+'\n')
+        f.close()
+    
+    return len(ray_cache)
+
+
+
+def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,component,model_name,
+                        rise_time_depths0,rise_time_depths1,moho_depth_in_km,total_duration,
+                        hf_dt,stress_parameter,kappa,Qexp,Pwave,Swave,high_stress_depth,
+                        Qmethod,scattering,Qc_exp,baseline_Qc,rank,size,ray_cache=False): 
+    '''
+    Run stochastic HF sims
+    
+    stress parameter is in bars
+    ray_cache: True to reuse the rays from structure/ray_cache/ and add the new ones
+    '''
+    
+    from numpy import genfromtxt
+    from mudpy.fakequakes import load_TauPyModel
+    from mudpy.forward import read_fakequakes_hypo_time
+    from os import path,makedirs
+    import warnings
+
+    rank=int(rank)
+    
+    if rank==0 and component=='N':
+        #print out what's going on:
+        out='''Running with input parameters:
+        home = %s
+        project_name = %s
+        rupture_name = %s
+        N = %s
+        M0 (N-m) = %s
+        sta = %s
+        sta_lon = %s
+        sta_lat = %s
+        model_name = %s
+        rise_time_depths = %s
+        moho_depth_in_km = %s
+        total_duration = %s
+        hf_dt = %s
+        stress_parameter = %s
+        kappa = %s
+        Qexp = %s
+        component = %s
+        Pwave = %s
+        Swave = %s
+        high_stress_depth = %s
+        Qmethod = %s
+        scattering = %s
+        Qc_exp = %s
+        baseline_Qc = %s
+        '''%(home,project_name,rupture_name,str(N),str(M0/1e7),sta,str(sta_lon),str(sta_lat),model_name,str([rise_time_depths0,rise_time_depths1]),
+        str(moho_depth_in_km),str(total_duration),str(hf_dt),str(stress_parameter),str(kappa),str(Qexp),str(component),str(Pwave),str(Swave),
+        str(high_stress_depth),str(Qmethod),str(scattering),str(Qc_exp),str(baseline_Qc))
+        print(out)
+
+    if rank==0:
+        out='''
+        Rupture_Name = %s
+        Station = %s
+        Component (N,E,Z) = %s
+        Sample rate = %sHz
+        Duration = %ss
+        '''%(rupture_name,sta,component,str(1/hf_dt),str(total_duration))
+        print(out)
+        
+    #print 'stress is '+str(stress_parameter)
+
+    #I don't condone it but this cleans up the warnings
+    warnings.filterwarnings("ignore")
+    
+    
+    #Fix input formats:
+    rise_time_depths=[rise_time_depths0,rise_time_depths1]
+    #Load the source
+    mpi_rupt=home+project_name+'/output/ruptures/mpi_rupt.'+str(rank)+'.'+rupture_name
+    fault=genfromtxt(mpi_rupt)  
+    
+    #load velocity structure
+    structure=genfromtxt(home+project_name+'/structure/'+model_name)
+    
+    #Create taup velocity model object, paste on top of iaspei91
+    #taup_create.build_taup_model(home+project_name+'/structure/bbp_norcal.tvel',output_folder=home+project_name+'/structure/')
+#    velmod=TauPyModel(model=home+project_name+'/structure/iquique',verbose=True)
+    velmod = load_TauPyModel(home+project_name+'/structure/'+model_name.split('.')[0]+'.npz')
+    
+    #Get epicentral time
+    epicenter,time_epi=read_fakequakes_hypo_time(home,project_name,rupture_name)
+    
+    #Previously traced rays
+    if ray_cache==True:
+        rays=load_ray_cache(home,project_name,model_name,Qmethod)
+        Nsaved=len(rays)
+    else:
+        rays=None
+    
+    #Stochastic simulation for this piece of the rupture
+    tr=hfsims_waveform(fault,N,M0,sta,sta_lon,sta_lat,component,structure,velmod,epicenter,time_epi,
+                    rise_time_depths,total_duration,hf_dt,stress_parameter,kappa,Qexp,Pwave,Swave,
+                    Qmethod,scattering,Qc_exp,baseline_Qc,verbose=(rank==0),ray_cache=rays)
+    
+    #Keep the new rays for the other components and ruptures
+    if ray_cache==True:
+        save_ray_cache(home,project_name,model_name,Qmethod,rays,Nsaved,rank)
+    
     #Write out to file 
     #old
     rupture=rupture_name.split('.')[0]+'.'+rupture_name.split('.')[1]
@@ -615,6 +778,172 @@ def run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,
     else:
         tr.write(home+project_name+'/output/waveforms/'+rupture+'/'+sta+'.HN'+component+'.'+str(rank)+'.sac',format='SAC')
 
+def run_hfsims_queue(home,project_name,rupture_list,GF_list,model_name,rise_time_depths0,rise_time_depths1,
+                     moho_depth_in_km,total_duration,hf_dt,stress_parameter,kappa,Qexp,Pwave,Swave,
+                     high_stress_depth,Qmethod,scattering,Qc_exp,baseline_Qc,hot_start,comm,ray_cache=False): 
+    '''
+    Run ALL stochastic HF sims (every rupture, station and component) in one
+    MPI job. Rank 0 hands out (rupture,station,component) tasks to the other
+    ranks as they become free. Each worker loads the structure and TauPyModel
+    only once, simulates the whole rupture for its task and writes the trace
+    straight to output/waveforms/<rupture>/<sta>.HN<comp>.mpi.sac, the same
+    file write_parallel_hfsims makes, so there are no mpi_rupt.* files and
+    nothing to merge afterwards.
+    
+    kappa: None for the default 0.04, 'gflist' to read station values from the
+        last column of GF_list or a single value for all sites
+    ray_cache: True to reuse the rays from structure/ray_cache/ and add the new 
+        ones. Then a task is one station for all ruptures and components so its
+        rays are traced by only one worker.
+    
+    stress parameter is in bars
+    '''
+    
+    from numpy import genfromtxt,ones,where
+    from mudpy.fakequakes import load_TauPyModel
+    from mudpy.forward import read_fakequakes_hypo_time
+    from os import makedirs
+    import warnings
+    
+    rank=comm.Get_rank()
+    size=comm.Get_size()
+    
+    #I don't condone it but this cleans up the warnings
+    warnings.filterwarnings("ignore")
+    
+    #Fix input formats:
+    rise_time_depths=[rise_time_depths0,rise_time_depths1]
+    
+    #What ruptures?
+    all_sources=genfromtxt(home+project_name+'/data/'+rupture_list,dtype='U',ndmin=1)
+    
+    #Get station info from GF_list
+    sta=genfromtxt(home+project_name+'/data/station_info/'+GF_list,usecols=[0],dtype='U',ndmin=1)
+    lonlat=genfromtxt(home+project_name+'/data/station_info/'+GF_list,usecols=[1,2],ndmin=2)
+    sta_lon=lonlat[:,0]
+    sta_lat=lonlat[:,1]
+    
+    #Multi kappa?
+    if kappa == 'gflist': #from station files
+        station_kappa = genfromtxt(home+project_name+'/data/station_info/'+GF_list,usecols=[-1],ndmin=1)
+    elif kappa == None: #default values
+        station_kappa = 0.04*ones(len(sta))
+    else: #one single value for all sites that is NOT the default
+        station_kappa = kappa*ones(len(sta))
+    
+    #All the work, each task is a list of (rupture,station,component)
+    comp=['N','E','Z']
+    tasks=[]
+    if ray_cache==True: #Station by station, all components and ruptures share the same rays
+        for ksta in range(len(sta)):
+            tasks.append([])
+            for ksource in range(hot_start,len(all_sources)):
+                for kcomp in range(len(comp)):
+                    tasks[-1].append((ksource,ksta,kcomp))
+    else: #Rupture by rupture so workers mostly reuse the rupture they have loaded
+        for ksource in range(hot_start,len(all_sources)):
+            for ksta in range(len(sta)):
+                for kcomp in range(len(comp)):
+                    tasks.append([(ksource,ksta,kcomp)])
+    
+    if rank==0:
+        out='''Running with input parameters:
+        home = %s
+        project_name = %s
+        rupture_list = %s (%d ruptures from hot_start = %d)
+        GF_list = %s (%d stations)
+        model_name = %s
+        rise_time_depths = %s
+        moho_depth_in_km = %s
+        total_duration = %s
+        hf_dt = %s
+        stress_parameter = %s
+        kappa = %s
+        Qexp = %s
+        Pwave = %s
+        Swave = %s
+        high_stress_depth = %s
+        Qmethod = %s
+        scattering = %s
+        Qc_exp = %s
+        baseline_Qc = %s
+        Total tasks = %d on %d worker(s)
+        '''%(home,project_name,rupture_list,len(all_sources),hot_start,GF_list,len(sta),model_name,str(rise_time_depths),
+        str(moho_depth_in_km),str(total_duration),str(hf_dt),str(stress_parameter),str(kappa),str(Qexp),str(Pwave),str(Swave),
+        str(high_stress_depth),str(Qmethod),str(scattering),str(Qc_exp),str(baseline_Qc),len(tasks),max(size-1,1))
+        print(out)
+    
+    #Rank 0 only hands out work when there are other ranks to do it
+    if size>1 and rank==0:
+        from mpi4py import MPI
+        next_task=0
+        active_workers=size-1
+        status=MPI.Status()
+        while active_workers>0:
+            comm.recv(source=MPI.ANY_SOURCE,tag=1,status=status)
+            worker=status.Get_source()
+            if next_task<len(tasks):
+                comm.send(next_task,dest=worker,tag=2)
+                if next_task%100==0:
+                    print('... dispatching task '+str(next_task)+' of '+str(len(tasks)))
+                next_task+=1
+            else: #Nothing left, tell the worker to go home
+                comm.send(None,dest=worker,tag=2)
+                active_workers-=1
+        print('... all tasks finished')
+        return
+    
+    #Workers load things exactly once
+    structure=genfromtxt(home+project_name+'/structure/'+model_name)
+    velmod = load_TauPyModel(home+project_name+'/structure/'+model_name.split('.')[0]+'.npz')
+    if ray_cache==True:
+        rays=load_ray_cache(home,project_name,model_name,Qmethod)
+        Nsaved=len(rays)
+    else:
+        rays=None
+    current_source=None
+    ktask=-1
+    
+    while True:
+        
+        #What's next?
+        if size>1:
+            comm.send(rank,dest=0,tag=1)
+            ktask=comm.recv(source=0,tag=2)
+            if ktask is None:
+                break
+        else:
+            ktask+=1
+            if ktask==len(tasks):
+                break
+        
+        for ksource,ksta,kcomp in tasks[ktask]:
+        
+            #Load rupture and full-fault parameters only when it changes
+            if ksource!=current_source:
+                rupture_name=all_sources[ksource]
+                fault=genfromtxt(home+project_name+'/output/ruptures/'+rupture_name)
+                slip=(fault[:,8]**2+fault[:,9]**2)**0.5
+                subfault_M0=slip*fault[:,10]*fault[:,11]*fault[:,13]
+                subfault_M0=subfault_M0*1e7 #to dyne-cm
+                M0=subfault_M0.sum()
+                N=len(where(slip>0)[0])
+                epicenter,time_epi=read_fakequakes_hypo_time(home,project_name,rupture_name)
+                rupture=rupture_name.rsplit('.',1)[0]
+                out_folder=home+project_name+'/output/waveforms/'+rupture+'/'
+                makedirs(out_folder,exist_ok=True)
+                current_source=ksource
+            
+            tr=hfsims_waveform(fault,N,M0,sta[ksta],sta_lon[ksta],sta_lat[ksta],comp[kcomp],structure,velmod,
+                        epicenter,time_epi,rise_time_depths,total_duration,hf_dt,stress_parameter,
+                        station_kappa[ksta],Qexp,Pwave,Swave,Qmethod,scattering,Qc_exp,baseline_Qc,
+                        ray_cache=rays)
+            tr.write(out_folder+sta[ksta]+'.HN'+comp[kcomp]+'.mpi.sac',format='SAC')
+        
+        #Save new rays after every task so they survive a crash
+        if ray_cache==True:
+            Nsaved=save_ray_cache(home,project_name,model_name,Qmethod,rays,Nsaved,rank)
+
     
 #If main entry point
 if __name__ == '__main__':
@@ -656,10 +985,42 @@ if __name__ == '__main__':
         scattering=sys.argv[24]
         Qc_exp=float(sys.argv[25])
         baseline_Qc=float(sys.argv[26])
+        ray_cache=sys.argv[27]=='True'
         run_parallel_hfsims(home,project_name,rupture_name,N,M0,sta,sta_lon,sta_lat,component,model_name,
                             rise_time_depths0,rise_time_depths1,moho_depth_in_km,total_duration,hf_dt,
                             stress_parameter,kappa,Qexp,Pwave,Swave,high_stress_depth,Qmethod,scattering,
-                            Qc_exp,baseline_Qc,rank,size)
+                            Qc_exp,baseline_Qc,rank,size,ray_cache)
+    elif sys.argv[1]=='run_hfsims_queue':
+        #Parse command line arguments
+        home=sys.argv[2]
+        project_name=sys.argv[3]
+        rupture_list=sys.argv[4]
+        GF_list=sys.argv[5]
+        model_name=sys.argv[6]
+        rise_time_depths0=int(sys.argv[7])
+        rise_time_depths1=int(sys.argv[8])
+        moho_depth_in_km=float(sys.argv[9])
+        total_duration=float(sys.argv[10])
+        hf_dt=float(sys.argv[11])
+        stress_parameter=float(sys.argv[12])
+        kappa=sys.argv[13]
+        if kappa=='None':
+            kappa=None
+        elif kappa!='gflist':
+            kappa=float(kappa)
+        Qexp=float(sys.argv[14])
+        Pwave=sys.argv[15]=='True'
+        Swave=sys.argv[16]=='True'
+        high_stress_depth=float(sys.argv[17])
+        Qmethod=sys.argv[18]
+        scattering=sys.argv[19]
+        Qc_exp=float(sys.argv[20])
+        baseline_Qc=float(sys.argv[21])
+        hot_start=int(sys.argv[22])
+        ray_cache=sys.argv[23]=='True'
+        run_hfsims_queue(home,project_name,rupture_list,GF_list,model_name,rise_time_depths0,rise_time_depths1,
+                         moho_depth_in_km,total_duration,hf_dt,stress_parameter,kappa,Qexp,Pwave,Swave,
+                         high_stress_depth,Qmethod,scattering,Qc_exp,baseline_Qc,hot_start,comm,ray_cache)
     else:
         print("ERROR: You're not allowed to run "+sys.argv[1]+" from the shell or it does not exist")
         
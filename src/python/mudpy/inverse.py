@@ -17,7 +17,7 @@ Functions in this module:
 
 
 def getG(home,project_name,fault_name,model_name,GF_list,G_from_file,G_name,epicenter,rupture_speed,
-        num_windows,decimate,bandpass,tsunami=False,onset_file=None):
+        num_windows,decimate,bandpass,tsunami=False,onset_file=None,G_dtype=None,mmap=False):
     '''
     Assemble Green functions matrix. If requested will parse all available synthetics on file and build the matrix.
     Otherwise, if it exists, it will be loaded from file 
@@ -36,12 +36,16 @@ def getG(home,project_name,fault_name,model_name,GF_list,G_from_file,G_name,epic
         rupture_speed: Fastest rupture speed allowed in the problem
         num_windows: Number of temporal rupture windows allowed
         decimate: Constant decimationf actor applied to GFs, set =0 for no decimation
+        G_dtype: If not None (e.g. 'float32') G is saved with this precision
+        mmap: If True G is returned memory mapped from the .npy file instead of
+            being held in RAM, use with normal_equations() and blocked_dot()
         
     OUT:
         G: Fully assembled GF matrix
     '''
     
-    from numpy import arange,genfromtxt,where,loadtxt,array,c_,concatenate,save,load,size,tile,expand_dims
+    from numpy import arange,genfromtxt,where,loadtxt,array,c_,concatenate,save,load,size,tile,expand_dims,zeros
+    from numpy.lib.format import open_memmap
     from os import remove
     from os.path import split
     
@@ -52,7 +56,10 @@ def getG(home,project_name,fault_name,model_name,GF_list,G_from_file,G_name,epic
             K_name=K_name+'.npy'
             G_name=G_name+'.npy'
         print('Loading G from file '+G_name)
-        G=load(G_name)
+        if mmap==True:
+            G=load(G_name,mmap_mode='r')
+        else:
+            G=load(G_name)
         #K=load(K_name)
     else: #assemble G one data type at a time
         print('Assembling G from synthetic computations...')
@@ -113,23 +120,18 @@ def getG(home,project_name,fault_name,model_name,GF_list,G_from_file,G_name,epic
                 delay_multiplier=tile(arange(0,num_windows),(len(trise),1)).T
                 trupt=tile(trise/2,(num_windows,1))
                 trupt=trupt*delay_multiplier
+                tdelay=zeros((num_windows,len(trise)))
                 for krup in range(num_windows):
-                    print('Working on window '+str(krup+1))
                     if onset_file==None: #There is no onset times file, caluclate them
-                        tdelay=epi2subfault(epicenter,source,rupture_speed,trupt[krup,:])
+                        tdelay[krup,:]=epi2subfault(epicenter,source,rupture_speed,trupt[krup,:])
                     else: #use provided onset times and add time window delay
-                        tdelay =  tdelay_constant+trupt[krup,:]
-                    if krup==0: #First rupture speed
-                        first_window=True
-                        Ess=[] ; Eds=[] ; Nss=[] ; Nds=[] ; Zss=[] ; Zds=[]
-                        Gdisp_temp,Ess,Eds,Nss,Nds,Zss,Zds = makeG(home,project_name,fault_name,model_name,split(mini_station)[1],
-                                                                gftype,tsunami,tdelay,decimate,bandpass,first_window,Ess,Eds,Nss,Nds,Zss,Zds)
-                        Gdisp=Gdisp_temp
-                    else:
-                        first_window=False
-                        Gdisp_temp,Ess,Eds,Nss,Nds,Zss,Zds = makeG(home,project_name,fault_name,model_name,split(mini_station)[1],
-                                                                gftype,tsunami,tdelay,decimate,bandpass,first_window,Ess,Eds,Nss,Nds,Zss,Zds)
-                        Gdisp=c_[Gdisp,Gdisp_temp]
+                        tdelay[krup,:]=tdelay_constant+trupt[krup,:]
+                #GFs are read and filtered once, every window is a time shifted copy
+                print('Working on '+str(num_windows)+' windows')
+                first_window=True
+                Ess=[] ; Eds=[] ; Nss=[] ; Nds=[] ; Zss=[] ; Zds=[]
+                Gdisp,Ess,Eds,Nss,Nds,Zss,Zds = makeG(home,project_name,fault_name,model_name,split(mini_station)[1],
+                                                        gftype,tsunami,tdelay,decimate,bandpass,first_window,Ess,Eds,Nss,Nds,Zss,Zds)
                 remove(mini_station) #Cleanup 
         #Velocity waveforms
         kgf=4
@@ -151,23 +153,18 @@ def getG(home,project_name,fault_name,model_name,GF_list,G_from_file,G_name,epic
                 delay_multiplier=tile(arange(0,num_windows),(len(trise),1)).T
                 trupt=tile(trise/2,(num_windows,1))
                 trupt=trupt*delay_multiplier
+                tdelay=zeros((num_windows,len(trise)))
                 for krup in range(num_windows):
-                    print('Working on window '+str(krup+1))
                     if onset_file==None: #There is no onset times file, caluclate them
-                        tdelay=epi2subfault(epicenter,source,rupture_speed,trupt[krup,:])
+                        tdelay[krup,:]=epi2subfault(epicenter,source,rupture_speed,trupt[krup,:])
                     else: #use provided onset times and add time window delay
-                        tdelay =  tdelay_constant+trupt[krup,:]
-                    if krup==0: #First rupture speed
-                        first_window=True
-                        Ess=[] ; Eds=[] ; Nss=[] ; Nds=[] ; Zss=[] ; Zds=[]
-                        Gvel_temp,Ess,Eds,Nss,Nds,Zss,Zds = makeG(home,project_name,fault_name,model_name,mini_station.split('/')[-1],
-                                                                gftype,tsunami,tdelay,decimate,bandpass,first_window,Ess,Eds,Nss,Nds,Zss,Zds)
-                        Gvel=Gvel_temp
-                    else:
-                        first_window=False
-                        Gvel_temp,Ess,Eds,Nss,Nds,Zss,Zds = makeG(home,project_name,fault_name,model_name,mini_station.split('/')[-1],
-                                                                gftype,tsunami,tdelay,decimate,bandpass,first_window,Ess,Eds,Nss,Nds,Zss,Zds)
-                        Gvel=c_[Gvel,Gvel_temp]
+                        tdelay[krup,:]=tdelay_constant+trupt[krup,:]
+                #GFs are read and filtered once, every window is a time shifted copy
+                print('Working on '+str(num_windows)+' windows')
+                first_window=True
+                Ess=[] ; Eds=[] ; Nss=[] ; Nds=[] ; Zss=[] ; Zds=[]
+                Gvel,Ess,Eds,Nss,Nds,Zss,Zds = makeG(home,project_name,fault_name,model_name,mini_station.split('/')[-1],
+                                                        gftype,tsunami,tdelay,decimate,bandpass,first_window,Ess,Eds,Nss,Nds,Zss,Zds)
                 remove(mini_station) #Cleanup 
         #Tsunami waveforms
         kgf=5
@@ -247,7 +244,21 @@ def getG(home,project_name,fault_name,model_name,GF_list,G_from_file,G_name,epic
             print(Ginsar.shape)
             G=concatenate([g for g in [Gstatic,Gdisp,Gvel,Gtsun,Ginsar] if g.size > 0])
         print('Saving GF matrix to '+G_name+' this might take just a second...')
-        save(G_name,G)
+        if G_dtype is None and mmap==False:
+            save(G_name,G)
+        else:
+            if G_name[-3:]!='npy':
+                G_name=G_name+'.npy'
+            #Write one block of rows at a time so a reduced precision copy of G is never held in memory
+            if G_dtype is None:
+                G_dtype=G.dtype
+            Gstore=open_memmap(G_name,mode='w+',dtype=G_dtype,shape=G.shape)
+            for krow in range(0,G.shape[0],4096):
+                Gstore[krow:krow+4096,:]=G[krow:krow+4096,:]
+            Gstore.flush()
+            del Gstore
+            if mmap==True: #Release the in memory G
+                G=load(G_name,mmap_mode='r')
         #save(K_name,K)
     return G
     
@@ -266,13 +277,15 @@ def makeG(home,project_name,fault_name,model_name,station_file,gftype,tsunami,td
         station_file: File with coordinates of stations and data types
         gftype: ='static' if assembling static field GFs, ='disp' if assembling displacement
             waveforms. ='vel' if assembling velocity waveforms.
-        tdelay: Vector of delay times to be applied to each time window
+        tdelay: Vector of delay times to be applied to each time window. For disp or vel
+            waveforms this can be an array of shape (num_windows,Nfaults), the GFs are then
+            read and filtered once and G has the columns of all windows side by side
         decimate: Constant decimationf actor applied to GFs, set =0 for no decimation
        
     OUT:
         G: Partially assembled GF with all synthetics from a particular data type
     '''
-    from numpy import genfromtxt,loadtxt,zeros,array,inf,size,where
+    from numpy import genfromtxt,loadtxt,zeros,array,inf,size,einsum,atleast_2d
     from obspy import read,Stream,Trace
     from mudpy.forward import tshift
     from mudpy.forward import lowpass as lfilt
@@ -293,110 +306,27 @@ def makeG(home,project_name,fault_name,model_name,station_file,gftype,tsunami,td
         staname=array([staname])
         datafiles=array([datafiles])
     insert_position=0
-    #Initalize G for faster assignments
-    if gftype.lower()=='static': #Initialize output matrix
-        G=zeros((Nsta*3,Nfaults*2))
-    elif gftype.lower()=='insar': #Initialize output matrix
-        G=zeros((Nsta,Nfaults*2))
-    else:
-        pass #For disp or vel waveforms G is initalized below
+    #Static and InSAR G are sliced out of the GF store, for disp or vel waveforms G is initalized below
     if gftype.lower()=='static': #Make matrix of static GFs
-        for ksta in range(Nsta):
-            print('Assembling static GFs for station '+staname[ksta])
-            #Initalize output variable
-            Gtemp=zeros([3,Nfaults*2])
-            #Where's the data
-            statics_path=home+project_name+'/GFs/static/'
-            #Loop over subfaults
-            for kfault in range(Nfaults):
-                
-                nsub='sub'+str(int(source[kfault,0])).rjust(4,'0')
-                nfault='subfault'+str(int(source[kfault,0])).rjust(4,'0')
-                strdepth='%.4f' % source[kfault,3]
-                syn_path=statics_path+model_name+'_'+strdepth+'.'+nsub+'/'
-                
-                                
-                if kfault%10==0:
-                    print('... working on subfault '+str(kfault)+' of '+str(Nfaults))
-                
-                nfault='subfault'+str(int(source[kfault,0])).rjust(4,'0')
-                
-                coseis_ss=loadtxt(syn_path+nfault+'.SS.static.neu',usecols=[1,2,3])
-                coseis_ds=loadtxt(syn_path+nfault+'.DS.static.neu',usecols=[1,2,3])
-                coseis_sta=loadtxt(syn_path+nfault+'.SS.static.neu',usecols=0,dtype='U')
-                                
-                #Find row corresponding to station
-                ista=where(coseis_sta==staname[ksta])[0]
-                
-                #get values
-                nss=coseis_ss[ista,0]
-                ess=coseis_ss[ista,1]
-                zss=coseis_ss[ista,2]
-                
-                nds=coseis_ds[ista,0]
-                eds=coseis_ds[ista,1]
-                zds=coseis_ds[ista,2]
-
-                
-                #Place into G matrix
-                # print(nss)
-                Gtemp[0,2*kfault]=nss   ; Gtemp[0,2*kfault+1]=nds    #North
-                Gtemp[1,2*kfault]=ess ; Gtemp[1,2*kfault+1]=eds  #East
-                Gtemp[2,2*kfault]=zss ; Gtemp[2,2*kfault+1]=zds  #Up
-                #Append to G
-            #Append to output matrix
-            G[ksta*3:ksta*3+3,:]=Gtemp   
+        print('Assembling static GFs for '+str(Nsta)+' stations from GF store')
+        store=make_static_GF_store(home,project_name,fault_name,model_name,staname,gftype='static')
+        ista,ifault=static_GF_store_index(store,staname,source)
+        #(Nsta,Nfaults,rake,neu) -> rows are station-major neu, columns are subfault-major ss,ds
+        Gs=store['GF'][ista][:,ifault]
+        G=Gs.transpose(0,3,1,2).reshape(Nsta*3,Nfaults*2)
         return G   
     if gftype.lower()=='insar': #Make matrix of insar LOS GFs
+        print('Assembling InSAR GFs for '+str(Nsta)+' stations from GF store')
+        store=make_static_GF_store(home,project_name,fault_name,model_name,staname,gftype='insar')
+        ista,ifault=static_GF_store_index(store,staname,source)
+        #Data path, need this to find LOS vector
+        los_path=home+project_name+'/data/statics/'
+        los=zeros((Nsta,3))
         for ksta in range(Nsta):
-            print('Assembling static GFs for station '+staname[ksta])
-            #Initalize output variable
-            Gtemp=zeros([1,Nfaults*2])
-            #Where's the data
-            statics_path=home+project_name+'/GFs/static/'
-            #Data path, need this to find LOS vector
-            los_path=home+project_name+'/data/statics/'
-            #Read los vector for this subfault
-            los=genfromtxt(los_path+staname[ksta]+'.los')
-            los=los[1:]
-            #Loop over subfaults
-            for kfault in range(Nfaults):
-                
-                nsub='sub'+str(int(source[kfault,0])).rjust(4,'0')
-                nfault='subfault'+str(int(source[kfault,0])).rjust(4,'0')
-                strdepth='%.4f' % source[kfault,3]
-                syn_path=statics_path+model_name+'_'+strdepth+'.'+nsub+'/'
-                
-                
-                if kfault%10==0:
-                    print('... working on subfault '+str(kfault)+' of '+str(Nfaults))
-                nfault='subfault'+str(int(source[kfault,0])).rjust(4,'0')
-                
-                coseis_ss=loadtxt(syn_path+nfault+'.SS.insar.neu',usecols=[1,2,3])
-                coseis_ds=loadtxt(syn_path+nfault+'.DS.insar.neu',usecols=[1,2,3])
-                coseis_sta=loadtxt(syn_path+nfault+'.SS.insar.neu',usecols=0,dtype='U')
-                
-                #Find row corresponding to station
-                ista=where(coseis_sta==staname[ksta])[0]
-                
-                #get values
-                nss=coseis_ss[ista,0]
-                ess=coseis_ss[ista,1]
-                zss=coseis_ss[ista,2]
-                
-                nds=coseis_ds[ista,0]
-                eds=coseis_ds[ista,1]
-                zds=coseis_ds[ista,2]
-                
-                # Dot product of GFs and los vector
-                los_ss=los.dot(array([nss,ess,zss]))
-                los_ds=los.dot(array([nds,eds,zds]))
-                
-                #Place into G matrix
-                Gtemp[0,2*kfault]=los_ss   ; Gtemp[0,2*kfault+1]=los_ds  
-                #Append to G
-            #Append to output matrix
-            G[ksta*1,:]=Gtemp   
+            los[ksta,:]=genfromtxt(los_path+staname[ksta]+'.los')[1:]
+        # Dot product of GFs and los vector
+        Gs=store['GF'][ista][:,ifault]
+        G=einsum('sc,sfrc->sfr',los,Gs).reshape(Nsta,Nfaults*2)
         return G  
     if gftype.lower()=='disp' or gftype.lower()=='vel':  #Full waveforms
         if gftype.lower()=='disp':
@@ -527,64 +457,33 @@ def makeG(home,project_name,fault_name,model_name,station_file,gftype,tsunami,td
                 Ndata+=ndata
                 Udata+=udata            
         #Finished reading, filtering, etc now time shift by rupture time and resmaple to data
-        ktrace=0
+        #tdelay can hold one row of delays per time window, all windows are aligned in one pass
+        tdelay=atleast_2d(tdelay)
+        Nwindows=tdelay.shape[0]
         print("Aligning GFs and resampling to data times...")
+        G=gdims(datafiles,Nfaults*Nwindows,decimate) #Survey all stations to decide size of G
+        ktrace=0
         for ksta in range(Nsta):
-            #Loop over subfaults
+            #How many points left in the tiem series
+            npts=Edata[ksta].stats.npts
             print('...Working on station #'+str(ksta+1)+' of '+str(Nsta))
+            print("... ... "+str(npts)+" data points left over after decimation")
+            north=slice(insert_position,insert_position+npts)
+            east=slice(insert_position+npts,insert_position+2*npts)
+            up=slice(insert_position+2*npts,insert_position+3*npts)
+            #Loop over subfaults and windows
             for kfault in range(Nfaults):
-                #Assign current GFs
-                ess=Stream(Trace())
-                nss=Stream(Trace())
-                zss=Stream(Trace())
-                eds=Stream(Trace())
-                nds=Stream(Trace())
-                zds=Stream(Trace())
-                ess[0]=Ess[ktrace].copy()
-                nss[0]=Nss[ktrace].copy()
-                zss[0]=Zss[ktrace].copy()
-                eds[0]=Eds[ktrace].copy()
-                nds[0]=Nds[ktrace].copy()
-                zds[0]=Zds[ktrace].copy()
-                #Time shift them according to subfault rupture time, zero pad, round to dt interval,decimate
-                #and extend to maximum time
-                ess=tshift(ess,tdelay[kfault])
-                nss=tshift(nss,tdelay[kfault])
-                zss=tshift(zss,tdelay[kfault])
-                eds=tshift(eds,tdelay[kfault])
-                nds=tshift(nds,tdelay[kfault])
-                zds=tshift(zds,tdelay[kfault])
-                #Now time align stuff                                
-                ess=resample_to_data(ess[0],Edata[ksta])
-                ess=prep_synth(ess,Edata[ksta])
-                nss=resample_to_data(nss[0],Ndata[ksta])
-                nss=prep_synth(nss,Ndata[ksta])
-                zss=resample_to_data(zss[0],Udata[ksta])
-                zss=prep_synth(zss,Udata[ksta])
-                eds=resample_to_data(eds[0],Edata[ksta])
-                eds=prep_synth(eds,Edata[ksta])
-                nds=resample_to_data(nds[0],Ndata[ksta])
-                nds=prep_synth(nds,Ndata[ksta])
-                zds=resample_to_data(zds[0],Udata[ksta])
-                zds=prep_synth(zds,Udata[ksta])
-                #Insert into Gtemp then append to G
-                if kfault==0 and ksta==0: #It's the first subfault and station, initalize G
-                    G=gdims(datafiles,Nfaults,decimate) #Survey all stations to decide size of G
-                if kfault==0: #Initalize Gtemp (different size for each station)
-                    #How many points left in the tiem series
-                    npts=Edata[ksta].stats.npts
-                    print("... ... "+str(npts)+" data points left over after decimation")
-                    Gtemp=zeros([3*npts,Nfaults*2])      
-                #Insert synthetics into Gtemp
-                Gtemp[0:npts,2*kfault]=nss.data
-                Gtemp[0:npts,2*kfault+1]=nds.data
-                Gtemp[npts:2*npts,2*kfault]=ess.data
-                Gtemp[npts:2*npts,2*kfault+1]=eds.data
-                Gtemp[2*npts:3*npts,2*kfault]=zss.data
-                Gtemp[2*npts:3*npts,2*kfault+1]=zds.data
+                for kwin in range(Nwindows):
+                    #Time shift according to subfault rupture time and cut to data times
+                    iss=2*(kwin*Nfaults+kfault)
+                    ids=iss+1
+                    G[north,iss]=align_to_data(Nss[ktrace],Ndata[ksta],tdelay[kwin,kfault])
+                    G[north,ids]=align_to_data(Nds[ktrace],Ndata[ksta],tdelay[kwin,kfault])
+                    G[east,iss]=align_to_data(Ess[ktrace],Edata[ksta],tdelay[kwin,kfault])
+                    G[east,ids]=align_to_data(Eds[ktrace],Edata[ksta],tdelay[kwin,kfault])
+                    G[up,iss]=align_to_data(Zss[ktrace],Udata[ksta],tdelay[kwin,kfault])
+                    G[up,ids]=align_to_data(Zds[ktrace],Udata[ksta],tdelay[kwin,kfault])
                 ktrace+=1
-            #After looping through all subfaults Insert Gtemp into G
-            G[insert_position:insert_position+3*npts,:]=Gtemp
             insert_position+=3*npts #Update for next station
         return G,Ess,Eds,Nss,Nds,Zss,Zds
     
@@ -674,10 +573,144 @@ def makeG(home,project_name,fault_name,model_name,station_file,gftype,tsunami,td
             insert_position+=npts #Update for next station
         return G,SS,DS             
     if gftype.lower()=='strain':
-        pass                                
-      
-      
-def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False):
+        pass
+
+
+def make_static_GF_store(home,project_name,fault_name,model_name,stations,gftype='static',update=False):
+    '''
+    Collect the per subfault static or InSAR .neu GFs into a single array stored in
+    GFs/static/<model_name>.<fault_name>.<gftype>.npz so that makeG can slice G out of
+    one file instead of opening every subfault file for every station.
+
+    If the store already exists only stations not yet in it are read from the .neu
+    files and appended (incremental update). With update=True the requested stations
+    are re-read even if present, this is what the GF step does after recomputing
+    synthetics. The modification time of every .neu file is kept in the store and
+    all stored stations of a subfault whose files changed since are re-read. If the
+    fault geometry changed the store is rebuilt from scratch.
+
+    IN:
+        home: Home directory
+        project_name: Name of the problem
+        fault_name: Name of fault description file
+        model_name: Name of velocity structure file
+        stations: Array of station names that need to be in the store
+        gftype: ='static' for GNSS offsets, ='insar' for InSAR points
+        update: If True re-read the requested stations even if already stored
+
+    OUT:
+        store: dict with 'stations' (Nsta), 'subfaults' (Nfaults), 'depths' (Nfaults)
+            and 'GF' of shape (Nsta,Nfaults,2,3) ordered as (station,subfault,ss/ds,n/e/u),
+            'mtimes' (Nfaults,2) holds the SS/DS .neu modification times when read
+    '''
+    from numpy import loadtxt,load,savez,zeros,array,atleast_1d,concatenate,isin,full
+    from os import path,makedirs,stat
+
+    source=loadtxt(home+project_name+'/data/model_info/'+fault_name,ndmin=2)
+    Nfaults=source.shape[0]
+    subfaults=source[:,0].astype('int')
+    depths=array(['%.4f' % z for z in source[:,3]])
+    stations=atleast_1d(array(stations,dtype='U'))
+    statics_path=home+project_name+'/GFs/static/'
+    store_file=statics_path+model_name+'.'+fault_name+'.'+gftype+'.npz'
+    neu_files=[]
+    for kfault in range(Nfaults):
+        nsub='sub'+str(subfaults[kfault]).rjust(4,'0')
+        nfault='subfault'+str(subfaults[kfault]).rjust(4,'0')
+        syn_path=statics_path+model_name+'_'+depths[kfault]+'.'+nsub+'/'
+        neu_files.append([syn_path+nfault+'.'+rake+'.'+gftype+'.neu' for rake in ['SS','DS']])
+    #Modification times of the .neu files as they are now, -1 if missing
+    mtimes=array([[stat(f).st_mtime_ns if path.exists(f) else -1 for f in files] for files in neu_files],dtype='int64')
+
+    #Load existing store if it matches the current fault geometry
+    store=None
+    if path.exists(store_file):
+        f=load(store_file)
+        store={'stations':f['stations'],'subfaults':f['subfaults'],'depths':f['depths'],'GF':f['GF']}
+        if 'mtimes' in f.files:
+            store['mtimes']=f['mtimes']
+        else:
+            store['mtimes']=full((len(store['subfaults']),2),-2,dtype='int64')
+        f.close()
+        if len(store['subfaults'])!=Nfaults or (store['subfaults']!=subfaults).any() or (store['depths']!=depths).any():
+            print('... fault geometry changed, rebuilding '+gftype+' GF store')
+            store=None
+    if store is None:
+        store={'stations':array([],dtype='U'),'subfaults':subfaults,'depths':depths,'GF':zeros((0,Nfaults,2,3)),
+                'mtimes':full((Nfaults,2),-2,dtype='int64')}
+
+    #Which stations have to be read from the .neu files
+    if update==True:
+        new_sta=stations
+    else:
+        new_sta=stations[~isin(stations,store['stations'])]
+    #Subfaults whose .neu files changed after they went in the store
+    stale=(store['mtimes']!=mtimes).any(axis=1) & (len(store['stations'])>0)
+    if len(new_sta)==0 and not stale.any():
+        return store
+
+    #Append the new stations, every subfault then reads its rows of new_sta and
+    #a stale subfault also re-reads the stored stations its .neu files still have
+    #(synthetics runs rewrite them with only the stations they computed)
+    all_sta=concatenate([store['stations'],new_sta[~isin(new_sta,store['stations'])]])
+    GF=zeros((len(all_sta),Nfaults,2,3))
+    GF[:len(store['stations'])]=store['GF']
+    row={sta:k for k,sta in enumerate(all_sta)}
+    inew=array([row[sta] for sta in new_sta],dtype='int')
+    if stale.any():
+        print('... .neu files changed for '+str(stale.sum())+' subfaults, re-reading them')
+    print('Reading '+gftype+' GFs for '+str(len(new_sta))+' stations into GF store '+store_file)
+    for kfault in range(Nfaults):
+        if kfault%100==0:
+            print('... working on subfault '+str(kfault)+' of '+str(Nfaults))
+        if len(new_sta)==0 and not stale[kfault]:
+            continue
+        for krake in range(2):
+            coseis=loadtxt(neu_files[kfault][krake],dtype='U',usecols=[0,1,2,3],ndmin=2)
+            neu_row={sta:k for k,sta in enumerate(coseis[:,0])}
+            try:
+                ista=array([neu_row[sta] for sta in new_sta],dtype='int')
+            except KeyError as e:
+                raise ValueError('station '+str(e.args[0])+' not found in '+neu_files[kfault][krake])
+            GF[inew,kfault,krake,:]=coseis[ista,1:4].astype('float')
+            if stale[kfault]:
+                iread=array([k for k,sta in enumerate(all_sta) if sta in neu_row],dtype='int')
+                ista=array([neu_row[all_sta[k]] for k in iread],dtype='int')
+                GF[iread,kfault,krake,:]=coseis[ista,1:4].astype('float')
+    store['stations']=all_sta
+    store['GF']=GF
+    store['mtimes']=mtimes
+    if not path.exists(statics_path):
+        makedirs(statics_path)
+    savez(store_file,**store)
+
+    return store
+
+
+def static_GF_store_index(store,stations,source):
+    '''
+    Locate stations and subfaults in a static GF store
+
+    IN:
+        store: dict returned by make_static_GF_store
+        stations: Array of station names in the order they should appear in G
+        source: Fault model array, subfault numbers in the first column
+
+    OUT:
+        ista: Row of each station in store['GF']
+        ifault: Column of each subfault in store['GF']
+    '''
+    from numpy import array,atleast_1d
+
+    row={sta:k for k,sta in enumerate(store['stations'])}
+    col={int(sub):k for k,sub in enumerate(store['subfaults'])}
+    ista=array([row[sta] for sta in atleast_1d(stations)],dtype='int')
+    ifault=array([col[int(sub)] for sub in source[:,0]],dtype='int')
+
+    return ista,ifault
+
+
+def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False,return_layout=False):
     '''
     Assemble the data vector for all data types
     
@@ -686,11 +719,19 @@ def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False):
         project_name: Name of the problem
         GF_list: Name of GF control file
         decimate: Constant decimationf actor applied to GFs, set =0 for no decimation
+        return_layout: If True also return the layout of d, see below
         
     OUT:
         d: The data vector
-    '''
-    from numpy import genfromtxt,where,array,append,r_,concatenate,zeros
+        layout: Only if return_layout=True. A dictionary of arrays with one entry 
+            per data segment (a single station component) in the order they appear in d:
+            'station', 'component' (n,e,u,tsun or los), 'data_type' (0 static, 
+            1 displacement, 2 velocity, 3 tsunami, 4 InSAR), 'start' and 'npts'
+            (the segment is d[start:start+npts]) and 'sigma' (the uncertainty 
+            from the GF_list, nan if the GF_list has no weight columns). It lets
+            get_data_weights(), get_VR() and get_RMS() work without reading files.
+    '''
+    from numpy import genfromtxt,where,array,append,r_,concatenate,zeros,ones,nan,cumsum
     from obspy import read
     from mudpy.forward import round_time
     from mudpy.green import stdecimate
@@ -702,6 +743,23 @@ def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False):
     GF=genfromtxt(gf_file,usecols=[3,4,5,6,7],skip_header=1,dtype='f8')
     GFfiles=genfromtxt(gf_file,usecols=[8,9,10,11,12],dtype='U')  
     stations=genfromtxt(gf_file,usecols=0,dtype='U')  
+    try:
+        sigmas=genfromtxt(gf_file,usecols=range(13,24),dtype='f8',ndmin=2)
+    except:
+        sigmas=nan*ones((len(GF),11))
+    
+    #Layout of the data vector, one entry per segment
+    segment_station=[]
+    segment_component=[]
+    segment_type=[]
+    segment_npts=[]
+    segment_sigma=[]
+    def add_segment(station,component,data_type,npts,sigma):
+        segment_station.append(station)
+        segment_component.append(component)
+        segment_type.append(data_type)
+        segment_npts.append(npts)
+        segment_sigma.append(sigma)
     
     #Parse out filtering pass bands
     displacement_bandpass=bandpass[0]
@@ -720,6 +778,8 @@ def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False):
         e=dtemp[1]
         u=dtemp[2]
         dstatic=append(dstatic,r_[n,e,u])
+        for kcomp,comp in enumerate(['n','e','u']):
+            add_segment(stations[i[ksta]],comp,kgf,1,sigmas[i[ksta],kcomp])
     
     #Displacements
     kgf=1
@@ -761,6 +821,8 @@ def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False):
         n[0].stats.starttime=round_time(n[0].stats.starttime,dt)
         u[0].stats.starttime=round_time(u[0].stats.starttime,dt)
         ddisp=append(ddisp,r_[n[0].data,e[0].data,u[0].data])
+        for kcomp,comp in enumerate(['n','e','u']):
+            add_segment(stations[i[ksta]],comp,kgf,[n,e,u][kcomp][0].stats.npts,sigmas[i[ksta],3+kcomp])
     
     #Velocities
     kgf=2
@@ -788,6 +850,8 @@ def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False):
         n[0].stats.starttime=round_time(n[0].stats.starttime,dt)
         u[0].stats.starttime=round_time(u[0].stats.starttime,dt)
         dvel=append(dvel,r_[n[0].data,e[0].data,u[0].data])
+        for kcomp,comp in enumerate(['n','e','u']):
+            add_segment(stations[i[ksta]],comp,kgf,[n,e,u][kcomp][0].stats.npts,sigmas[i[ksta],6+kcomp])
     
     #Tsunami
     kgf=3
@@ -802,6 +866,7 @@ def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False):
             tsun[0].data=lfilt(tsun[0].data,tsunami_bandpass,fsample,2)
             
         dtsun=append(dtsun,tsun)
+        add_segment(stations[i[ksta]],'tsun',kgf,tsun[0].stats.npts,sigmas[i[ksta],9])
     
     #InSAR LOS
     kgf=4
@@ -813,14 +878,21 @@ def getdata(home,project_name,GF_list,decimate,bandpass,quiet=False):
         dtemp=genfromtxt(GFfiles[i[ksta],kgf])
         los=dtemp[0]
         dlos=append(dlos,los)          
+        add_segment(stations[i[ksta]],'los',kgf,1,sigmas[i[ksta],10])
     #Done, concatenate all, convert to column vector and exit
     d=concatenate([dx for dx in [dstatic,ddisp,dvel,dtsun,dlos] if dx.size > 0])
     D=zeros((d.shape[0],1))
     D[:,0]=d
+    if return_layout==True:
+        npts=array(segment_npts,dtype='int')
+        layout={'station':array(segment_station,dtype='U'),'component':array(segment_component,dtype='U'),
+                'data_type':array(segment_type,dtype='int'),'start':r_[0,cumsum(npts)[:-1]].astype('int'),
+                'npts':npts,'sigma':array(segment_sigma,dtype='f8')}
+        return D,layout
     return D
           
     
-def getLs(home,project_name,fault_name,nfaults,num_windows,bounds):
+def getLs(home,project_name,fault_name,nfaults,num_windows,bounds,sparse=False,neighbors=None):
     '''
     Make spatial regularization matrix based on finite difference Lapalce operator.
     This routine will request adjustments depending on the boundary conditions requested
@@ -837,39 +909,60 @@ def getLs(home,project_name,fault_name,nfaults,num_windows,bounds):
             Possible values for each element of the tuple are 'free' for a free boundary condition
             and 'locked' for a locked one. For example a bounds tuple with 3 locked edges and the top
             edge free would be bounds=('free', 'locked', 'locked', 'locked')
+        sparse: If True return a scipy.sparse CSR matrix, the operator is never
+            held as a dense array
+        neighbors: Optional list with the indices of the neighbors of each subfault
+            for meshes that are not a regular nstrike x ndip grid. Each row of the
+            operator is then 1 on the neighbors and minus the largest number of 
+            neighbors on the diagonal so missing neighbors on the edges act as locked,
+            like the regular stencil does. bounds is not used in this case.
 
     OUT:
         Lout: The regularization matrix
     '''
     
-    from numpy import loadtxt,zeros,tile
+    from numpy import loadtxt,r_,ones,concatenate,atleast_1d
+    from scipy.sparse import coo_matrix,hstack
     
     #Load source
     source=loadtxt(home+project_name+'/data/model_info/'+fault_name,ndmin=2)
     N=len(source) #No. of subfaults
     nstrike=nfaults[0]
     ndip=nfaults[1]
-    #Initalize
-    L=zeros((2*N,2*N))
+    if neighbors is not None:
+        max_neighbors=max([len(neighbors[k]) for k in range(N)])
     #Which L am I building?
     print('Making discrete Laplace operator regularization matrix...')
-    for kfault in range(N):#Loop over faults and fill regularization matrix
-        stencil,values=laplace_stencil(kfault,nstrike,ndip,bounds)
+    rows=[]
+    columns=[]
+    entries=[]
+    for kfault in range(N):#Loop over faults and collect the non-zero entries
+        if neighbors is None:
+            stencil,values=laplace_stencil(kfault,nstrike,ndip,bounds)
+        else:
+            stencil=r_[kfault,neighbors[kfault]].astype('int')
+            values=r_[-max_neighbors,ones(len(neighbors[kfault]))]
+        stencil=atleast_1d(stencil).astype('int')
+        values=atleast_1d(values).astype('float')
         #Add strike slip branches of stencil
-        L[2*kfault,2*stencil]=values
+        rows.append(2*kfault*ones(len(stencil),dtype='int'))
+        columns.append(2*stencil)
+        entries.append(values)
         #Add dip slip branches of stencil
-        L[2*kfault+1,2*stencil+1]=values
+        rows.append((2*kfault+1)*ones(len(stencil),dtype='int'))
+        columns.append(2*stencil+1)
+        entries.append(values)
+    L=coo_matrix((concatenate(entries),(concatenate(rows),concatenate(columns))),shape=(2*N,2*N)).tocsr()
     if num_windows==1: #Only one rupture speed
         Lout=L 
     else: #Multiple rupture speeds, smooth total moment laplacian
-        Lout=L
-        Lout=tile(Lout,(1,num_windows))/num_windows
-        #for k in range(num_windows-1):
-        #    Lout=block_diag(Lout,L)
+        Lout=hstack([L]*num_windows,format='csr')/num_windows
+    if sparse==False:
+        Lout=Lout.toarray()
     return Lout
         
         
-def getLt(home,project_name,fault_name,num_windows):
+def getLt(home,project_name,fault_name,num_windows,sparse=False):
     '''
     Make temporal regularization matrix using forward differences for windows 1 
     through N-1 and backwards differences for window N
@@ -879,54 +972,85 @@ def getLt(home,project_name,fault_name,num_windows):
         project_name: Name of the problem
         fault_name: Name of fault description file
         num_windows: Number of temporal slip windows
+        sparse: If True return a scipy.sparse CSR matrix
         
     OUT:
         L: A square matrix of derivatives
     '''
     
-    from numpy import loadtxt,zeros,eye,arange
+    from numpy import loadtxt
+    from scipy.sparse import csr_matrix,eye
     
     #Load source
     source=loadtxt(home+project_name+'/data/model_info/'+fault_name,ndmin=2)
     N=len(source) #No. of subfaults
     if num_windows<2: #Duh
         print('WARNING temporal regularization is unecessary when only employing 1 time window. Returning zeros.')
-        Lout=zeros((2*N,2*N))
+        Lout=csr_matrix((2*N,2*N))
+        if sparse==False:
+            Lout=Lout.toarray()
         return Lout
-    #Initalize
-    L=eye(2*N*num_windows)
-    #Ltest=zeros((N*num_windows,2*N*num_windows))
     print('Making first derivative temporal regularization matrix...')
-    #Forward difference indices
-    iforward=arange(N*2*(num_windows-1))
-    L[iforward,iforward+(2*N)]=-1
-    #
-    #i1=arange(0,N*num_windows)
-    #i2=arange(0,2*N*num_windows,2)
-    #Ltest[i1,i2]=1
-    #Ltest[i1,i2+1]=1
-    #i1=arange(0,N*num_windows-N)
-    #i2=arange(2*N,2*N*num_windows,2)
-    #Ltest[i1,i2]=-1
-    #Ltest[i1,i2+1]=-1
-    #Ltest=Ltest/2
-    #return Ltest
+    #Identity minus the forward difference indices, i.e. L[i,i+2N]=-1
+    L=eye(2*N*num_windows,format='csr')-eye(2*N*num_windows,k=2*N,format='csr')
     #
     #Backwards differences for last window
     #iback=arange(N*2*(num_windows-1),N*2*num_windows)
     #L[iback,iback-(2*N)]=-1
+    if sparse==False:
+        L=L.toarray()
     return L
 
 
-def get_data_weights(home,project_name,GF_list,d,decimate):
+def add_regularization(K,lambda_s,LsLs,lambda_t=0,LtLt=None):
+    '''
+    Form K+(lambda_s**2)*LsLs+(lambda_t**2)*LtLt as a new dense array. The 
+    regularization terms can be scipy.sparse matrices, only their non-zero
+    entries are added so no dense copy of them is ever made.
+    '''
+    
+    from numpy import array
+    from scipy.sparse import issparse
+    
+    Kinv=array(K,dtype='float')
+    for lambda_reg,LL in [(lambda_s,LsLs),(lambda_t,LtLt)]:
+        if LL is None or lambda_reg==0:
+            continue
+        if issparse(LL):
+            LL=LL.tocoo()
+            LL.sum_duplicates()
+            Kinv[LL.row,LL.col]+=(lambda_reg**2)*LL.data
+        else:
+            Kinv+=(lambda_reg**2)*LL
+    
+    return Kinv
+
+
+def get_data_weights(home,project_name,GF_list,d,decimate,type_weights=None,return_types=False,layout=None):
     '''
     Assemble matrix of data weights from sigmas of observations
+    
+    Per station and per component weights are the inverse of the sigmas in 
+    the GF_list. Optionally type_weights, a list of 5 multipliers for the 
+    static, displacement, velocity, tsunami and InSAR weights, is applied on top.
+    If return_types=True the data type (0 through 4 in that same order) of 
+    every row is returned too. If the layout from getdata() is supplied no
+    files are read.
     '''    
-    from numpy import genfromtxt,where,zeros,ones
+    from numpy import genfromtxt,where,zeros,ones,repeat
     from obspy import read
     from mudpy.green import stdecimate
 
     print('Computing data weights...')
+    if layout is not None:
+        w=repeat(1/layout['sigma'].astype('f'),layout['npts']).astype('f8')
+        data_type=repeat(layout['data_type'],layout['npts'])
+        if type_weights is not None:
+            for kgf in range(5):
+                w[data_type==kgf]*=type_weights[kgf]
+        if return_types==True:
+            return w,data_type
+        return w
     #Read gf file and decide what needs tog et loaded
     gf_file=home+project_name+'/data/station_info/'+GF_list
     GF=genfromtxt(gf_file,usecols=[3,4,5,6,7],dtype='f8')
@@ -934,20 +1058,24 @@ def get_data_weights(home,project_name,GF_list,d,decimate):
     weights=genfromtxt(gf_file,usecols=range(13,28),dtype='f')
     #Initalize
     w=zeros(len(d))
+    data_type=zeros(len(d),dtype='int')
     kinsert=0
     #Deal with decimation
     #if decimate==None:
     #    decimate=1
     #Static weights
     kgf=0
+    kstart=kinsert
     i=where(GF[:,kgf]==1)[0]
     for ksta in range(len(i)):
         w[kinsert]=1/weights[i[ksta],0] #North
         w[kinsert+1]=1/weights[i[ksta],1] #East
         w[kinsert+2]=1/weights[i[ksta],2] #Up
         kinsert=kinsert+3
+    data_type[kstart:kinsert]=0
     #Displacement waveform weights
     kgf=1
+    kstart=kinsert
     i=where(GF[:,kgf]==1)[0]
     for ksta in range(len(i)):
         #Read waveform to determine length of insert
@@ -964,8 +1092,10 @@ def get_data_weights(home,project_name,GF_list,d,decimate):
         wu=(1/weights[i[ksta],5])*ones(nsamples)
         w[kinsert:kinsert+nsamples]=wu
         kinsert=kinsert+nsamples
+    data_type[kstart:kinsert]=1
     #velocity waveform weights
     kgf=2
+    kstart=kinsert
     i=where(GF[:,kgf]==1)[0]
     for ksta in range(len(i)):
         #Read waveform to determine length of insert
@@ -986,8 +1116,10 @@ def get_data_weights(home,project_name,GF_list,d,decimate):
             print('WARNING: mismatch in data weights length')
             w[kinsert:kinsert+nsamples]=wu[:-1]  #I don't know why this happens, wu is the right length but w is too short by one but only for the last station
         kinsert=kinsert+nsamples
+    data_type[kstart:kinsert]=2
     #Tsunami
     kgf=3
+    kstart=kinsert
     i=where(GF[:,kgf]==1)[0]
     for ksta in range(len(i)):
         #Read waveform to determine length of insert
@@ -1002,15 +1134,150 @@ def get_data_weights(home,project_name,GF_list,d,decimate):
         
         w[kinsert:kinsert+nsamples]=wtsun
         kinsert=kinsert+nsamples
+    data_type[kstart:kinsert]=3
     #InSAR
     kgf=4
+    kstart=kinsert
     i=where(GF[:,kgf]==1)[0]
     for ksta in range(len(i)):
         w[kinsert]=1/weights[i[ksta],10] #LOS
         kinsert+=1
+    data_type[kstart:kinsert]=4
+    #Extra weight per data type
+    if type_weights is not None:
+        for kgf in range(5):
+            w[data_type==kgf]*=type_weights[kgf]
     #Make W and exit
+    if return_types==True:
+        return w,data_type
     return w
 
+
+def apply_data_weights(G,d,w,block_rows=4096,in_place=True):
+    '''
+    Weight the inversion in place. The rows of G are scaled by the weights in
+    blocks so that no second G-sized array (nor the diagonal weight matrix) is
+    ever made. As before the weighted data vector is normalized to unit length 
+    and G is scaled by the same factor.
+    
+    IN:
+        G: GF matrix, overwritten with W*G
+        d: Data vector
+        w: Data weights (1/sigma)
+        block_rows: Number of rows of G scaled at once
+        in_place: If False G is left alone (e.g. an out-of-core G store) and only
+            wd and row_scale are computed, pass row_scale to normal_equations()
+        
+    OUT:
+        WG: The weighted GF matrix, this is G itself unless G was read-only
+        wd: Weighted and normalized data vector
+        row_scale: The factors applied to each row, ds=WG*m/row_scale are the
+            unweighted synthetics
+    '''
+    
+    from numpy import expand_dims,array,where
+    from numpy.linalg import norm
+    
+    w=array(w,dtype='float').squeeze()
+    izero=where(w==0)[0]
+    if len(izero)>0:
+        print('WARNING: '+str(len(izero))+' data have zero weight, using a negligible weight instead')
+        w[izero]=w[w>0].min()*1e-8
+    
+    #apply data weights
+    wd=w*d.squeeze()
+    
+    #get norm after applying weights and normalize weghted data vector
+    data_norm=norm(wd)
+    wd=expand_dims(wd/data_norm,axis=1)
+    row_scale=w/data_norm
+    
+    if in_place==False:
+        return G,wd,row_scale
+    
+    #Apply weights to left hand side of the equation one block of rows at a time
+    if not G.flags.writeable:
+        G=array(G)
+    for krow in range(0,G.shape[0],block_rows):
+        G[krow:krow+block_rows,:]*=expand_dims(row_scale[krow:krow+block_rows],axis=1)
+    
+    return G,wd,row_scale
+
+
+def report_data_weights(wd,data_type=None):
+    '''
+    Print how much each data type contributes to the weighted data vector
+    '''
+    
+    from numpy import unique
+    
+    names=['static','displacement','velocity','tsunami','InSAR']
+    total=(wd**2).sum()
+    print('Effective data weights:')
+    if data_type is None:
+        print('... '+str(len(wd))+' data, no per type breakdown available')
+        return
+    for kgf in unique(data_type):
+        i=data_type==kgf
+        print('... %s: %d data, %.1f%% of weighted data norm' % (names[kgf],i.sum(),100*(wd[i]**2).sum()/total))
+
+
+def normal_equations(G,d,row_scale=None,block_rows=4096):
+    '''
+    Accumulate G'G and G'd one block of rows at a time. G can be a memory mapped
+    G store (see getG) in float32 or float64, only one block of rows is in memory 
+    at a time and all products are accumulated in float64.
+    
+    IN:
+        G: GF matrix or memory mapped GF store
+        d: Data vector, already weighted if row_scale is given
+        row_scale: Optional weights applied to each row of G as it is read
+        block_rows: Number of rows of G read at once
+        
+    OUT:
+        K: G'G (or (WG)'WG)
+        x: G'd (or (WG)'d), column vector
+    '''
+    
+    from numpy import zeros,asarray,expand_dims
+    
+    d=asarray(d,dtype='float64').reshape(-1)
+    K=zeros((G.shape[1],G.shape[1]))
+    x=zeros((G.shape[1],1))
+    for krow in range(0,G.shape[0],block_rows):
+        Gblock=asarray(G[krow:krow+block_rows,:],dtype='float64')
+        if row_scale is not None:
+            Gblock=Gblock*expand_dims(row_scale[krow:krow+block_rows],axis=1)
+        K+=Gblock.T.dot(Gblock)
+        x[:,0]+=Gblock.T.dot(d[krow:krow+block_rows])
+    
+    return K,x
+
+
+def blocked_dot(G,sol,block_rows=4096):
+    '''
+    Synthetics G*sol computed one block of rows at a time, for use with a 
+    memory mapped G store
+    
+    IN:
+        G: GF matrix or memory mapped GF store
+        sol: Model vector
+        block_rows: Number of rows of G read at once
+        
+    OUT:
+        ds: Synthetics, same number of columns as sol
+    '''
+    
+    from numpy import zeros,asarray
+    
+    sol=asarray(sol,dtype='float64')
+    ds=zeros((G.shape[0],)+sol.shape[1:])
+    for krow in range(0,G.shape[0],block_rows):
+        ds[krow:krow+block_rows]=asarray(G[krow:krow+block_rows,:],dtype='float64').dot(sol)
+    
+    return ds
+
+
     
     
 #=================        Write inversion results      =========================
@@ -1334,7 +1601,31 @@ def write_log(home,project_name,run_name,k,rupture_speed,num_windows,lambda_spat
     f.write('M0(N-m) = '+repr(Mo)+'\n')
     f.write('Mw = '+repr(Mw)+'\n')
     f.close()
-    
+
+
+def write_sweep_table(home,project_name,run_name,sweep_table):
+    '''
+    Write the summary of every regularization level of a run to a single
+    <run_name>.sweep file next to the .log files, sorted by run number. Read it with
+    genfromtxt to draw the L-curve or pick the minimum ABIC without parsing the logs.
+
+    IN:
+        home: Home directory location
+        project_name: Name of the problem
+        run_name: Name of inversion run
+        sweep_table: List of rows as returned by runslip.run_sweep_point()
+    OUT:
+        Nothing
+    '''
+
+    from numpy import array,savetxt,argsort
+
+    sweep_table=array(sweep_table,dtype='float')
+    sweep_table=sweep_table[argsort(sweep_table[:,0])]
+    fmtout='%4i\t%.6e\t%.6e\t%.6e\t%.6e\t%.4f\t%.4f\t%.4f\t%.4f\t%.4f\t%.6e\t%.6e\t%.4f\t%4i\t%i'
+    header='num,lambda_spatial,lambda_temporal,L2,Lm,VR_static(%),VR_displacement(%),VR_velocity(%),VR_tsunami(%),VR_InSAR(%),ABIC,M0(N-m),Mw,solver_iterations,converged'
+    savetxt(home+project_name+'/output/inverse_models/models/'+run_name+'.sweep',sweep_table,fmtout,header=header)
+
     
     
 #==================              Random Tools            ======================
@@ -1623,7 +1914,7 @@ def get_stats(WG,sol,wd,Ls):
     return L2,Lm
     
     
-def get_VR(home,project_name,GF_list,sol,d,ds,decimate,WG,wd):
+def get_VR(home,project_name,GF_list,sol,d,ds,decimate,WG,wd,layout=None,wds=None):
     '''
     Compute Variance reduction to the data
     
@@ -1631,17 +1922,36 @@ def get_VR(home,project_name,GF_list,sol,d,ds,decimate,WG,wd):
         G: GF matrix
         sol: Solution  vector from inversion
         d: data vector
+        layout: Optional layout of d from getdata(), avoids reading any files
+        wds: If known, the weighted synthetics WG*sol
     OUT:
         VR: Variance reduction (%)
     '''
     
-    from numpy import genfromtxt,where,r_,nan
+    from numpy import genfromtxt,where,r_,nan,ones
     from obspy import read
     from mudpy.green import stdecimate
     from numpy.linalg import norm
     
     print('... calcualting variance reduction...')
     
+    if layout is not None:
+        if wds is None:
+            wds=WG.dot(sol)
+        VR=nan*ones(5)
+        L2=nan*ones(5)
+        for kgf in range(5):
+            i=where(layout['data_type']==kgf)[0]
+            if len(i)==0:
+                continue
+            kstart=layout['start'][i[0]]
+            kend=layout['start'][i[-1]]+layout['npts'][i[-1]]
+            res=((d[kstart:kend]-ds[kstart:kend])**2)**0.5
+            dnorm=(d[kstart:kend]**2)**0.5
+            VR[kgf]=(1-(res.sum()/dnorm.sum()))*100
+            L2[kgf]=norm(wds[kstart:kend]-wd[kstart:kend])
+        return VR,L2
+    
     #Read gf file and decide what needs to get loaded
     gf_file=home+project_name+'/data/station_info/'+GF_list
     stations=genfromtxt(gf_file,usecols=[0],skip_header=1,dtype='U')
@@ -1652,7 +1962,8 @@ def get_VR(home,project_name,GF_list,sol,d,ds,decimate,WG,wd):
     kend=0
     
     #Calculate weighted syntehtic data
-    wds=WG.dot(sol)
+    if wds is None:
+        wds=WG.dot(sol)
     
     #Statics
     kgf=0
@@ -1759,7 +2070,7 @@ def get_VR(home,project_name,GF_list,sol,d,ds,decimate,WG,wd):
     
 
 
-def get_RMS(home,project_name,run_name,run_number,GF_list,bandpass,use_weights=True):
+def get_RMS(home,project_name,run_name,run_number,GF_list,bandpass,use_weights=True,layout=None,d=None,ds=None):
     '''
     Compute RMS per data type
     
@@ -1767,17 +2078,38 @@ def get_RMS(home,project_name,run_name,run_number,GF_list,bandpass,use_weights=T
         G: GF matrix
         sol: Solution  vector from inversion
         d: data vector
+        layout,d,ds: Optionally the layout from getdata() with the data and 
+            synthetics vectors already in memory, no files are read then
     OUT:
         RMS
     '''
     
-    from numpy import genfromtxt,where,r_,nan,zeros,ones
+    from numpy import genfromtxt,where,r_,nan,zeros,ones,repeat
     from obspy import read
     from mudpy.green import stdecimate
     from mudpy.forward import lowpass as lfilter
     
     print('... calcualting RMS...')
     
+    if layout is not None:
+        d=d.squeeze()
+        ds=ds.squeeze()
+        data_type=repeat(layout['data_type'],layout['npts'])
+        if use_weights==True:
+            sigma=repeat(layout['sigma'],layout['npts'])
+        else:
+            sigma=ones(len(d))
+        res=(d-ds)/sigma
+        RMS=nan*ones(6)
+        for kgf in range(3):
+            i=data_type==kgf
+            if i.sum()>0:
+                RMS[kgf]=((res[i]**2).sum()/i.sum())**0.5
+        #Total only over statics and waveforms
+        i=data_type<3
+        RMS[5]=((res[i]**2).sum()/i.sum())**0.5
+        return RMS
+    
     #Read gf file and decide what needs to get loaded
     gf_file=home+project_name+'/data/station_info/'+GF_list
     stations=genfromtxt(gf_file,usecols=[0],skip_header=1,dtype='U')
@@ -1942,7 +2274,249 @@ def get_RMS(home,project_name,run_name,run_number,GF_list,bandpass,use_weights=T
 
 
     
-def get_ABIC(G,GTG,sol,d,lambda_s,lambda_t,Ls,LsLs,Lt,LtLt):
+def get_regularization_basis(A,B):
+    '''
+    Simultaneously diagonalize two symmetric positive semi-definite matrices so 
+    that A+(lambda**2)*B can be inverted and its log-determinant evaluated for 
+    any lambda with only matrix-vector products. This is the generalized 
+    eigenproblem A*v = mu*(A+s*B)*v with V'(A+s*B)V = I, so that
+    
+        A+(lambda**2)*B = V^-T * diag(mu+(lambda**2/s)*(1-mu)) * V^-1
+    
+    where s balances the size of the two matrices. A+s*B must be positive definite.
+    
+    IN:
+        A: Fixed part of the matrix, e.g. G'G (+ temporal regularization)
+        B: Matrix scaled by the regularization parameter, e.g. Ls'Ls
+    OUT:
+        basis: Tuple (mu,V,s,logdet) for regularized_solve() and regularized_logdet()
+    '''
+    
+    from numpy import asarray,trace,log,diag,clip
+    from scipy.linalg import eigh,cholesky
+    from scipy.sparse import issparse
+    
+    if issparse(A):
+        A=A.toarray()
+    if issparse(B):
+        B=B.toarray()
+    A=asarray(A)
+    B=asarray(B)
+    
+    #Balance the two matrices
+    if trace(B)>0:
+        s=trace(A)/trace(B)
+    else:
+        s=1.
+    M=A+s*B
+    
+    #Log-determinant of the reference matrix
+    logdet=2*log(diag(cholesky(M,lower=True))).sum()
+    
+    #Decompose, mu is in [0,1] to within roundoff
+    mu,V=eigh(A,M)
+    mu=clip(mu,0,1)
+    
+    return mu,V,s,logdet
+    
+    
+def regularized_logdet(basis,lambda_reg):
+    '''
+    log(det(A+(lambda_reg**2)*B)) from the output of get_regularization_basis()
+    '''
+    
+    from numpy import log
+    
+    mu,V,s,logdet=basis
+    w=mu+(lambda_reg**2/s)*(1-mu)
+    
+    return logdet+log(w).sum()
+    
+    
+def regularized_solve(basis,x,lambda_reg):
+    '''
+    Solve (A+(lambda_reg**2)*B)*sol = x from the output of get_regularization_basis()
+    
+    OUT:
+        sol: Solution vector
+        logdet: log(det(A+(lambda_reg**2)*B)), handy for ABIC
+    '''
+    
+    from numpy import asarray,log
+    
+    mu,V,s,logdet=basis
+    x=asarray(x)
+    w=mu+(lambda_reg**2/s)*(1-mu)
+    if x.ndim==1:
+        sol=V.dot(V.T.dot(x)/w)
+    else:
+        sol=V.dot(V.T.dot(x)/w[:,None])
+    
+    return sol,logdet+log(w).sum()
+    
+    
+def bounded_lsq(N,x,lb=0.,ub=None,active=None,max_iter=None,tol=1e-10):
+    '''
+    Bounded least squares on the (regularized) normal equations,
+    
+        min 0.5*sol'*N*sol - x'*sol  subject to  lb <= sol <= ub
+    
+    solved by block principal pivoting (Judice and Pires, 1994). Each iteration
+    factors only the block of N for the free parameters and all variables that
+    violate the optimality conditions change set at once, with a single variable 
+    exchange as backup if the number of violations stops decreasing. Passing the 
+    active set of a nearby solution (e.g. the previous regularization level) 
+    typically converges in a handful of iterations. 
+    
+    A dense N has its free block Cholesky factored every iteration. A sparse N
+    or a scipy LinearOperator (e.g. products with G'G and the sparse 
+    regularization operators) is never formed, the free block is solved by 
+    conjugate gradients on products with N, warm started from the previous 
+    iterate.
+    
+    IN:
+        N: Symmetric positive definite normal matrix G'G+regularization, dense,
+            sparse or a LinearOperator
+        x: G'd
+        lb: Lower bounds, scalar or one per parameter (0 is positivity), -inf
+            for no lower bound
+        ub: Upper bounds, scalar or one per parameter, None for no upper bound
+        active: Starting active set, -1 at the lower bound, 0 free and 1 at the 
+            upper bound for each parameter. Default is all at the lower bound,
+            parameters are never started at an infinite bound, they start free
+        max_iter: Maximum number of iterations, default 10 times the number of parameters
+        tol: Relative tolerance on the optimality conditions
+    OUT:
+        sol: Solution vector, column
+        active: Final active set, pass to the next call to warm start
+        iterations: Number of iterations used
+        converged: True if the optimality conditions are met, a non-finite
+            solution is replaced by zeros and is never converged
+    '''
+    
+    from numpy import asarray,zeros,ones,inf,where,broadcast_to,abs,expand_dims,isinf,isfinite,ix_
+    from scipy.linalg import cho_factor,cho_solve,LinAlgError
+    from scipy.sparse import issparse
+    from scipy.sparse.linalg import LinearOperator,aslinearoperator,cg
+    
+    x=asarray(x,dtype='float').reshape(-1)
+    Nparam=len(x)
+    dense=not (issparse(N) or isinstance(N,LinearOperator))
+    if dense:
+        N=asarray(N)
+    else:
+        N=aslinearoperator(N)
+    lb=broadcast_to(asarray(lb,dtype='float'),(Nparam,)).copy()
+    if ub is None:
+        ub=inf*ones(Nparam)
+    else:
+        ub=broadcast_to(asarray(ub,dtype='float'),(Nparam,)).copy()
+    if active is None:
+        active=-ones(Nparam,dtype='int')
+    else:
+        active=asarray(active,dtype='int').copy()
+    #A parameter can't sit at an infinite bound
+    active[(active==-1) & isinf(lb)]=0
+    active[(active==1) & isinf(ub)]=0
+    if max_iter is None:
+        max_iter=10*Nparam
+    #Optimality tolerance scaled to the problem
+    if dense:
+        gtol=tol*max(abs(x).max(),abs(N).max())
+    else:
+        gtol=tol*max(abs(x).max(),abs(N.matvec(ones(Nparam))).max()/Nparam)
+    sol=zeros(Nparam)
+    
+    best_infeasible=Nparam+1
+    backup=3
+    converged=False
+    for iterations in range(1,max_iter+1):
+        free=active==0
+        sol=where(active==-1,lb,where(active==1,ub,where(free,sol,0.)))
+        if free.any() and dense:
+            bound=~free
+            rhs=x[free]-N[ix_(free,bound)].dot(sol[bound])
+            try:
+                sol[free]=cho_solve(cho_factor(N[ix_(free,free)]),rhs)
+            except (LinAlgError,ValueError):
+                print('+++ WARNING: Free block of the normal equations is not positive definite or not finite')
+                break
+        elif free.any():
+            ifree=where(free)[0]
+            fixed=sol.copy()
+            fixed[ifree]=0
+            rhs=x[ifree]-N.matvec(fixed)[ifree]
+            def free_matvec(v,ifree=ifree):
+                u=zeros(Nparam)
+                u[ifree]=v.ravel()
+                return N.matvec(u)[ifree]
+            Nfree=LinearOperator((len(ifree),len(ifree)),matvec=free_matvec,dtype='float')
+            sol[ifree],info=cg(Nfree,rhs,x0=sol[ifree],rtol=tol,atol=0.,maxiter=10*len(ifree))
+            if info!=0 or not isfinite(sol[ifree]).all():
+                print('+++ WARNING: Conjugate gradients did not solve the free block of the normal equations')
+                break
+        #Gradient of the quadratic
+        g=N.dot(sol)-x
+        #Optimality (KKT) violations
+        low=free & (sol<lb-gtol)
+        high=free & (sol>ub+gtol)
+        release=((active==-1) & (g<-gtol)) | ((active==1) & (g>gtol))
+        infeasible=low | high | release
+        Ninfeasible=infeasible.sum()
+        if Ninfeasible==0:
+            converged=True
+            break
+        if Ninfeasible<best_infeasible: #Progress, exchange everything
+            best_infeasible=Ninfeasible
+            backup=3
+        elif backup>0: #Allow a few exchanges without progress
+            backup-=1
+        else: #Single exchange of the last infeasible variable, this cannot cycle
+            ilast=where(infeasible)[0][-1]
+            low[:ilast]=False ; high[:ilast]=False ; release[:ilast]=False
+            best_infeasible=Ninfeasible
+        active[low]=-1
+        active[high]=1
+        active[release]=0
+    
+    sol=sol.clip(lb,ub)
+    if not isfinite(sol).all():
+        print('+++ WARNING: Bounded solver produced a non-finite solution, writting zeros.')
+        sol=zeros(Nparam)
+        converged=False
+    return expand_dims(sol,axis=1),active,iterations,converged
+
+
+def rake_cone_basis(Nparam,rake_min,rake_max):
+    '''
+    Change of variables that turns a rake cone into positivity. Every ss,ds pair
+    is written as sol = C*a with the columns of C the unit slip vectors at 
+    rake_min and rake_max, a>=0 then keeps the rake in [rake_min,rake_max]. 
+    rake_min=0, rake_max=90 is plain positivity.
+    
+    IN:
+        Nparam: Number of model parameters (ss,ds interleaved)
+        rake_min,rake_max: Cone edges in degrees, less than 180 apart
+    OUT:
+        C: Sparse block diagonal transformation matrix
+    '''
+    
+    from numpy import deg2rad,cos,sin,arange,tile,r_
+    from scipy.sparse import csr_matrix
+    
+    iss=arange(0,Nparam,2)
+    ids=iss+1
+    r1=deg2rad(rake_min)
+    r2=deg2rad(rake_max)
+    rows=r_[iss,ids,iss,ids]
+    cols=r_[iss,iss,ids,ids]
+    values=r_[tile(cos(r1),len(iss)),tile(sin(r1),len(iss)),tile(cos(r2),len(iss)),tile(sin(r2),len(iss))]
+    C=csr_matrix((values,(rows,cols)),shape=(Nparam,Nparam))
+    
+    return C
+    
+    
+def get_ABIC(G,GTG,sol,d,lambda_s,lambda_t,Ls,LsLs,Lt,LtLt,logdet_normal=None,logdet_reg=None,ds=None):
     '''
     Compute Akaike's Bayesian information criterion, for details see Ide et al. (1996)
     in BSSA, specifically equation 33.
@@ -1957,34 +2531,49 @@ def get_ABIC(G,GTG,sol,d,lambda_s,lambda_t,Ls,LsLs,Lt,LtLt):
         Lt:Temporal reularization matrix
         Ls_rank: Rank of Ls (#eigenvalues>0)
         Lt_rank: Rank of Lt
+        logdet_normal: If known, log(det(GTG+lambda_s**2*LsLs+lambda_t**2*LtLt))
+        logdet_reg: If known, log(det(lambda_s**2*LsLs+lambda_t**2*LtLt))
+        ds: If known, the synthetics G*sol
     OUT:
         ABIC: Akaike's Bayesian information criterion
     
     '''
     
-    from numpy import log
+    from numpy import log,zeros
     from numpy.linalg  import norm,slogdet
     
     #Data points
     N=d.size
     #Model parameters
     M=sol.size
+    #Synthetics
+    if ds is None:
+        ds=G.dot(sol)
     #Off you go, compute it
     if lambda_t==0: #There is only one contraint (no temporal regularization)
         print("... Static ABIC requested")
-        s=norm(d-G.dot(sol))**2+(lambda_s**2)*norm(Ls.dot(sol))**2
+        s=norm(d-ds)**2+(lambda_s**2)*norm(Ls.dot(sol))**2
         a1=N*log(s)
         a2=M*log(lambda_s**2)
-        sq,a3=slogdet(GTG+(lambda_s**2)*LsLs)
+        if logdet_normal is None:
+            sq,a3=slogdet(add_regularization(GTG,lambda_s,LsLs))
+        else:
+            a3=logdet_normal
         #Add 'em up
         ABIC=a1-a2+a3
         return ABIC
     else: #There is a double regularization, use Fukahata et al. definition
         print('... computing 2d-ABIC')
-        s=(norm(d-G.dot(sol))**2)+((lambda_s**2)*(norm(Ls.dot(sol))**2))+((lambda_t**2)*(norm(Lt.dot(sol))**2))
+        s=(norm(d-ds)**2)+((lambda_s**2)*(norm(Ls.dot(sol))**2))+((lambda_t**2)*(norm(Lt.dot(sol))**2))
         a1=N*log(s)
-        sq,a2=slogdet((lambda_s**2)*LsLs+(lambda_t**2)*LtLt)
-        sq,a3=slogdet(GTG+(lambda_s**2)*LsLs+(lambda_t**2)*LtLt)
+        if logdet_reg is None:
+            sq,a2=slogdet(add_regularization(zeros(GTG.shape),lambda_s,LsLs,lambda_t,LtLt))
+        else:
+            a2=logdet_reg
+        if logdet_normal is None:
+            sq,a3=slogdet(add_regularization(GTG,lambda_s,LsLs,lambda_t,LtLt))
+        else:
+            a3=logdet_normal
         #Add 'em up
         ABIC=a1-a2+a3
         return ABIC
@@ -2113,6 +2702,53 @@ def resample_to_data(synth,data):
     synth.data=synth_correct
     return synth
 
+
+def align_to_data(synth,data,tdelay):
+    '''
+    Time shift a synthetic by tdelay seconds and return the samples that line up with
+    the data. This gives the same samples as forward.tshift() followed by resample_to_data()
+    and prep_synth() but works on arrays, so the synthetic trace is never copied or
+    modified and can be reused for every time window.
+
+    IN:
+        synth: synthetic trace object (already filtered and decimated)
+        data: data trace object
+        tdelay: Shift in seconds, positive moves forward in time
+    OUT:
+        y: Synthetic samples at the data times
+    '''
+    from datetime import timedelta
+    from numpy import interp,arange,zeros,r_
+    from obspy.core.compatibility import round_away
+    from mudpy.forward import round_time
+
+    delta=synth.stats.delta
+    sampling_rate=synth.stats.sampling_rate
+    #Shifted start time
+    t1=synth.stats.starttime+timedelta(seconds=tdelay)
+    #Fractional sample correction onto the data sampling
+    dt=round_time(t1,data.stats.delta)-t1
+    tsynth=arange(synth.stats.npts)/sampling_rate
+    y=interp(tsynth+dt,tsynth,synth.data)
+    #Pad with zeros or crop to the start of the data
+    t1st=data.stats.starttime
+    if t1-t1st>=0:
+        y=r_[zeros(int((t1-t1st)/data.stats.delta)),y]
+        t1=t1st
+    else:
+        nsamples=round_away((t1st-t1)*sampling_rate)
+        if nsamples>0:
+            t1+=nsamples*delta
+            y=y[nsamples:]
+    #Crop to the end of the data
+    t2st=data.stats.endtime
+    if t1+(len(y)-1)*delta-t2st>=0:
+        y=y[:max(round_away((t2st-t1)*sampling_rate)+1,0)]
+    else:
+        print("ERROR: Synthetic end time is before data end time, recompute longer syntehtics please.")
+        return 'Error in GF length'
+    return y
+
 def resample_synth_tsun(synth,data):
     '''
     Resample a synthetic to the time samples contained in the input data
@@ -2145,15 +2781,35 @@ def resample_synth_tsun(synth,data):
     return synth
     
 def model_covariance(home,project_name,run_name,run_number,fault_name,G_name,nfaults,
-                        num_windows,bounds,GF_list,decimate,lowpass,beta):
+                        num_windows,bounds,GF_list,decimate,lowpass,beta,method='cholesky',
+                        resolution=False,num_probes=100,rank=50,seed=0):
     '''
-    Compute model covariance matrix
-    '''
-    from numpy import load,arange,zeros,genfromtxt,expand_dims,save
-    from numpy.linalg import norm,inv
+    Compute the diagonal of the model covariance matrix (marginal variances) and
+    optionally of the model resolution matrix. 
+    
+    G is read memory mapped one block of rows at a time and the inverse of the
+    normal matrix is never formed, see posterior_diagonals() for the available
+    estimators. Besides the .cov.npy file of variances a .cov file with the ss
+    and ds standard deviations (and a .res file with the resolution diagonal if
+    requested) is written next to the .inv model in the same format.
+    
+    IN:
+        method: ='cholesky' exact diagonal, ='probe' stochastic estimate from 
+            num_probes random vectors, ='lowrank' from the rank least resolved 
+            directions (smallest eigenpairs of the normal matrix) plus a 
+            diagonal remainder
+        resolution: If True also get the diagonal of the resolution matrix
+        num_probes: Number of probing vectors for method='probe'
+        rank: Number of eigenpairs for method='lowrank'
+        seed: Random seed for method='probe'
+    '''
+    from numpy import load,arange,zeros,genfromtxt,expand_dims,save,savetxt,c_,sqrt
+    from numpy.linalg import norm
     from datetime import datetime
     import gc
 
+    if method.lower() not in ('cholesky','probe','lowrank'):
+        raise ValueError('Unrecognized covariance method \''+method+'\'')
     t0=datetime.now()
     #Get smoothing from log file
     outdir=home+project_name+'/output/inverse_models/models/'
@@ -2173,25 +2829,24 @@ def model_covariance(home,project_name,run_name,run_number,fault_name,G_name,nfa
     #Cd=diag(Cd)
     #Cd=diag(1/Cd)
     #Load G
-    print('Computing for SS model parameters')
     print('Getting G...')
     G_name=home+project_name+'/GFs/matrices/'+G_name
     print('Loading '+G_name)
     if G_name[-3:]!='npy':
             G_name=G_name+'.npy'
-    G=load(G_name)
-    iss=2*arange(G.shape[1]/2)
-    ids=2*arange(G.shape[1]/2)+1
+    G=load(G_name,mmap_mode='r')
+    iss=2*arange(G.shape[1]//2)
+    ids=2*arange(G.shape[1]//2)+1
     gc.collect()
-    print('Compressing G...')
     #Get regularization matrices
     print('Getting regularization matrices...')
-    Ls=getLs(home,project_name,fault_name,nfaults,num_windows,bounds)
-    Lt=getLt(home,project_name,fault_name,num_windows)
+    Ls=getLs(home,project_name,fault_name,nfaults,num_windows,bounds,sparse=True)
+    Lt=getLt(home,project_name,fault_name,num_windows,sparse=True)
     #Read model
     print('Reading model')
-    model=outdir+run_name+'.'+run_number+'.inv'
-    model=genfromtxt(model,usecols=(8,9))
+    model_file=outdir+run_name+'.'+run_number+'.inv'
+    inv_model=genfromtxt(model_file)
+    model=inv_model[:,8:10]
     m0=zeros((model.size,1))
     m0[iss]=expand_dims(model[:,0],1) 
     m0[ids]=expand_dims(model[:,1],1) 
@@ -2200,28 +2855,116 @@ def model_covariance(home,project_name,run_name,run_number,fault_name,G_name,nfa
     #Get data
     print('Reading data...')
     d=getdata(home,project_name,GF_list,decimate,lowpass)
-    #Compute residual
-    sm0=norm(d-G.dot(m0))**2+(ls**2)*norm(Ls.dot(m0))**2+(lt**2)*norm(Lt.dot(m0))**2
+    #Normal equations and residual, one block of G at a time
+    K,x=normal_equations(G,d)
+    sm0=norm(d-blocked_dot(G,m0))**2+(ls**2)*norm(Ls.dot(m0))**2+(lt**2)*norm(Lt.dot(m0))**2
+    G=None
     #Get sigma
     sigma=sm0/len(d)
     #Compute model covariance
     print('Computing model covariance...')
-    #Cd=csc_matrix(Cd)
-    Cm=(G.T).dot(G)+(ls**2)*(Ls.T).dot(Ls)+(lt**2)*(Lt.T).dot(Lt)
-    print('Inverting G\'G')
-    Cm=inv(Cm)
+    N=add_regularization(K,ls,Ls.T.dot(Ls),lt,Lt.T.dot(Lt))
+    if resolution==False:
+        K=None
+    Cm,R=posterior_diagonals(N,K=K,method=method,num_probes=num_probes,rank=rank,seed=seed)
     Cm=Cm*sigma
-    print('Extracting diagonal terms...')
-    Cm=Cm.diagonal()
-    G=None
     #Prep for output
     Cm_name=G_name.split('.npy')[0]+'.cov'
     print('Saving to '+Cm_name)
     save(Cm_name,Cm)
+    #Per subfault and window, same layout as the .inv file (in the rotated frame if beta!=0)
+    fmtout='%6i\t%.4f\t%.4f\t%8.4f\t%.2f\t%.2f\t%.2f\t%.2f\t%12.4e\t%12.4e\t%10.1f\t%10.1f\t%8.4f\t%.4e'
+    out=c_[inv_model[:,0:8],sqrt(Cm[iss]),sqrt(Cm[ids]),inv_model[:,10:]]
+    print('... writing model standard deviations to '+outdir+run_name+'.'+run_number+'.cov')
+    savetxt(outdir+run_name+'.'+run_number+'.cov',out,fmtout,header='No,lon,lat,z(km),strike,dip,rise,dura,ss-std(m),ds-std(m),ss_len(m),ds_len(m),rupt_time(s),rigidity(Pa)')
+    if R is not None:
+        out=c_[inv_model[:,0:8],R[iss],R[ids],inv_model[:,10:]]
+        print('... writing resolution diagonal to '+outdir+run_name+'.'+run_number+'.res')
+        savetxt(outdir+run_name+'.'+run_number+'.res',out,fmtout,header='No,lon,lat,z(km),strike,dip,rise,dura,ss-resolution,ds-resolution,ss_len(m),ds_len(m),rupt_time(s),rigidity(Pa)')
     deltaT=datetime.now()-t0
     print('Well that only took '+str(deltaT))
     
     
+def posterior_diagonals(N,K=None,method='cholesky',num_probes=100,rank=50,seed=0,block_cols=512):
+    '''
+    Diagonal of inv(N) and optionally of the resolution matrix inv(N)*K without
+    forming inv(N)
+    
+    IN:
+        N: Regularized normal matrix G'G+ls^2*Ls'Ls+lt^2*Lt'Lt
+        K: G'G, if not None the resolution diagonal is also returned
+        method: ='cholesky' exact, columns of inv(L) are solved block_cols at a
+                time so memory stays at one copy of N
+            ='probe' stochastic estimate diag(inv(N)) ~ mean(v*inv(N)v) over 
+                num_probes Rademacher vectors v (Bekas et al., 2007), each 
+                inv(N)v is a Jacobi preconditioned conjugate gradient solve so N
+                is only multiplied and never factored
+            ='lowrank' inv(N) ~ V*inv(S)*V' + D from the rank smallest eigenpairs
+                of N (the least resolved directions), the remaining directions are
+                approximated by the Jacobi diagonal D=(1-diag(V*V'))/diag(N) and 
+                taken as fully resolved. Exact when rank is the number of parameters
+        num_probes: Number of probing vectors for method='probe'
+        rank: Number of eigenpairs for method='lowrank'
+        seed: Random seed for method='probe'
+        block_cols: Number of columns solved at once for method='cholesky'
+        
+    OUT:
+        Cdiag: diag(inv(N))
+        Rdiag: diag(inv(N)*K) or None
+    '''
+    
+    from numpy import zeros,arange,sign
+    from numpy.random import default_rng
+    from scipy.linalg import cholesky,cho_solve,solve_triangular,eigh
+    from scipy.sparse import diags
+    from scipy.sparse.linalg import cg
+    
+    if method.lower() not in ('cholesky','probe','lowrank'):
+        raise ValueError('Unrecognized covariance method \''+method+'\'')
+    Nparam=len(N)
+    Rdiag=None
+    if method.lower()=='cholesky':
+        L=cholesky(N,lower=True)
+        Cdiag=zeros(Nparam)
+        if K is not None:
+            Rdiag=zeros(Nparam)
+        for kcol in range(0,Nparam,block_cols):
+            icol=arange(kcol,min(kcol+block_cols,Nparam))
+            E=zeros((Nparam,len(icol)))
+            E[icol,arange(len(icol))]=1
+            #Column i of inv(L) has the squared norm diag(inv(N))[i]
+            X=solve_triangular(L,E,lower=True)
+            Cdiag[icol]=(X**2).sum(axis=0)
+            if K is not None:
+                Y=cho_solve((L,True),K[:,icol])
+                Rdiag[icol]=Y[icol,arange(len(icol))]
+    elif method.lower()=='probe':
+        V=sign(default_rng(seed).random((Nparam,num_probes))-0.5)
+        Jacobi=diags(1/N.diagonal())
+        def solve(b):
+            y,info=cg(N,b,rtol=1e-8,M=Jacobi,maxiter=10*Nparam)
+            if info!=0:
+                print('+++ WARNING: Conjugate gradients did not converge for a probing vector')
+            return y
+        Cdiag=zeros(Nparam)
+        if K is not None:
+            Rdiag=zeros(Nparam)
+        for kprobe in range(num_probes):
+            v=V[:,kprobe]
+            Cdiag+=v*solve(v)/num_probes
+            if K is not None:
+                Rdiag+=v*solve(K.dot(v))/num_probes
+    elif method.lower()=='lowrank':
+        rank=min(rank,Nparam)
+        S,V=eigh(N,subset_by_index=[0,rank-1])
+        #How much of each parameter lies in the computed subspace
+        captured=(V**2).sum(axis=1)
+        Cdiag=((V**2)/S).sum(axis=1)+(1-captured)/N.diagonal()
+        if K is not None:
+            Rdiag=((V/S)*K.dot(V)).sum(axis=1)+(1-captured)
+    
+    return Cdiag,Rdiag
+    
     
 def data_covariance(gf_file,decimate):
     '''
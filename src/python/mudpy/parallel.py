@@ -105,6 +105,183 @@ def run_parallel_green(home,project_name,station_file,model_name,dt,NFFT,static,
             #If file is empty run again
             
 
+
+def run_parallel_green_store(home,project_name,station_file,model_name,dt,NFFT,static,dk,pmin,pmax,kmax,tsunami,insar,distance_bin,rank,size):
+    '''
+    Same as run_parallel_green but fk.pl only runs once per unique source depth.
+    The fk output depends only on source depth and source-station distance so
+    all subfaults at one depth share a single call with the union of their 
+    distances. Waveform GFs are kept in GFs/store/ keyed by model, depth and 
+    distance and are symlinked into the usual per subfault folders, so anything 
+    already in the store is never recomputed. Each depth folder is tagged with 
+    a hash of the velocity model contents and the fk parameters (NFFT, dt, dk, 
+    pmin, pmax, kmax) so editing any of them starts a new store instead of 
+    reusing stale kernels. Static GFs are split back out into the usual per 
+    subfault files.
+    
+    IN:
+        Same as run_parallel_green plus
+        distance_bin: None to key the store on the exact distance (to the meter)
+            or a bin width in km, distances are rounded to the center of the bin
+    OUT:
+        Nothing
+    '''
+    import subprocess
+    from os import chdir,path,makedirs,symlink,remove,stat
+    from shutil import copy,rmtree,move
+    from numpy import loadtxt,array,unique,where
+    from shlex import split
+    from glob import glob
+    from hashlib import sha1
+    from mudpy.green import src2sta
+
+    #No more than this many distances per fk.pl call, ndis=5000 in fk's model.h
+    max_distances=4000
+
+    #What parameters are we using?
+    if rank==0:
+        out='''Running all processes with:
+        home = %s
+        project_name = %s
+        station_file = %s
+        model_name = %s
+        static = %s
+        tsunami = %s
+        dt = %.3f
+        NFFT = %d
+        dk = %.3f
+        pmin = %.3f
+        pmax = %.3f
+        kmax = %.3f
+        insar = %s
+        distance_bin = %s
+        ''' %(home,project_name,station_file,model_name,str(static),str(tsunami),dt,NFFT,dk,pmin,pmax,kmax,str(insar),str(distance_bin))
+        print(out)
+    
+    #Where does everything go?
+    if tsunami==False and static==0:
+        gf_folder=home+project_name+'/GFs/dynamic/'
+        store_folder=home+project_name+'/GFs/store/dynamic/'
+    elif tsunami==True and static==1:
+        gf_folder=home+project_name+'/GFs/tsunami/'
+        store_folder=home+project_name+'/GFs/store/tsunami/'
+    elif static==1:
+        gf_folder=home+project_name+'/GFs/static/'
+        store_folder=home+project_name+'/GFs/store/static/'
+    if insar==True:
+        suffix='insar'
+    else:
+        suffix='gps'
+    
+    #Anything that changes the fk output changes the store tag
+    fk_parameters='NFFT=%d dt=%r dk=%r pmin=%r pmax=%r kmax=%r' % (NFFT,dt,dk,pmin,pmax,kmax)
+    key=sha1()
+    key.update(open(home+project_name+'/structure/'+model_name,'rb').read())
+    key.update(fk_parameters.encode())
+    store_tag=key.hexdigest()[0:12]
+    
+    #read your corresponding source file, all subfaults at one depth are in the same file
+    source=loadtxt(home+project_name+'/data/model_info/mpi_source.'+str(rank)+'.fault',ndmin=2)
+    if len(source)==0:
+        print('MPI: processor #',rank,'has no unique depths to work on')
+        return
+    strdepths=array(['%.4f' % z for z in source[:,3]])
+    unique_depths=unique(strdepths)
+    
+    for kdepth in range(len(unique_depths)):
+        
+        depth=unique_depths[kdepth]
+        isub=where(strdepths==depth)[0]
+        
+        #Exact distance string for every subfault/station pair and the store key it maps to
+        exact_distances=[]
+        store_keys=[]
+        for ksource in isub:
+            d,az=src2sta(station_file,source[ksource,:])
+            exact_distances.append(['%.6f' % d[k] for k in range(len(d))])
+            if distance_bin is None:
+                store_keys.append(exact_distances[-1])
+            else:
+                store_keys.append(['%.6f' % (round(d[k]/distance_bin)*distance_bin) for k in range(len(d))])
+        unique_keys=unique(array(store_keys).ravel())
+        
+        #Work in this depth's store folder
+        depth_folder=store_folder+model_name+'_'+depth+'.'+store_tag+'/'
+        if path.exists(depth_folder)==False:
+            makedirs(depth_folder)
+            f=open(depth_folder+'store.txt','w')
+            f.write(fk_parameters+'\n')
+            f.close()
+        copy(home+project_name+'/structure/'+model_name,depth_folder+model_name)
+        chdir(depth_folder)
+        
+        if static==0: #Compute full waveforms, only what is not in the store yet
+            missing=[key for key in unique_keys if path.exists(depth_folder+key+'.grn.0')==False]
+            print('MPI: processor #',rank,'is now working on depth',depth,'km (',kdepth+1,'/',len(unique_depths),') with',
+                  len(isub),'subfaults,',len(unique_keys),'unique distances,',len(missing),'not in store')
+            for kbatch in range(0,len(missing),max_distances):
+                diststr=''.join([' '+key for key in missing[kbatch:kbatch+max_distances]])
+                command = "fk.pl -M"+model_name+"/"+depth+"/f -N"+str(NFFT)+"/"+str(dt)+'/1/'+repr(dk)+' -P'+repr(pmin)+'/'+repr(pmax)+'/'+repr(kmax)+diststr
+                command=split(command)
+                p=subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+                p.communicate() 
+                # Move files up one level and delete folder created by fk
+                files_list=glob(depth_folder+model_name+'_'+depth+'/*.grn*')
+                for f in files_list:
+                    move(f,depth_folder+f.split('/')[-1])
+                rmtree(depth_folder+model_name+'_'+depth)
+            
+            #Link store files into each subfault folder under their exact distance name
+            for k in range(len(isub)):
+                subfault=str(int(source[isub[k],0])).rjust(4,'0')
+                subfault_folder=gf_folder+model_name+'_'+depth+'.sub'+subfault+'/'
+                if path.exists(subfault_folder)==False:
+                    makedirs(subfault_folder)
+                copy(home+project_name+'/structure/'+model_name,subfault_folder+model_name)
+                for ksta in range(len(exact_distances[k])):
+                    for f in glob(depth_folder+store_keys[k][ksta]+'.grn.*'):
+                        link_name=subfault_folder+exact_distances[k][ksta]+'.grn.'+f.split('.grn.')[-1]
+                        if path.lexists(link_name):
+                            remove(link_name)
+                        symlink(f,link_name)
+        
+        else: #Compute only statics, one call for the whole depth then split it by subfault
+            print('MPI: processor #',rank,'is now working on depth',depth,'km (',kdepth+1,'/',len(unique_depths),') with',
+                  len(isub),'subfaults and',len(unique_keys),'unique distances')
+            static_lines={}
+            for kbatch in range(0,len(unique_keys),max_distances):
+                keys=unique_keys[kbatch:kbatch+max_distances]
+                diststr=''.join([' '+key for key in keys])
+                command=split("fk.pl -M"+model_name+"/"+depth+"/f -N1 "+diststr)
+                write_file=depth_folder+model_name+'.static.'+depth+'.'+suffix
+                file_is_empty=True
+                while file_is_empty:
+                    p=subprocess.Popen(command,stdout=open(write_file,'w'),stderr=subprocess.PIPE)
+                    p.communicate()
+                    if stat(write_file).st_size!=0: #File is NOT empty
+                        file_is_empty=False
+                    else:
+                        print('Warning: I just had a mini-seizure and made an empty GF file on first try, re-running')
+                #fk writes one line per distance in the order requested
+                f=open(write_file,'r')
+                lines=f.readlines()
+                f.close()
+                for k in range(len(keys)):
+                    static_lines[keys[k]]=lines[k]
+            
+            #Write the per subfault files exactly as run_parallel_green would
+            for k in range(len(isub)):
+                subfault=str(int(source[isub[k],0])).rjust(4,'0')
+                subfault_folder=gf_folder+model_name+'_'+depth+'.sub'+subfault+'/'
+                if path.exists(subfault_folder)==False:
+                    makedirs(subfault_folder)
+                copy(home+project_name+'/structure/'+model_name,subfault_folder+model_name)
+                f=open(subfault_folder+model_name+'.static.'+depth+'.sub'+subfault+'.'+suffix,'w')
+                for ksta in range(len(store_keys[k])):
+                    f.write(static_lines[store_keys[k][ksta]])
+                f.close()
+            
+
 def run_parallel_synthetics(home,project_name,station_file,model_name,integrate,static,quasistatic2dynamic,tsunami,
                             time_epi,beta,custom_stf,impulse,NFFT,dt,rank,size,insar=False,okada=False,mu_okada=45e9,):
     '''
@@ -1250,6 +1427,28 @@ if __name__ == '__main__':
         elif insar=='False':
             insar=False
         run_parallel_green(home,project_name,station_file,model_name,dt,NFFT,static,dk,pmin,pmax,kmax,tsunami,insar,rank,size)
+    
+    elif sys.argv[1]=='run_parallel_green_store':
+        #Parse command line arguments
+        home=sys.argv[2]
+        project_name=sys.argv[3]
+        station_file=sys.argv[4]
+        model_name=sys.argv[5]
+        dt=float(sys.argv[6])
+        NFFT=int(sys.argv[7])
+        static=int(sys.argv[8])
+        dk=float(sys.argv[9])
+        pmin=int(sys.argv[10])
+        pmax=int(sys.argv[11])
+        kmax=int(sys.argv[12])
+        tsunami=sys.argv[13]=='True'
+        insar=sys.argv[14]=='True'
+        distance_bin=sys.argv[15]
+        if distance_bin=='None':
+            distance_bin=None
+        else:
+            distance_bin=float(distance_bin)
+        run_parallel_green_store(home,project_name,station_file,model_name,dt,NFFT,static,dk,pmin,pmax,kmax,tsunami,insar,distance_bin,rank,size)
 
     
     elif sys.argv[1]=='run_parallel_synthetics':
@@ -177,7 +177,7 @@ def make_green(home,project_name,station_file,fault_name,model_name,dt,NFFT,stat
 
 
 def make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,NFFT,static,tsunami,
-            hot_start,dk,pmin,pmax,kmax,ncpus,insar=False,okada=False):
+            hot_start,dk,pmin,pmax,kmax,ncpus,insar=False,okada=False,depth_store=False,distance_bin=None):
     '''
     This routine set's up the computation of GFs for each subfault to all stations.
     The GFs are impulse sources, they don't yet depend on strike and dip.
@@ -192,12 +192,16 @@ def make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,
         NFFT: No. of samples requested in waveform (must be power of 2)
         static: =0 if computing full waveforms, =1 if computing only the static field
         hot_start: =k if you want to start computations at k-th subfault, =0 to compute all
+        depth_store: =True to run fk.pl once per unique depth and share the
+            results between subfaults through GFs/store/
+        distance_bin: bin width in km for distances in the store, None uses
+            the exact distances
 
         
     OUT:
         Nothing
     '''
-    from numpy import arange,savetxt,genfromtxt
+    from numpy import arange,savetxt,genfromtxt,array,unique,where,isin
     from os import path,makedirs,environ
     from shlex import split
     import subprocess
@@ -228,8 +232,15 @@ def make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,
                 #It doesn't, make it, don't be lazy
                 makedirs(subfault_folder)
     #Create individual source files
+    if depth_store==True: #All subfaults at one depth go to the same CPU
+        strdepths=array(['%.4f' % z for z in source[hot_start:,3]])
+        unique_depths=unique(strdepths)
+        print('Found '+str(len(unique_depths))+' unique depths for '+str(len(strdepths))+' subfaults')
     for k in range(ncpus):
-        i=arange(k+hot_start,len(source),ncpus)
+        if depth_store==True:
+            i=hot_start+where(isin(strdepths,unique_depths[arange(k,len(unique_depths),ncpus)]))[0]
+        else:
+            i=arange(k+hot_start,len(source),ncpus)
         mpi_source=source[i,:]
         fmt='%d\t%10.6f\t%10.6f\t%.8f\t%10.6f\t%10.6f\t%10.6f\t%10.6f\t%10.6f\t%10.6f'
         savetxt(home+project_name+'/data/model_info/mpi_source.'+str(k)+'.fault',mpi_source,fmt=fmt)
@@ -239,6 +250,12 @@ def make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,
     if static==1 and okada==True:
         print('Static Okada solution requested, no need to run GFs...')
         pass
+    elif depth_store==True:
+        mpi='mpiexec -n '+str(ncpus)+' python '+mud_source+'parallel.py run_parallel_green_store '+home+' '+project_name+' '+station_file+' '+model_name+' '+str(dt)+' '+str(NFFT)+' '+str(static)+' '+str(dk)+' '+str(pmin)+' '+str(pmax)+' '+str(kmax)+' '+str(tsunami)+' '+str(insar)+' '+str(distance_bin)
+        print(mpi)
+        mpi=split(mpi)
+        p=subprocess.Popen(mpi)
+        p.communicate()
     else:
         mpi='mpiexec -n '+str(ncpus)+' python '+mud_source+'parallel.py run_parallel_green '+home+' '+project_name+' '+station_file+' '+model_name+' '+str(dt)+' '+str(NFFT)+' '+str(static)+' '+str(dk)+' '+str(pmin)+' '+str(pmax)+' '+str(kmax)+' '+str(tsunami)+' '+str(insar)
         print(mpi)
@@ -422,13 +439,17 @@ def make_parallel_synthetics(home,project_name,station_file,fault_name,model_nam
 def inversionGFs(home,project_name,GF_list,tgf_file,fault_name,model_name,
         dt,tsun_dt,NFFT,tsunNFFT,green_flag,synth_flag,dk,pmin,
         pmax,kmax,beta,time_epi,hot_start,ncpus,custom_stf,quasistatic2dynamic=0,
-        impulse=False):
+        impulse=False,depth_store=False,distance_bin=None):
     '''
     This routine will read a .gflist file and compute the required GF type for each station
+    
+    With depth_store=True fk.pl is run once per unique subfault depth and the 
+    results are shared between subfaults, see parallel.run_parallel_green_store
     '''
     from numpy import genfromtxt,where,loadtxt,shape,floor
     from os import remove
     from gc import collect
+    from mudpy.inverse import make_static_GF_store
     
     #Read in GFlist and decide what to compute
     gf_file=home+project_name+'/data/station_info/'+GF_list
@@ -460,7 +481,7 @@ def inversionGFs(home,project_name,GF_list,tgf_file,fault_name,model_name,
             tsunami=False
             insar=False
             make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,NFFT,static,tsunami,
-                        hot_start,dk,pmin,pmax,kmax,ncpus,insar)
+                        hot_start,dk,pmin,pmax,kmax,ncpus,insar,depth_store=depth_store,distance_bin=distance_bin)
         i=where(GF[:,3]==1)[0]
         if len(i)>0 : #displ waveform
             print('Displacememnt GFs requested...')
@@ -472,7 +493,7 @@ def inversionGFs(home,project_name,GF_list,tgf_file,fault_name,model_name,
             static=0
             tsunami=False
             make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,NFFT,static,tsunami,
-                        hot_start,dk,pmin,pmax,kmax,ncpus)
+                        hot_start,dk,pmin,pmax,kmax,ncpus,depth_store=depth_store,distance_bin=distance_bin)
         i=where(GF[:,4]==1)[0]
         if len(i)>0 : #vel waveform
             print('Velocity GFs requested...')
@@ -484,7 +505,7 @@ def inversionGFs(home,project_name,GF_list,tgf_file,fault_name,model_name,
             static=0
             tsunami=False
             make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,NFFT,static,tsunami,
-                        hot_start,dk,pmin,pmax,kmax,ncpus)
+                        hot_start,dk,pmin,pmax,kmax,ncpus,depth_store=depth_store,distance_bin=distance_bin)
         if tgf_file!=None: #Tsunami
             print('Seafloor displacement GFs requested...')
 #            static=0
@@ -492,7 +513,7 @@ def inversionGFs(home,project_name,GF_list,tgf_file,fault_name,model_name,
             tsunami=True
             station_file=tgf_file
             make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,NFFT,static,tsunami,
-                        hot_start,dk,pmin,pmax,kmax,ncpus)
+                        hot_start,dk,pmin,pmax,kmax,ncpus,depth_store=depth_store,distance_bin=distance_bin)
         i=where(GF[:,6]==1)[0]
         if len(i)>0: #InSAR LOS
             print('InSAR GFs requested...')
@@ -506,7 +527,7 @@ def inversionGFs(home,project_name,GF_list,tgf_file,fault_name,model_name,
             tsunami=False
             insar=True
             make_parallel_green(home,project_name,station_file,fault_name,model_name,dt,NFFT,static,tsunami,
-                        hot_start,dk,pmin,pmax,kmax,ncpus,insar)
+                        hot_start,dk,pmin,pmax,kmax,ncpus,insar,depth_store=depth_store,distance_bin=distance_bin)
             collect()   
     #Synthetics are computed  one station at a time
     if synth_flag==1:
@@ -527,6 +548,8 @@ def inversionGFs(home,project_name,GF_list,tgf_file,fault_name,model_name,
             tsunami=False
             insar=False
             make_parallel_synthetics(home,project_name,station_file,fault_name,model_name,integrate,static,quasistatic2dynamic,tsunami,beta,hot_start,time_epi,ncpus,custom_stf,NFFT,dt,impulse,insar)
+            #Collect the per subfault .neu files into the static GF store read by makeG
+            make_static_GF_store(home,project_name,fault_name,model_name,stations[i],gftype='static',update=True)
         #Decide which synthetics are required
         i=where(GF[:,3]==1)[0]
         if len(i)>0: #dispalcement waveform
@@ -592,6 +615,7 @@ def inversionGFs(home,project_name,GF_list,tgf_file,fault_name,model_name,
             tsunami=False
             insar=True
             make_parallel_synthetics(home,project_name,station_file,fault_name,model_name,integrate,static,quasistatic2dynamic,tsunami,beta,hot_start,time_epi,ncpus,custom_stf,NFFT,dt,impulse,insar)
+            make_static_GF_store(home,project_name,fault_name,model_name,stations[i],gftype='insar',update=True)
     
                    
 
@@ -666,33 +690,66 @@ def teleseismicGFs(home,project_name,GF_list_teleseismic,fault_name,model_name,t
 def run_inversion(home,project_name,run_name,fault_name,model_name,GF_list,G_from_file,G_name,epicenter,
                 rupture_speed,num_windows,reg_spatial,reg_temporal,nfaults,beta,decimate,bandpass,
                 solver,bounds,weight=False,Ltype=2,target_moment=None,data_vector=None,weights_file=None,
-                onset_file=None,GOD_inversion=False):
+                onset_file=None,GOD_inversion=False,fast_sweep=False,type_weights=None,G_mmap=False,G_dtype=None,
+                sweep_workers=1,rake_cone=None,slip_bounds=None):
     '''
     Assemble G and d, determine smoothing and run the inversion
+    
+    With fast_sweep=True and the lstsq solver the normal equations are 
+    diagonalized together with Ls'Ls once per temporal regularization level,
+    every spatial level is then solved (and its ABIC found) without another 
+    factorization
+    
+    When weight=True the rows of G are scaled in place, type_weights optionally
+    multiplies the weights of the static, displacement, velocity, tsunami and 
+    InSAR data
+    
+    With G_mmap=True G is memory mapped from its .npy file (optionally saved as
+    G_dtype='float32') and G'G, G'd and the synthetics are accumulated one block
+    of rows at a time, so G never has to fit in memory
+    
+    Each regularization level is solved by run_sweep_point(), with sweep_workers>1
+    that many levels run concurrently on a read-only memory map of the normal
+    equations. Outputs are written as each level finishes and the table of all
+    levels (see inverse.write_sweep_table) is kept up to date in <run_name>.sweep
+    
+    solver='bvls' solves the bounded problem on the regularized normal equations
+    with inverse.bounded_lsq(), warm started from the active set of the previous
+    level when the sweep runs serially. slip_bounds=(lb,ub) sets bounds (scalars
+    or one per parameter, default positivity) and rake_cone=(rake_min,rake_max) 
+    confines the rake of every subfault to that cone (inverse.rake_cone_basis).
+    The cone is solved for non-negative cone coefficients, so slip_bounds can't
+    be combined with rake_cone
     '''
     from mudpy import inverse as inv
     from mudpy.forward import get_mu_and_area
-    from numpy import zeros,dot,array,squeeze,expand_dims,empty,tile,eye,ones,arange,load,size,genfromtxt
-    from numpy import where,sort,r_,diag
-    from numpy.linalg import lstsq
-    from scipy.linalg import norm
+    from numpy import array,tile,ones,arange,load,size,genfromtxt
+    from numpy import where,sort,r_,memmap,save
+    from numpy.linalg import LinAlgError
     from scipy.sparse import csr_matrix as sparse
-    from scipy.optimize import nnls
+    from scipy.sparse import eye as sparse_eye
+    from multiprocessing import Pool
+    from functools import partial
+    from os import remove
     from datetime import datetime
     import gc
     from matplotlib import path
     
     
 
+    if rake_cone is not None and slip_bounds is not None:
+        raise ValueError('slip_bounds can\'t be combined with rake_cone, the cone already bounds the slip')
+    
     t1=datetime.now()
     #Get data vector
     if data_vector==None:
-        d=inv.getdata(home,project_name,GF_list,decimate,bandpass=bandpass)
+        d,layout=inv.getdata(home,project_name,GF_list,decimate,bandpass=bandpass,return_layout=True)
     else:
         d=load(data_vector) 
+        layout=None
     #Get GFs
     G=inv.getG(home,project_name,fault_name,model_name,GF_list,G_from_file,G_name,epicenter,
-                rupture_speed,num_windows,decimate,bandpass,onset_file=onset_file)
+                rupture_speed,num_windows,decimate,bandpass,onset_file=onset_file,G_dtype=G_dtype,mmap=G_mmap)
     
     
     
@@ -806,50 +863,48 @@ def run_inversion(home,project_name,run_name,fault_name,model_name,GF_list,G_fro
     if weight==True:
         print('Applying data weights')
         if weights_file==None:
-            w=inv.get_data_weights(home,project_name,GF_list,d,decimate)
+            w,data_type=inv.get_data_weights(home,project_name,GF_list,d,decimate,type_weights=type_weights,
+                                             return_types=True,layout=layout)
         else:  # Remember weights are "uncertainties" alrger value is less trustworthy
             w = genfromtxt(weights_file)
             w = 1/w
+            data_type=None
         
-        #apply data weights
-        wd=w*d.squeeze()
-        
-        #get norm after applying weights and normalize weghted data vector
-        data_norm = norm(wd)
-        wd = wd/data_norm
-        
-        #reshape for inversion
-        wd=expand_dims(wd,axis=1)
-        
-        #Apply weights to left hand side of the equation (the GFs)
-        W=empty(G.shape)
-        #W=tile(w,(G.shape[1],1)).T #why this and not a diagonal matrix??? ANSWER: they have the same effect, don;t rememebr why I chose to do it this way
-        W=diag(w)
-        
-        #Normalization effect
-        W = W/data_norm
-        WG=W.dot(G)
-
-        #Clear up extraneous variables
-        W=None
-        w=None
-        #Define inversion quantities
-        x=WG.transpose().dot(wd)
-        print('Computing G\'G')
-        K=(WG.T).dot(WG)
+        if G_mmap==True: #Weights are applied to each block of G as it is read
+            WG,wd,row_scale=inv.apply_data_weights(G,d,w,in_place=False)
+            inv.report_data_weights(wd.squeeze(),data_type)
+            w=None
+            print('Computing G\'G from the G store')
+            K,x=inv.normal_equations(G,wd,row_scale=row_scale)
+        else:
+            #Scale the rows of G in place, from here on G holds W*G
+            WG,wd,row_scale=inv.apply_data_weights(G,d,w)
+            G=WG
+            inv.report_data_weights(wd.squeeze(),data_type)
+            w=None
+            #Define inversion quantities
+            x=WG.transpose().dot(wd)
+            print('Computing G\'G')
+            K=(WG.T).dot(WG)
     else:
         #Define inversion quantities if no weighted
-        x=G.transpose().dot(d)
-        print('Computing G\'G')
-        K=(G.T).dot(G)
+        row_scale=None
+        wd=d
+        if G_mmap==True:
+            print('Computing G\'G from the G store')
+            K,x=inv.normal_equations(G,d)
+        else:
+            x=G.transpose().dot(d)
+            print('Computing G\'G')
+            K=(G.T).dot(G)
     #Get regularization matrices (set to 0 matrix if not needed)
     static=False #Is it jsut a static inversion?
     if size(reg_spatial)>1:
         if Ltype==2: #Laplacian smoothing
-            Ls=inv.getLs(home,project_name,fault_name,nfaults,num_windows,bounds)
+            Ls=inv.getLs(home,project_name,fault_name,nfaults,num_windows,bounds,sparse=True)
         elif Ltype==0: #Tikhonov smoothing
             N=nfaults[0]*nfaults[1]*num_windows*2 #Get total no. of model parameters
-            Ls=eye(N) 
+            Ls=sparse_eye(N,format='csr') 
         elif Ltype==3:  #moment regularization
             N=nfaults[0]*nfaults[1]*num_windows*2 #Get total no. of model parameters
             Ls=ones((1,N))
@@ -866,97 +921,234 @@ def run_inversion(home,project_name,run_name,fault_name,model_name,GF_list,G_fro
             return
         Ninversion=len(reg_spatial)
     else:
-        Ls=zeros(K.shape)
+        Ls=sparse(K.shape)
         reg_spatial=array([0.])
         Ninversion=1
     if size(reg_temporal)>1:
-        Lt=inv.getLt(home,project_name,fault_name,num_windows)
+        Lt=inv.getLt(home,project_name,fault_name,num_windows,sparse=True)
         Ninversion=len(reg_temporal)*Ninversion
     else:
-        Lt=zeros(K.shape)
+        Lt=sparse(K.shape)
         reg_temporal=array([0.])
         static=True
-    #Make L's sparse
+    #Make L's sparse, they stay sparse from here on
     Ls=sparse(Ls)
     Lt=sparse(Lt)
     #Get regularization tranposes for ABIC
-    LsLs=Ls.transpose().dot(Ls)
-    LtLt=Lt.transpose().dot(Lt)
-    #inflate
-    Ls=Ls.todense()
-    Lt=Lt.todense()
-    LsLs=LsLs.todense()
-    LtLt=LtLt.todense()
+    LsLs=Ls.transpose().dot(Ls).tocsr()
+    LtLt=Lt.transpose().dot(Lt).tocsr()
     #off we go
     dt=datetime.now()-t1
     print('Preprocessing wall time was '+str(dt))
     print('\n--- RUNNING INVERSIONS ---\n')
     ttotal=datetime.now()
-    kout=0
-    for kt in range(len(reg_temporal)):
-        for ks in range(len(reg_spatial)):
-            t1=datetime.now()
-            lambda_spatial=reg_spatial[ks]
-            lambda_temporal=reg_temporal[kt]
-            print('Running inversion '+str(kout+1)+' of '+str(Ninversion)+' at regularization levels: ls ='+repr(lambda_spatial)+' , lt = '+repr(lambda_temporal))
-            if static==True: #Only statics inversion no Lt matrix
-                Kinv=K+(lambda_spatial**2)*LsLs
-                Lt=eye(len(K))
-                LtLt=Lt.T.dot(Lt)
-            else: #Mixed inversion
-                Kinv=K+(lambda_spatial**2)*LsLs+(lambda_temporal**2)*LtLt
-            if solver.lower()=='lstsq':
-                sol,res,rank,s=lstsq(Kinv,x)
-            elif solver.lower()=='nnls':
-                x=squeeze(x.T)
+    #Everything a sweep point needs besides its regularization levels
+    point_function=partial(run_sweep_point,home=home,project_name=project_name,run_name=run_name,
+                           fault_name=fault_name,model_name=model_name,GF_list=GF_list,G_name=G_name,
+                           epicenter=epicenter,rupture_speed=rupture_speed,num_windows=num_windows,
+                           beta=beta,decimate=decimate,solver=solver,onset_file=onset_file,
+                           GOD_inversion=GOD_inversion,static=static,x=x,d=d,wd=wd,row_scale=row_scale,
+                           layout=layout,Ls=Ls,Lt=Lt,LsLs=LsLs,LtLt=LtLt,G_mmap=G_mmap,
+                           rake_cone=rake_cone,slip_bounds=slip_bounds)
+    #Shared copies and the pool are cleaned up even if a sweep point fails
+    shared_files=[]
+    pool=None
+    try:
+        if sweep_workers>1:
+            #Workers read K, G and the sweep bases from .npy memory maps instead of getting copies
+            def share(A,suffix):
+                if isinstance(A,memmap):
+                    return A.filename
+                shared_file=home+project_name+'/GFs/matrices/'+G_name.split('.npy')[0]+'.sweep.'+suffix+'.npy'
+                save(shared_file,A)
+                shared_files.append(shared_file)
+                return shared_file
+            print('... sharing normal equations with '+str(sweep_workers)+' sweep workers')
+            K_shared=share(K,'K')
+            G_shared=share(G,'G')
+            pool=Pool(sweep_workers)
+        sweep_table=[]
+        active=None
+        kout=0
+        for kt in range(len(reg_temporal)):
+            sweep=False
+            basis_normal=None
+            basis_reg=None
+            if fast_sweep==True and solver.lower()=='lstsq':
+                #Factorize once for all spatial regularization levels
+                print('Diagonalizing normal equations for the regularization sweep')
+                lambda_temporal=reg_temporal[kt]
                 try:
-                    sol,res=nnls(Kinv,x)
-                except:
-                    print('+++ WARNING: No solution found, writting zeros.')
-                    sol=zeros(G.shape[1])
-                x=expand_dims(x,axis=1)
-                sol=expand_dims(sol,axis=1)
-            else:
-                print('ERROR: Unrecognized solver \''+solver+'\'')
-
-            #Force faults outside a polygon to be zero
-#            print('WARNING: Using fault polygon to force solutions to zero')
-#            #load faulkt
-#            fault=genfromtxt(home+project_name+'/data/model_info/'+fault_name)
-#            polygon=genfromtxt('/Users/dmelgarm/Oaxaca2020/etc/zero_fault.txt')
-#            polygon=path.Path(polygon)
-#            i=where(polygon.contains_points(fault[:,1:3])==False)[0]
-#            i=sort(r_[i*2,i*2+1])
-#            N=nfaults[0]*2
-#            i=r_[i,i+N,i+2*N,i+3*N]
-#            sol[i]=0
-            
-            #Compute synthetics
-            ds=dot(G,sol)
-            
-            #Get stats
-            L2,Lmodel=inv.get_stats(Kinv,sol,x,Ls)
-            VR,L2data=inv.get_VR(home,project_name,GF_list,sol,d,ds,decimate,WG,wd)
-            #VR=inv.get_VR(WG,sol,wd)
-            #ABIC=inv.get_ABIC(WG,K,sol,wd,lambda_spatial,lambda_temporal,Ls,LsLs,Lt,LtLt)
-            ABIC=inv.get_ABIC(G,K,sol,d,lambda_spatial,lambda_temporal,Ls,LsLs,Lt,LtLt)
-            #Get moment
-            Mo,Mw=inv.get_moment(home,project_name,fault_name,model_name,sol)
-            #If a rotational offset was applied then reverse it for output to file
-            if beta !=0:
-                sol=inv.rot2ds(sol,beta)
-            #Write log
-            inv.write_log(home,project_name,run_name,kout,rupture_speed,num_windows,lambda_spatial,lambda_temporal,beta,
-                L2,Lmodel,VR,ABIC,Mo,Mw,model_name,fault_name,G_name,GF_list,solver,L2data)
-            #Write output to file
-            if GOD_inversion==True:
-                num=str(kout).rjust(4,'0')
-                np.save(home+project_name+'/output/inverse_models/'+run_name+'.'+num+'.syn.npy',ds)
-                inv.write_synthetics_GOD(home,project_name,run_name,GF_list,ds,kout,decimate)
-            else:
-                inv.write_synthetics(home,project_name,run_name,GF_list,G,sol,ds,kout,decimate)
-            inv.write_model(home,project_name,run_name,fault_name,model_name,rupture_speed,num_windows,epicenter,sol,kout,onset_file=onset_file)
-            kout+=1
-            dt1=datetime.now()-t1
-            dt2=datetime.now()-ttotal
-            print('... inversion wall time was '+str(dt1)+', total wall time elapsed is '+str(dt2))
+                    if static==True:
+                        basis_normal=inv.get_regularization_basis(K,LsLs)
+                    else:
+                        basis_normal=inv.get_regularization_basis(inv.add_regularization(K,0,None,lambda_temporal,LtLt),LsLs)
+                        basis_reg=inv.get_regularization_basis((lambda_temporal**2)*LtLt,LsLs)
+                    sweep=True
+                except LinAlgError:
+                    print('+++ WARNING: Normal equations are singular, solving each regularization level separately')
+            points=[(kout+ks,reg_spatial[ks],reg_temporal[kt]) for ks in range(len(reg_spatial))]
+            kout+=len(reg_spatial)
+            if sweep_workers>1:
+                if sweep==True: #Only the eigenvectors are big
+                    basis_normal=basis_normal[:1]+(share(basis_normal[1],'Vnormal'),)+basis_normal[2:]
+                    if basis_reg is not None:
+                        basis_reg=basis_reg[:1]+(share(basis_reg[1],'Vreg'),)+basis_reg[2:]
+                finished=pool.imap_unordered(partial(point_function,K=K_shared,G=G_shared,
+                                              basis_normal=basis_normal,basis_reg=basis_reg),points)
+            #Results are written by each point as it finishes, keep the sweep table current
+            for point in points:
+                if sweep_workers>1:
+                    row,active=next(finished)
+                else: #Serial points are warm started from the previous one
+                    row,active=point_function(point,K=K,G=G,basis_normal=basis_normal,basis_reg=basis_reg,warm_start=active)
+                sweep_table.append(row)
+                inv.write_sweep_table(home,project_name,run_name,sweep_table)
+                print('... finished inversion '+str(row[0]+1)+' of '+str(Ninversion)+', total wall time elapsed is '+str(datetime.now()-ttotal))
+        if sweep_workers>1:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for shared_file in shared_files:
+            remove(shared_file)
+
+
+def run_sweep_point(point,home,project_name,run_name,fault_name,model_name,GF_list,G_name,epicenter,
+                rupture_speed,num_windows,beta,decimate,solver,onset_file,GOD_inversion,static,K,x,G,d,wd,
+                row_scale,layout,Ls,Lt,LsLs,LtLt,basis_normal=None,basis_reg=None,G_mmap=False,
+                rake_cone=None,slip_bounds=None,warm_start=None):
+    '''
+    Solve one point of the regularization sweep of run_inversion, compute its
+    synthetics and statistics and write the .log, .inv and synthetics files
+    
+    K, G and the eigenvectors of the sweep bases can be .npy file names, they
+    are then memory mapped so that concurrent points share one read-only copy
+    
+    IN:
+        point: Tuple (run number, lambda_spatial, lambda_temporal)
+        K: Normal matrix G'G (weighted if G is)
+        x: G'd
+        G: GF matrix, weighted in place unless G_mmap=True
+        d: Data vector
+        wd: Weighted data vector
+        row_scale: Weights applied to the rows of G, or None
+        basis_normal,basis_reg: Output of get_regularization_basis() if the
+            factorize-once sweep is used
+        rake_cone,slip_bounds: Constraints for solver='bvls', see run_inversion
+        warm_start: Active set to start solver='bvls' from
+        
+    OUT:
+        row: Sweep table row [run number, lambda_spatial, lambda_temporal, L2, Lm, VR of
+            the five data types, ABIC, M0, Mw, solver iterations, converged]
+        active: Final active set of solver='bvls', otherwise None
+    '''
+    from mudpy import inverse as inv
+    from numpy import zeros,dot,squeeze,expand_dims,load,save
+    from numpy.linalg import lstsq
+    from scipy.optimize import nnls
+    from datetime import datetime
+    
+    kout,lambda_spatial,lambda_temporal=point
+    t1=datetime.now()
+    if isinstance(K,str):
+        K=load(K,mmap_mode='r')
+    if isinstance(G,str):
+        G=load(G,mmap_mode='r')
+    if basis_normal is not None and isinstance(basis_normal[1],str):
+        basis_normal=basis_normal[:1]+(load(basis_normal[1],mmap_mode='r'),)+basis_normal[2:]
+    if basis_reg is not None and isinstance(basis_reg[1],str):
+        basis_reg=basis_reg[:1]+(load(basis_reg[1],mmap_mode='r'),)+basis_reg[2:]
+    print('Running inversion '+str(kout+1)+' at regularization levels: ls ='+repr(lambda_spatial)+' , lt = '+repr(lambda_temporal))
+    if static==True: #Only statics inversion no Lt matrix
+        Kinv=inv.add_regularization(K,lambda_spatial,LsLs)
+    else: #Mixed inversion
+        Kinv=inv.add_regularization(K,lambda_spatial,LsLs,lambda_temporal,LtLt)
+    logdet_normal=None
+    logdet_reg=None
+    active=None
+    iterations=0 #Direct solvers
+    converged=True
+    if basis_normal is not None:
+        sol,logdet_normal=inv.regularized_solve(basis_normal,x,lambda_spatial)
+        if static==False:
+            logdet_reg=inv.regularized_logdet(basis_reg,lambda_spatial)
+    elif solver.lower()=='lstsq':
+        sol,res,rank,s=lstsq(Kinv,x)
+    elif solver.lower()=='nnls':
+        try:
+            sol,res=nnls(Kinv,squeeze(x.T))
+        except:
+            print('+++ WARNING: No solution found, writting zeros.')
+            sol=zeros(G.shape[1])
+        sol=expand_dims(sol,axis=1)
+    elif solver.lower()=='bvls':
+        if slip_bounds is None:
+            lb,ub=0.,None
+        else:
+            lb,ub=slip_bounds
+        if rake_cone is None:
+            sol,active,iterations,converged=inv.bounded_lsq(Kinv,x,lb,ub,active=warm_start)
+        else: #Solve for the cone coefficients, sol=C*a with a>=0
+            C=inv.rake_cone_basis(len(Kinv),rake_cone[0],rake_cone[1])
+            CtK=C.T.dot(Kinv)
+            sol,active,iterations,converged=inv.bounded_lsq(C.T.dot(CtK.T).T,C.T.dot(x),0.,None,active=warm_start)
+            sol=C.dot(sol)
+        if converged==True:
+            print('... bounded solver converged in '+str(iterations)+' iterations')
+        else:
+            print('+++ WARNING: bounded solver did not converge in '+str(iterations)+' iterations')
+    else:
+        print('ERROR: Unrecognized solver \''+solver+'\'')
+
+    #Force faults outside a polygon to be zero
+#    print('WARNING: Using fault polygon to force solutions to zero')
+#    #load faulkt
+#    fault=genfromtxt(home+project_name+'/data/model_info/'+fault_name)
+#    polygon=genfromtxt('/Users/dmelgarm/Oaxaca2020/etc/zero_fault.txt')
+#    polygon=path.Path(polygon)
+#    i=where(polygon.contains_points(fault[:,1:3])==False)[0]
+#    i=sort(r_[i*2,i*2+1])
+#    N=nfaults[0]*2
+#    i=r_[i,i+N,i+2*N,i+3*N]
+#    sol[i]=0
+    
+    #Compute synthetics, undo the weights if G was weighted in place
+    wds=None
+    if G_mmap==True: #G store is unweighted
+        ds=inv.blocked_dot(G,sol)
+        if row_scale is not None:
+            wds=ds*expand_dims(row_scale,axis=1)
+    else:
+        ds=dot(G,sol)
+        if row_scale is not None:
+            ds=ds/expand_dims(row_scale,axis=1)
+    
+    #Get stats
+    L2,Lmodel=inv.get_stats(Kinv,sol,x,Ls)
+    VR,L2data=inv.get_VR(home,project_name,GF_list,sol,d,ds,decimate,G,wd,layout=layout,wds=wds)
+    #VR=inv.get_VR(WG,sol,wd)
+    #ABIC=inv.get_ABIC(WG,K,sol,wd,lambda_spatial,lambda_temporal,Ls,LsLs,Lt,LtLt)
+    ABIC=inv.get_ABIC(G,K,sol,d,lambda_spatial,lambda_temporal,Ls,LsLs,Lt,LtLt,
+                      logdet_normal=logdet_normal,logdet_reg=logdet_reg,ds=ds)
+    #Get moment
+    Mo,Mw=inv.get_moment(home,project_name,fault_name,model_name,sol)
+    #If a rotational offset was applied then reverse it for output to file
+    if beta !=0:
+        sol=inv.rot2ds(sol,beta)
+    #Write log
+    inv.write_log(home,project_name,run_name,kout,rupture_speed,num_windows,lambda_spatial,lambda_temporal,beta,
+        L2,Lmodel,VR,ABIC,Mo,Mw,model_name,fault_name,G_name,GF_list,solver,L2data)
+    #Write output to file
+    if GOD_inversion==True:
+        num=str(kout).rjust(4,'0')
+        save(home+project_name+'/output/inverse_models/'+run_name+'.'+num+'.syn.npy',ds)
+        inv.write_synthetics_GOD(home,project_name,run_name,GF_list,ds,kout,decimate)
+    else:
+        inv.write_synthetics(home,project_name,run_name,GF_list,G,sol,ds,kout,decimate)
+    inv.write_model(home,project_name,run_name,fault_name,model_name,rupture_speed,num_windows,epicenter,sol,kout,onset_file=onset_file)
+    print('... inversion '+str(kout+1)+' wall time was '+str(datetime.now()-t1))
+    
+    return [kout,lambda_spatial,lambda_temporal,L2,Lmodel]+list(VR)+[ABIC,Mo,Mw,iterations,converged],active
@@ -445,19 +445,30 @@ def plot_LW_scaling(home,project_name,run_name):
     return L,W,Mw
  
     
-def analyze_sources(rupture_folder,Mw_lims=[7.75,9.35],return_values=False):
+def analyze_sources(rupture_folder,Mw_lims=[7.75,9.35],return_values=False,run_name=None):
     '''
-    Basic parameters of the sources
+    Basic parameters of the sources. If run_name is given the sources are read
+    from that run's rupture catalog in rupture_folder instead of .log/.rupt files
     '''
     
     from glob import glob
     from numpy import zeros,arange,log10,genfromtxt,sqrt,where,sort
     from matplotlib import pyplot as plt
     from matplotlib.ticker import MultipleLocator
+    from mudpy.fakequakes import read_rupture_catalog_folder,get_catalog_rupture
+    from os import path
     
     plt.rcParams.update({'font.size': 12})
-    logs=sort(glob(rupture_folder+'*.log'))
-    ruptures=sort(glob(rupture_folder+'*.rupt'))
+    if run_name is not None:
+        catalog_path=path.join(rupture_folder,run_name+'.catalog')
+        catalog=read_rupture_catalog_folder(catalog_path)
+        if catalog is None:
+            print('ERROR: No rupture catalog in '+catalog_path)
+            return
+        logs=catalog['meta']['run_number']
+    else:
+        logs=sort(glob(rupture_folder+'*.log'))
+        ruptures=sort(glob(rupture_folder+'*.rupt'))
 
     L=zeros(len(logs))
     W=zeros(len(logs))
@@ -470,20 +481,27 @@ def analyze_sources(rupture_folder,Mw_lims=[7.75,9.35],return_values=False):
     trise_max=zeros(len(logs))
     trise_stdev=zeros(len(logs))
     for k in range(len(logs)):
-        f=open(logs[k],'r')
-        while True:
-            line=f.readline()
-            if 'Lmax' in line:
-                L[k]=float(line.split(':')[-1].split()[0])
-            if 'Wmax' in line:
-                W[k]=float(line.split(':')[-1].split()[0])
-            if 'Target magnitude' in line:
-                Mw_target[k]=float(line.split()[-1])
-            if 'Actual magnitude' in line:
-                Mw_actual[k]=float(line.split()[-1])
-                break
-        #now go look in rupture files for slip aprameters
-        source=genfromtxt(ruptures[k])
+        if run_name is not None:
+            source,mask,meta=get_catalog_rupture(catalog,logs[k])
+            L[k]=meta['Lmax']
+            W[k]=meta['Wmax']
+            Mw_target[k]=meta['target_Mw']
+            Mw_actual[k]=meta['actual_Mw']
+        else:
+            f=open(logs[k],'r')
+            while True:
+                line=f.readline()
+                if 'Lmax' in line:
+                    L[k]=float(line.split(':')[-1].split()[0])
+                if 'Wmax' in line:
+                    W[k]=float(line.split(':')[-1].split()[0])
+                if 'Target magnitude' in line:
+                    Mw_target[k]=float(line.split()[-1])
+                if 'Actual magnitude' in line:
+                    Mw_actual[k]=float(line.split()[-1])
+                    break
+            #now go look in rupture files for slip aprameters
+            source=genfromtxt(ruptures[k])
         slip=sqrt(source[:,8]**2+source[:,9]**2)
         trise=source[:,7]
         i=where(slip>0)[0]